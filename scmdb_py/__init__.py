@@ -78,6 +78,11 @@ def create_app(configfile=None):
     assets_env.register('request_new_ensemble_js', request_new_ensemble_js)
     assets_env.register('tabular_css', tabular_css)
 
+    # Bundles built ahead of time by `flask build-assets`, see asset_build.
+    if app.config.get('ASSETS_PRECOMPILED'):
+        from .asset_build import use_precompiled_assets
+        use_precompiled_assets(assets_env, app)
+
     with app.app_context():
         from .frontend import frontend
         #app.register_blueprint(frontend, url_prefix="/portal")
@@ -87,6 +92,9 @@ def create_app(configfile=None):
         app.register_blueprint(content)
         #app.register_blueprint(content, url_prefix="/portal")
 
+    from .commands import register_commands
+    register_commands(app)
+
     app.json_encoder = MiniJSONEncoder
 
     nav.init_app(app)
@@ -98,6 +106,17 @@ def create_app(configfile=None):
     htmlmin.init_app(app)
     RQ(app)
 
+    # Last, so that the compression of responses is timed as well.
+    from .timing import init_timing
+    init_timing(app)
+
+    from .slow_queries import init_slow_queries
+    init_slow_queries(app)
+
+    # Before the first request, see render.
+    from .render import init_render_pool
+    init_render_pool(app)
+
     return app
 
 
@@ -0,0 +1,223 @@
+"""Precomputed gene x group aggregate matrices for the heatmaps.
+
+A heatmap of N genes used to run N joins over the whole ensemble, each on a
+different random sample of cells, and take the per-cluster median of every
+sample. An offline job (`flask --app=scmdb_py aggregates <ensemble>`) now
+computes the median (methylation) or mean (snATAC, RNA) of every gene in every
+cluster and annotation, from all the cells, and saves one dense float32 matrix
+per (ensemble, measure, grouping column) in AGGREGATES_DIR:
+
+    <AGGREGATES_DIR>/<ensemble>/<measure>__<grouping column>.npy   genes x groups
+    <AGGREGATES_DIR>/<ensemble>/<measure>__<grouping column>.json  gene ids, group labels
+
+The matrices are memory-mapped at serve time, so a heatmap is a single gather
+of its gene rows.
+"""
+import json
+import os
+import re
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+from flask import current_app
+
+from . import basedir, db
+from .box_stats import fetch_gene_measures, get_grouping_columns, group_label
+from .cells import EMBEDDING_BINDS
+from .fetch import read_frame
+
+AGGREGATE_STATS = {'methylation': 'median', 'snATAC': 'mean', 'RNA': 'mean'}
+
+# Ensembles, measures and grouping columns are parts of file names, and may come from request arguments.
+AGGREGATE_NAME = re.compile(r'^[A-Za-z0-9_]+$')
+
+# Matrices memory-mapped by this process, by path. Flask-Cache pickles cached
+# values, which would copy the whole matrix on every lookup.
+_loaded = {}
+
+# State shared with the worker processes of build_aggregates, inherited when they are forked.
+_build = {}
+
+
+def aggregates_dir():
+    """Directory of the aggregate matrices, set with AGGREGATES_DIR."""
+
+    return current_app.config.get('AGGREGATES_DIR', os.path.join(basedir, 'tmp', 'aggregates'))
+
+
+def is_aggregate_name(*names):
+    """Whether names can be used in the path of an aggregate matrix, ie. do not contain / or .."""
+
+    return all(isinstance(name, str) and AGGREGATE_NAME.match(name) for name in names)
+
+
+def aggregate_path(ensemble, measure, grouping_column):
+    """Path of an aggregate matrix, without the .npy/.json extension. None if a name is not a valid file name."""
+
+    if not is_aggregate_name(ensemble, measure, grouping_column):
+        return None
+    return os.path.join(aggregates_dir(), ensemble, measure + '__' + grouping_column)
+
+
+def _init_build_worker():
+    """Give each worker its own database connections and an application context."""
+
+    app = _build['app']
+    db.get_engine(app, EMBEDDING_BINDS[_build['modality']]).dispose()
+    app.app_context().push()
+
+
+def _aggregate_gene(gene_id):
+    """Aggregate the values of one gene in every group of every grouping column.
+
+    Returns:
+        tuple: gene_id and a dict of (measure, grouping column) to a Series indexed by group label.
+            The dict is None if the gene could not be fetched.
+    """
+
+    fetched = fetch_gene_measures(_build['ensemble'], _build['modality'], 'gene_' + gene_id.replace('.', '_'),
+                                  _build['grouping_columns'], _build['methylation_types'])
+    if fetched is None:
+        return gene_id, None
+    groupings, measures = fetched
+
+    aggregates = {}
+    for measure, values in measures.items():
+        for column in _build['grouping_columns']:
+            grouped = values.groupby(groupings[column].map(group_label).values, sort=False)
+            aggregates[(measure, column)] = getattr(grouped, AGGREGATE_STATS[_build['modality']])()
+
+    return gene_id, aggregates
+
+
+def build_aggregates(ensemble, modality='methylation', methylation_types=('mCH', 'mCG'), processes=None):
+    """Compute and save the aggregate matrices of an ensemble. Needs an application context.
+
+    Genes are fetched and aggregated by a pool of forked worker processes.
+
+    Arguments:
+        ensemble (str): Ensemble identifier. (Eg. Ens0, Ens1, Ens2...).
+        modality (str): methylation, snATAC or RNA
+        methylation_types ([str]): Methylation types to aggregate, ignored for the other modalities.
+        processes (int): Number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+        int: Number of genes aggregated.
+    """
+
+    # Prevent SQL injection since table and column names cannot be parameterized.
+    if ";" in ensemble or modality not in EMBEDDING_BINDS or any(";" in mtype for mtype in methylation_types):
+        return 0
+
+    engine = db.get_engine(current_app, EMBEDDING_BINDS[modality])
+    grouping_columns = get_grouping_columns(ensemble, modality)
+    genes = [row.gene_id for row in engine.execute("SELECT gene_id FROM genes").fetchall()]
+    gene_rows = {gene_id: row for row, gene_id in enumerate(genes)}
+
+    cells = read_frame("SELECT %(columns)s FROM cells INNER JOIN %(ensemble)s ON cells.cell_id = %(ensemble)s.cell_id" % {
+        'columns': ", ".join(ensemble + "." + column for column in grouping_columns), 'ensemble': ensemble}, engine)
+    groups = {column: cells[column].map(group_label).unique().tolist() for column in grouping_columns}
+    group_columns = {column: {group: i for i, group in enumerate(groups[column])} for column in grouping_columns}
+
+    if modality == 'methylation':
+        measures = [mtype + level for mtype in methylation_types for level in ['_original', '_normalized']]
+    else:
+        measures = ['normalized_counts']
+    matrices = {(measure, column): np.full((len(genes), len(groups[column])), np.nan, dtype=np.float32)
+                for measure in measures for column in grouping_columns}
+
+    _build.update(app=current_app._get_current_object(), ensemble=ensemble, modality=modality,
+                  grouping_columns=grouping_columns, methylation_types=list(methylation_types))
+    num_genes = 0
+    pool = Pool(processes, initializer=_init_build_worker)
+    try:
+        for gene_id, aggregates in pool.imap_unordered(_aggregate_gene, genes, chunksize=16):
+            if aggregates is None:
+                continue
+            for (measure, column), values in aggregates.items():
+                positions = [group_columns[column][group] for group in values.index]
+                matrices[(measure, column)][gene_rows[gene_id], positions] = values.values
+            num_genes += 1
+    finally:
+        pool.close()
+        pool.join()
+        _build.clear()
+
+    os.makedirs(os.path.join(aggregates_dir(), ensemble), exist_ok=True)
+    for (measure, column), matrix in matrices.items():
+        path = aggregate_path(ensemble, measure, column)
+        if path is None:
+            continue
+        # Write aside and rename so that running servers never map a partial file.
+        with open(path + '.npy.tmp', 'wb') as f:
+            np.save(f, matrix)
+        with open(path + '.json.tmp', 'w') as f:
+            json.dump({'genes': genes, 'groups': groups[column], 'stat': AGGREGATE_STATS[modality]}, f)
+        os.replace(path + '.npy.tmp', path + '.npy')
+        os.replace(path + '.json.tmp', path + '.json')
+
+    return num_genes
+
+
+def load_aggregate(ensemble, measure, grouping_column):
+    """Memory-map an aggregate matrix, reloading it when it has been rebuilt.
+
+    Returns:
+        dict: matrix (genes x groups), genes (gene id of each row), gene_rows (gene id, with and without version,
+            to row) and groups.
+            None if the matrix has not been built.
+    """
+
+    path = aggregate_path(ensemble, measure, grouping_column)
+    if path is None:
+        return None
+    try:
+        mtime = os.path.getmtime(path + '.npy')
+    except OSError:
+        return None
+
+    loaded = _loaded.get(path)
+    if loaded is None or loaded['mtime'] != mtime:
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        gene_rows = {}
+        for row, gene_id in enumerate(meta['genes']):
+            gene_rows[gene_id] = row
+            gene_rows.setdefault(gene_id.split('.')[0], row)
+        loaded = {'mtime': mtime,
+                  'matrix': np.load(path + '.npy', mmap_mode='r'),
+                  'genes': meta['genes'],
+                  'gene_rows': gene_rows,
+                  'groups': meta['groups']}
+        _loaded[path] = loaded
+
+    return loaded
+
+
+def get_aggregate_frame(ensemble, measure, grouping_column, gene_ids, gene_names):
+    """Gather the aggregates of a few genes, in the shape the heatmaps build from per-gene queries.
+
+    Arguments:
+        ensemble (str): Ensemble identifier. (Eg. Ens0, Ens1, Ens2...).
+        measure (str): ie. mCH_original, mCG_normalized or normalized_counts
+        grouping_column (str): ie. cluster_mCH_lv_npc50_k5, annotation_RNA
+        gene_ids ([str]): Ensembl IDs of the genes.
+        gene_names ([str]): Column name of each gene.
+
+    Returns:
+        DataFrame: Groups x genes, indexed by grouping_column. None if the matrix has not been built or
+            lacks one of the genes.
+    """
+
+    aggregate = load_aggregate(ensemble, measure, grouping_column)
+    if aggregate is None:
+        return None
+
+    rows = [aggregate['gene_rows'].get(gene_id) for gene_id in gene_ids]
+    if None in rows:
+        return None
+
+    # Cluster numbers are stored as labels, turn them back into numbers so that they sort numerically.
+    groups = pd.Index(pd.to_numeric(pd.Series(aggregate['groups']), errors='ignore'), name=grouping_column)
+    return pd.DataFrame(np.asarray(aggregate['matrix'][rows], dtype=np.float64).T, index=groups, columns=gene_names)
@@ -0,0 +1,102 @@
+"""Static assets built ahead of time instead of on the first request.
+
+With url_expire, Flask-Assets checks every bundle on each page and rebuilds the
+stale ones on the request, and the dissections template had to be rendered with
+PHP before starting the server. `flask --app=scmdb_py build-assets` now does
+both ahead of time: it renders the templates, builds and minifies every bundle,
+records the hash of each output in a manifest, and writes a gzipped copy of each
+output next to it.
+
+With ASSETS_PRECOMPILED set, the application never builds a bundle: asset URLs
+are looked up in the manifest, and the gzipped copies are served to browsers
+which accept them.
+"""
+import gzip
+import mimetypes
+import os
+import shutil
+import subprocess
+
+from flask import request, send_from_directory
+
+from . import basedir
+
+# Templates rendered by PHP, as (source, output) paths relative to the package.
+PHP_TEMPLATES = [('templates/components/CEMBA_dissections.php', 'templates/components/CEMBA_dissections.html')]
+
+
+def manifest_path(app):
+    """Path of the manifest of bundle versions, set with ASSETS_MANIFEST_FILE."""
+
+    return app.config.get('ASSETS_MANIFEST_FILE', os.path.join(app.static_folder, 'assets-manifest.json'))
+
+
+def configure_versions(assets_env, app):
+    """Version bundle URLs by the hash of their contents, recorded in the manifest."""
+
+    assets_env.url_expire = True
+    assets_env.versions = 'hash'
+    assets_env.manifest = 'json:' + manifest_path(app)
+
+
+def render_php_templates():
+    """Render the PHP templates. Written aside and renamed so that a failed render keeps the previous output.
+
+    Returns:
+        list: Paths of the rendered templates.
+    """
+
+    rendered = []
+    for source, output in PHP_TEMPLATES:
+        output = os.path.join(basedir, output)
+        with open(output + '.tmp', 'wb') as f:
+            subprocess.check_call(['php', '-f', os.path.join(basedir, source)], stdout=f)
+        os.replace(output + '.tmp', output)
+        rendered.append(output)
+    return rendered
+
+
+def gzip_file(path):
+    """Write a gzipped copy of a file next to it, as <path>.gz."""
+
+    with open(path, 'rb') as f, gzip.open(path + '.gz.tmp', 'wb', compresslevel=9) as compressed:
+        shutil.copyfileobj(f, compressed)
+    os.replace(path + '.gz.tmp', path + '.gz')
+
+
+def build_bundles(assets_env, app):
+    """Build every bundle, record their versions in the manifest and gzip their outputs.
+
+    Returns:
+        list: Paths of the bundle outputs.
+    """
+
+    configure_versions(assets_env, app)
+    outputs = []
+    for name, bundle in sorted(assets_env._named_bundles.items()):
+        bundle.build(force=True)
+        output = bundle.resolve_output()
+        gzip_file(output)
+        outputs.append(output)
+    return outputs
+
+
+def use_precompiled_assets(assets_env, app):
+    """Serve the bundles built by build-assets without ever building them."""
+
+    configure_versions(assets_env, app)
+    assets_env.auto_build = False
+
+    static = app.view_functions['static']
+
+    def static_precompressed(filename):
+        path = os.path.join(app.static_folder, filename)
+        if 'gzip' in request.headers.get('Accept-Encoding', '') and os.path.isfile(path + '.gz'):
+            response = send_from_directory(app.static_folder, filename + '.gz',
+                                           mimetype=mimetypes.guess_type(filename)[0])
+            response.headers['Content-Encoding'] = 'gzip'
+            response.headers['Vary'] = 'Accept-Encoding'
+            return response
+        return static(filename=filename)
+
+    app.view_functions['static'] = static_precompressed
@@ -25,6 +25,171 @@ function delayLoad(f) {
     setTimeout(f, 50);
 }
 
+// Heavy plots are rendered as jobs: their routes answer 202 with a job id,
+// which is polled until the plot is ready (see jobs.py). Takes the options of
+// $.ajax, success and complete are called once the plot itself has arrived.
+var PLOT_JOB_POLL_MS = 2000;
+
+function ajaxPlot(options) {
+    let success = options.success || function() {};
+    let complete = options.complete || function() {};
+    let failed = function(xhr) {
+        complete();
+        if (xhr.status === 404 || xhr.status === 500) {
+            success(xhr.responseText);
+        }
+    };
+
+    let poll = function(job) {
+        $.ajax({
+            type: "GET",
+            url: './plot/job/'+job,
+            success: function(data, textStatus, xhr) {
+                if (xhr.status === 202) {
+                    setTimeout(function() { poll(job); }, PLOT_JOB_POLL_MS);
+                } else {
+                    complete();
+                    success(data);
+                }
+            },
+            error: failed
+        });
+    };
+
+    options.complete = undefined;
+    options.success = function(data, textStatus, xhr) {
+        if (xhr.status === 202) {
+            setTimeout(function() { poll(data.job); }, PLOT_JOB_POLL_MS);
+        } else {
+            complete();
+            success(data);
+        }
+    };
+    options.error = failed;
+    if (plotBatch !== null) {
+        if (options.beforeSend) {
+            options.beforeSend();
+        }
+        plotBatch.push(options);
+        return;
+    }
+    return $.ajax(options);
+}
+
+// While f runs, ajaxPlot collects the plots instead of requesting them, they
+// are then requested from ./plot/gene_view in one round trip, streamed where
+// the browser can read a response as it arrives.
+var plotBatch = null;
+
+function batchPlots(f) {
+    plotBatch = [];
+    try {
+        f();
+    } finally {
+        let batch = plotBatch;
+        plotBatch = null;
+        sendPlotBatch(batch);
+    }
+}
+
+function sendPlotBatch(batch) {
+    if (batch.length === 0) {
+        return;
+    }
+    let parts = {};
+    $.each(batch, function(i, options) {
+        parts[i] = options.url;
+    });
+
+    if (typeof(fetch) !== 'undefined' && typeof(TextDecoder) !== 'undefined') {
+        return streamPlotBatch(batch, parts);
+    }
+
+    // Posted, the URLs of the plots carry the genes and would not fit in a query string.
+    $.ajax({
+        type: "POST",
+        url: './plot/gene_view',
+        data: JSON.stringify({parts: parts}),
+        contentType: 'application/json',
+        headers: {'X-CSRFToken': csrfToken()},
+        dataType: 'json',
+        success: function(data) {
+            $.each(batch, function(i, options) {
+                deliverPlot(options, data[i]);
+            });
+        },
+        error: function(xhr) {
+            $.each(batch, function(i, options) {
+                options.error(xhr);
+            });
+        }
+    });
+}
+
+// Shows each plot of a batch as soon as the server has rendered it, reading
+// the newline delimited JSON of ./plot/gene_view/stream as it arrives.
+function streamPlotBatch(batch, parts) {
+    let delivered = {};
+    let fail = function() {
+        $.each(batch, function(i, options) {
+            if (!delivered[i]) {
+                options.error({status: 500, responseText: 'Failed to produce plot. Contact maintainer.'});
+            }
+        });
+    };
+
+    fetch('./plot/gene_view/stream', {
+        method: 'POST',
+        credentials: 'same-origin',
+        headers: {'Content-Type': 'application/json', 'X-CSRFToken': csrfToken()},
+        body: JSON.stringify({parts: parts})
+    })
+        .then(function(response) {
+            if (!response.ok) {
+                return fail();
+            }
+            let reader = response.body.getReader();
+            let decoder = new TextDecoder();
+            let buffer = '';
+            let read = function() {
+                return reader.read().then(function(chunk) {
+                    buffer += decoder.decode(chunk.value || new Uint8Array(), {stream: !chunk.done});
+                    let lines = buffer.split('\n');
+                    buffer = lines.pop();
+                    $.each(lines, function(j, line) {
+                        if (line.length > 0) {
+                            let part = JSON.parse(line);
+                            delivered[part.name] = true;
+                            deliverPlot(batch[part.name], part);
+                        }
+                    });
+                    if (chunk.done) {
+                        return fail();  // Plots missing from the stream
+                    }
+                    return read();
+                });
+            };
+            return read();
+        })
+        .catch(fail);
+}
+
+// Token of the page (see base.html), posts are checked by Flask-WTF.
+function csrfToken() {
+    return $('meta[name="csrf-token"]').attr('content');
+}
+
+function deliverPlot(options, part) {
+    let xhr = {status: part.status, responseText: part.body};
+    if (part.status === 202) {
+        options.success(JSON.parse(part.body), 'success', xhr);
+    } else if (part.status === 200) {
+        options.success(part.body, 'success', xhr);
+    } else {
+        options.error(xhr);
+    }
+}
+
 function save3DData(trace, layout){
     trace_3d = trace;
     layout_3d = layout;
@@ -186,6 +351,16 @@ function updateSearchWithModules(module) {
 }
 
 
+// Scatter plots of a whole gene module are requested by module name, the server looks its genes up.
+function scatterGeneQuery(genes_query) {
+    let module = $('#geneModulesSelect').val();
+    if (module && module !== '0') {
+        return 'module='+encodeURIComponent(module);
+    }
+    return 'q='+genes_query;
+}
+
+
 // Drop down options for tSNE (methylation) plot //
 function populateMethylationTSNEDropdowns(data) {
     window.global_all_methylation_tsne_settings = data['all_tsne_settings'];
@@ -596,47 +771,49 @@ function updateGeneElements(updateMCHScatter=true) {
         if (typeof(Storage) !== 'undefined') {
             storage.save('lastViewedGenes', lastViewedGenes, 30);  // store last viewed genes for 30 minutes
         }
-        if (updateMCHScatter){
-            if (methylation_data_available === 1) {
-                updateMCHScatterPlot();
-            }
-            if (snATAC_data_available === 1) {
-                updatesnATACScatterPlot();
-            }
-            if (RNA_data_available === 1) {
-                updateRNAScatterPlot();
+        batchPlots(function() {
+            if (updateMCHScatter){
+                if (methylation_data_available === 1) {
+                    updateMCHScatterPlot();
+                }
+                if (snATAC_data_available === 1) {
+                    updatesnATACScatterPlot();
+                }
+                if (RNA_data_available === 1) {
+                    updateRNAScatterPlot();
+                }
             }
-        }
-        try {updateClustersBarPlot();} catch(err) {};
-        $('#epiBrowserLink').removeClass('disabled');
-        if($("#geneName").select2('data').length > 1) {
-            $('#normalize-heatmap').show();
-            $('#methylation-box-heat-normalize-toggle-div').show();
-            $('#methylation-box-heat-normalize-toggle').prop('disabled', false);
-            updateMethylationHeatmap();
-            updateCorrelatingGeneDataTable("");
-            // $('#epiBrowserLink').addClass('disabled');
-            $("#methylation-box-and-heat").removeClass('col-md-8').addClass('col-md-12');
-            $("#methylation-correlated-genes").hide();
-            if (RNA_data_available === 1) {
-                updateRNAHeatmap();
-                $('#RNA-box-heat-normalize-toggle').prop('disabled', false);
+            try {updateClustersBarPlot();} catch(err) {};
+            $('#epiBrowserLink').removeClass('disabled');
+            if($("#geneName").select2('data').length > 1) {
+                $('#normalize-heatmap').show();
+                $('#methylation-box-heat-normalize-toggle-div').show();
+                $('#methylation-box-heat-normalize-toggle').prop('disabled', false);
+                updateMethylationHeatmap();
+                updateCorrelatingGeneDataTable("");
+                // $('#epiBrowserLink').addClass('disabled');
+                $("#methylation-box-and-heat").removeClass('col-md-8').addClass('col-md-12');
+                $("#methylation-correlated-genes").hide();
+                if (RNA_data_available === 1) {
+                    updateRNAHeatmap();
+                    $('#RNA-box-heat-normalize-toggle').prop('disabled', false);
+                }
             }
-        }
-        else{
-            $('#normalize-heatmap').hide();
-            $('#methylation-box-heat-normalize-toggle-div').hide();
-            $('#methylation-box-heat-normalize-toggle').prop('disabled', true);
-            //updateOrthologToggle();
-            updateMCHBoxPlot();
-            updateCorrelatingGeneDataTable($('#geneName option:selected').val());
-            $("#methylation-box-and-heat").removeClass('col-md-12').addClass('col-md-8');
-            $("#methylation-correlated-genes").show();
-            if (RNA_data_available === 1) {
-                updateRNABoxPlot();
-                $('#RNA-box-heat-normalize-toggle').prop('disabled', true);
+            else{
+                $('#normalize-heatmap').hide();
+                $('#methylation-box-heat-normalize-toggle-div').hide();
+                $('#methylation-box-heat-normalize-toggle').prop('disabled', true);
+                //updateOrthologToggle();
+                updateMCHBoxPlot();
+                updateCorrelatingGeneDataTable($('#geneName option:selected').val());
+                $("#methylation-box-and-heat").removeClass('col-md-12').addClass('col-md-8');
+                $("#methylation-correlated-genes").show();
+                if (RNA_data_available === 1) {
+                    updateRNABoxPlot();
+                    $('#RNA-box-heat-normalize-toggle').prop('disabled', true);
+                }
             }
-        }
+        });
         $.ajax({
             url: './gene/id?q='+geneSelected,
             dataType: 'json',
@@ -690,10 +867,10 @@ function updateMCHScatterPlot(onlyUpdatetSNEandClustering=false) {
 
 	// Load the data
     if ($('#geneName option:selected').val() != 'Select..') {
-        $.ajax({
+        ajaxPlot({
         //$.getJSON({
             type: "GET",
-            url: './plot/methylation/scatter/'+ensemble+'/'+tsne_setting+'/' +methylationType+ '/'+levelType+'/'+grouping+'/'+clustering+'/'+methylation_color_percentile_Values[0]+'/'+methylation_color_percentile_Values[1]+'/'+tsneOutlierOption+'/'+max_points+'?q='+genes_query,
+            url: './plot/methylation/scatter/'+ensemble+'/'+tsne_setting+'/' +methylationType+ '/'+levelType+'/'+grouping+'/'+clustering+'/'+methylation_color_percentile_Values[0]+'/'+methylation_color_percentile_Values[1]+'/'+tsneOutlierOption+'/'+max_points+'?'+scatterGeneQuery(genes_query),
             beforeSend: function() {
                 $("#mch-scatter-loader").show();
                 $("#methylation-tsneUpdateBtn, #methylation-tsneUpdateBtn-top").attr('disabled', true);
@@ -706,6 +883,7 @@ function updateMCHScatterPlot(onlyUpdatetSNEandClustering=false) {
                 //Plotly.newPlot('plot-mch-scatter', data);
                 $('#plot-mch-scatter').html(data);
                 $("#methylation-tsneUpdateBtn, #methylation-tsneUpdateBtn-top").attr('disabled', false);
+                initMCHScatterTiles(tsne_setting, methylationType, levelType, genes_query);
             }
         });
     }
@@ -716,6 +894,186 @@ function updateMCHScatterPlot(onlyUpdatetSNEandClustering=false) {
     $("#methylation-clustering-options-heading").text("Algorithm: " + $("#methylation-clustering-algorithms").val() + ", Methylation: " + $("#methylation-clustering-methylation").val() + ", K-value: " + $("#methylation-clustering-k").val());
 }
 
+// Zooming into the 2D methylation scatter loads the cells hidden by max_points
+// for the visible region, one quadtree tile at a time (see tiles.py).
+var mchTileRequest = 0;
+var mchTileCache = {};
+
+function initMCHScatterTiles(tsne_setting, methylationType, levelType, genes_query) {
+    let graph = $('#plot-mch-scatter .plotly-graph-div')[0];
+    if (typeof(graph) === 'undefined' || tsne_setting.indexOf('_ndim2_') === -1 || genes_query.indexOf('+') !== -1) {
+        return;
+    }
+    mchTileRequest++;
+    mchTileCache = {};
+
+    $.getJSON('./plot/methylation/tiles/'+ensemble+'/'+tsne_setting, function(info) {
+        if (typeof(info.bounds) === 'undefined') {
+            return;
+        }
+        let tileURL = './plot/methylation/tile/'+ensemble+'/'+tsne_setting+'/'+methylationType+'/'+levelType;
+        graph.on('plotly_relayout', function() {
+            updateMCHScatterTiles(graph, info, tileURL, genes_query);
+        });
+    });
+}
+
+function updateMCHScatterTiles(graph, info, tileURL, genes_query) {
+    let request = ++mchTileRequest;
+    let xrange = graph.layout.xaxis2.range;
+    let yrange = graph.layout.yaxis.range;
+    let bounds = info.bounds;
+    let width = Math.max(bounds[1] - bounds[0], 1e-9);
+    let height = Math.max(bounds[3] - bounds[2], 1e-9);
+
+    let zoom = Math.ceil(Math.log2(Math.min(width / (xrange[1] - xrange[0]), height / (yrange[1] - yrange[0]))));
+    zoom = Math.min(Math.max(zoom, 0), info.max_zoom);
+
+    let detail = graph.data.findIndex(trace => trace.name === 'tiles');
+    if (zoom === 0) {
+        if (detail !== -1) {
+            Plotly.deleteTraces(graph, detail);
+        }
+        return;
+    }
+
+    let numTiles = Math.pow(2, zoom);
+    let tileIndex = function(value, lower, size) {
+        return Math.min(Math.max(Math.floor((value - lower) / size * numTiles), 0), numTiles - 1);
+    };
+    let requests = [];
+    for (let tx = tileIndex(xrange[0], bounds[0], width); tx <= tileIndex(xrange[1], bounds[0], width); tx++) {
+        for (let ty = tileIndex(yrange[0], bounds[2], height); ty <= tileIndex(yrange[1], bounds[2], height); ty++) {
+            let url = tileURL+'/'+zoom+'/'+tx+'/'+ty+'?q='+genes_query;
+            if (!(url in mchTileCache)) {
+                mchTileCache[url] = $.getJSON(url);
+            }
+            requests.push(mchTileCache[url]);
+        }
+    }
+
+    $.when.apply($, requests).done(function() {
+        if (request !== mchTileRequest) {
+            return;
+        }
+        // Share the color scale and renderer (SVG or WebGL) of the full scatter plot.
+        // WebGL traces cannot mix numbers and color names, so cells without data are dropped.
+        let valueTrace = graph.data.find(trace => trace.marker && trace.marker.colorbar);
+        let x = [], y = [], colors = [], text = [];
+        for (let i = 0; i < requests.length; i++) {
+            let tile = requests[i].responseJSON;
+            if (typeof(tile) === 'undefined' || typeof(tile.x) === 'undefined') {
+                continue;
+            }
+            for (let j = 0; j < tile.x.length; j++) {
+                if (tile.value[j] === null && valueTrace.type === 'scattergl') {
+                    continue;
+                }
+                x.push(tile.x[j]);
+                y.push(tile.y[j]);
+                colors.push(tile.value[j] === null ? 'grey' : tile.value[j]);
+                text.push(tile.value[j] === null ? 'N/A' : String(tile.value[j]));
+            }
+        }
+
+        let marker = {
+            'color': colors,
+            'colorscale': 'Viridis',
+            'cmin': valueTrace.marker.cmin,
+            'cmax': valueTrace.marker.cmax,
+            'size': 2,
+        };
+        if (detail === -1) {
+            Plotly.addTraces(graph, {
+                'type': valueTrace.type,
+                'mode': 'markers',
+                'name': 'tiles',
+                'x': x,
+                'y': y,
+                'text': text,
+                'marker': marker,
+                'xaxis': 'x2',
+                'yaxis': 'y',
+                'showlegend': false,
+                'hoverinfo': 'text',
+            });
+        } else {
+            Plotly.restyle(graph, {'x': [x], 'y': [y], 'text': [text], 'marker': [marker]}, [detail]);
+        }
+    }).fail(function() {
+        // Tiles which failed are asked again on the next zoom, meanwhile the full scatter
+        // is shown without the overlay of a previous region.
+        $.each(requests, function(i, tileRequest) {
+            if (tileRequest.state() === 'rejected') {
+                $.each(mchTileCache, function(url, cached) {
+                    if (cached === tileRequest) {
+                        delete mchTileCache[url];
+                    }
+                });
+            }
+        });
+        if (request !== mchTileRequest) {
+            return;
+        }
+        let overlay = graph.data.findIndex(trace => trace.name === 'tiles');
+        if (overlay !== -1) {
+            Plotly.deleteTraces(graph, overlay);
+        }
+    });
+}
+
+// The color percentile sliders only move the clamp of the color scale. Scatter plots
+// come with the percentiles of their values (see quantiles.py), so the new limits
+// are applied with Plotly.restyle instead of asking the server for a new plot.
+function sketchQuantile(sketch, q) {
+    let position = Math.min(Math.max(q, 0), 1) * (sketch.length - 1);
+    let lower = Math.floor(position);
+    if (lower === sketch.length - 1) {
+        return sketch[lower];
+    }
+    return sketch[lower] + (sketch[lower + 1] - sketch[lower]) * (position - lower);
+}
+
+function colorbarTicks(start, end) {
+    // Same ticks as scatter.colorbar_ticks
+    let label = function(value) { return String(Math.round(value * 100) / 100); };
+    let tickvals = [], ticktext = [];
+    for (let i = 0; i < 4; i++) {
+        tickvals.push(start + i * (end - start) / 4);
+        ticktext.push(label(tickvals[i]));
+    }
+    tickvals.push(end);
+    ticktext[0] = '<' + ticktext[0];
+    ticktext.push('>' + label(end));
+    return {'tickvals': tickvals, 'ticktext': ticktext};
+}
+
+function restyleScatterColors(container, percentiles) {
+    let graph = $(container + ' .plotly-graph-div')[0];
+    let sketch = $(container + ' .color-sketch');
+    if (typeof(graph) === 'undefined' || sketch.length === 0) {
+        return false;
+    }
+    sketch = JSON.parse(sketch.text());
+    let start = sketchQuantile(sketch, percentiles[0]);
+    let end = Math.max(sketchQuantile(sketch, percentiles[1]), start + 0.01);
+    let ticks = colorbarTicks(start, end);
+
+    // Value traces, including the zoom tiles, and the one holding the colorbar
+    let valueTraces = [], colorbarTraces = [];
+    graph.data.forEach(function(trace, i) {
+        if (trace.marker && typeof(trace.marker.cmin) !== 'undefined') {
+            valueTraces.push(i);
+        }
+        if (trace.marker && trace.marker.colorbar) {
+            colorbarTraces.push(i);
+        }
+    });
+    Plotly.restyle(graph, {'marker.cmin': start, 'marker.cmax': end}, valueTraces);
+    Plotly.restyle(graph, {'marker.colorbar.tickvals': [ticks.tickvals], 'marker.colorbar.ticktext': [ticks.ticktext]}, colorbarTraces);
+    return true;
+}
+
 function updatesnATACScatterPlot(onlyUpdatetSNEandClustering=false) {
     let tsne_settings = "ATAC_ndim"+$("#snATAC-tsne-dimensions").val()+"_perp"+$("#snATAC-tsne-perplexity").val();
     let max_points = $('#max-points').val();
@@ -746,10 +1104,10 @@ function updatesnATACScatterPlot(onlyUpdatetSNEandClustering=false) {
     genes_query = genes_query.slice(0,-1);
 
     if ($('#geneName option:selected').val() != 'Select..') {
-        $.ajax({
+        ajaxPlot({
         //$.getJSON({
             type: "GET",
-            url: './plot/snATAC/scatter/'+ensemble+'/'+grouping+'/'+snATAC_color_percentile_Values[0]+'/'+snATAC_color_percentile_Values[1]+'/'+tsneOutlierOption+'/'+smoothing+'/'+max_points+'?q='+genes_query,
+            url: './plot/snATAC/scatter/'+ensemble+'/'+grouping+'/'+snATAC_color_percentile_Values[0]+'/'+snATAC_color_percentile_Values[1]+'/'+tsneOutlierOption+'/'+smoothing+'/'+max_points+'?'+scatterGeneQuery(genes_query),
             beforeSend: function() {
                 $("#snATAC-scatter-loader").show();
                 $("#methylation-tsneUpdateBtn, #methylation-tsneUpdateBtn-top").attr("disabled", true);
@@ -800,10 +1158,10 @@ function updateRNAScatterPlot(onlyUpdatetSNEandClustering=false) {
     genes_query = genes_query.slice(0,-1);
 
     if ($('#geneName option:selected').val() != 'Select..') {
-        $.ajax({
+        ajaxPlot({
         //$.getJSON({
             type: "GET",
-            url: './plot/RNA/scatter/'+ensemble+'/'+grouping+'/'+RNA_color_percentile_Values[0]+'/'+RNA_color_percentile_Values[1]+'/'+tsneOutlierOption+'/'+max_points+'?q='+genes_query,
+            url: './plot/RNA/scatter/'+ensemble+'/'+grouping+'/'+RNA_color_percentile_Values[0]+'/'+RNA_color_percentile_Values[1]+'/'+tsneOutlierOption+'/'+max_points+'?'+scatterGeneQuery(genes_query),
             beforeSend: function() {
                 $("#RNA-scatter-loader").show();
                 $("#methylation-tsneUpdateBtn, #methylation-tsneUpdateBtn-top").attr("disabled", true);
@@ -973,7 +1331,7 @@ function updateMCHBoxPlot() {
         var outlierOption = 'false';
     }
 
-    $.ajax({
+    ajaxPlot({
         type: "GET",
         url: './plot/methylation/box/'+ensemble+'/'+methylationType+'/'+geneSelected+'/'+grouping+'/'+clustering+'/'+levelType+'/'+outlierOption+'/'+max_points,
         beforeSend: function() {
@@ -997,7 +1355,7 @@ function updateClustersBarPlot() {
     let normalize = $('#clusters-bar-normalize-toggle').prop('checked');
     let clustering = $("#methylation-clustering-methylation").val()+"_"+$("#methylation-clustering-algorithms").val()+"_npc50"+"_k"+$("#methylation-clustering-k").val();
 
-    $.ajax({
+    ajaxPlot({
         type: "GET",
         url: './plot/clusters/bar/'+ensemble+'/'+grouping+'/'+clustering+'/'+normalize,
         beforeSend: function() {
@@ -1025,7 +1383,7 @@ function updatesnATACBoxPlot() {
         var outlierOption = 'false';
     }
 
-    $.ajax({
+    ajaxPlot({
         type: "GET",
         url: './plot/snATAC/box/'+ensemble+'/'+geneSelected+'/'+grouping+'/'+outlierOption,
         beforeSend: function() {
@@ -1054,7 +1412,7 @@ function updateRNABoxPlot() {
         var outlierOption = 'false';
     }
 
-    $.ajax({
+    ajaxPlot({
         type: "GET",
         url: './plot/RNA/box/'+ensemble+'/'+geneSelected+'/'+grouping+'/'+outlierOption,
         beforeSend: function() {
@@ -1117,7 +1475,7 @@ function updateMethylationHeatmap() {
     }
     genes_query = genes_query.slice(0,-1);
 
-    $.ajax({
+    ajaxPlot({
         type: "GET",
         url: './plot/methylation/heat/'+ensemble+'/'+methylationType+'/'+grouping+'/'+clustering+'/'+levelType+'/'+methylation_box_color_percentile_Values[0]+'/'+methylation_box_color_percentile_Values[1]+'?q='+genes_query+'&normalize='+normalize,
         beforeSend: function() {
@@ -1157,7 +1515,7 @@ function updatesnATACHeatmap() {
     }
     genes_query = genes_query.slice(0,-1);
 
-    $.ajax({
+    ajaxPlot({
         type: "GET",
         url: './plot/snATAC/heat/'+ensemble+'/'+grouping+'/'+snATAC_color_percentile_Values[0]+'/'+snATAC_color_percentile_Values[1]+'?q='+genes_query+'&normalize='+normalize,
         beforeSend: function() {
@@ -1196,7 +1554,7 @@ function updateRNAHeatmap() {
     }
     genes_query = genes_query.slice(0,-1);
 
-    $.ajax({
+    ajaxPlot({
         type: "GET",
         url: './plot/RNA/heat/'+ensemble+'/'+grouping+'/'+RNA_color_percentile_Values[0]+'/'+RNA_color_percentile_Values[1]+'?q='+genes_query+'&normalize='+normalize,
         beforeSend: function() {
@@ -0,0 +1,291 @@
+"""Precomputed per-group summary statistics for the box plots.
+
+The box plots used to fetch every sampled cell of a gene and let Plotly compute
+the quartiles in the browser, shipping every point when outliers were shown.
+An offline job (`flask --app=scmdb_py box-summaries <ensemble>`) now computes,
+for every gene of an ensemble and every clustering of its cells, the number of
+cells, mean, median, quartiles, whiskers and a capped list of outliers, and
+stores them in the `box_summaries` table of the modality's database. The box
+plot endpoints draw from these rows, so their cost no longer depends on the
+size of the ensemble. Ensembles which have not been summarised yet fall back to
+the per-cell plots.
+"""
+import datetime
+import json
+import sys
+
+import numpy as np
+import pandas as pd
+from flask import current_app
+from sqlalchemy import exc
+
+from . import cache, db
+from .cells import EMBEDDING_BINDS
+from .fetch import read_frame
+
+SUMMARY_TABLE = 'box_summaries'
+
+# Outliers beyond this number are thinned out to evenly spaced ranks, which
+# keeps the most extreme values of each group.
+MAX_OUTLIERS = 100
+
+SUMMARY_COLUMNS = ['group_name', 'n', 'mean', 'median', 'q1', 'q3', 'lowerfence', 'upperfence', 'outliers']
+
+CREATE_SUMMARY_TABLE = "CREATE TABLE IF NOT EXISTS %(table)s ( \
+    ensemble VARCHAR(32) NOT NULL, \
+    gene_id VARCHAR(32) NOT NULL, \
+    measure VARCHAR(24) NOT NULL, \
+    grouping VARCHAR(64) NOT NULL, \
+    group_name VARCHAR(96) NOT NULL, \
+    n INT NOT NULL, \
+    mean DOUBLE, median DOUBLE, q1 DOUBLE, q3 DOUBLE, lowerfence DOUBLE, upperfence DOUBLE, \
+    outliers TEXT, \
+    PRIMARY KEY (ensemble, gene_id, measure, grouping, group_name))" % {'table': SUMMARY_TABLE}
+
+
+def group_label(group):
+    """Label of a group as stored in the summary table. Cluster numbers read as floats lose their '.0'."""
+
+    if group is None or (isinstance(group, float) and np.isnan(group)):
+        return 'None'
+    if isinstance(group, (float, np.floating)) and float(group).is_integer():
+        return str(int(group))
+    return str(group)
+
+
+def summarize_values(values):
+    """Box plot statistics of one group, whiskers following Tukey's 1.5 IQR rule like Plotly.
+
+    Arguments:
+        values (ndarray): Values of the cells in the group, without NaN.
+
+    Returns:
+        dict: n, mean, median, q1, q3, lowerfence, upperfence and outliers (JSON list, at most MAX_OUTLIERS values).
+    """
+
+    values = np.sort(values)
+    q1, median, q3 = np.percentile(values, [25, 50, 75])
+    iqr = q3 - q1
+    inside = (values >= q1 - 1.5 * iqr) & (values <= q3 + 1.5 * iqr)
+    outliers = values[~inside]
+    if len(outliers) > MAX_OUTLIERS:
+        outliers = outliers[np.linspace(0, len(outliers) - 1, MAX_OUTLIERS).round().astype(int)]
+
+    return {'n': len(values),
+            'mean': float(values.mean()),
+            'median': float(median),
+            'q1': float(q1),
+            'q3': float(q3),
+            'lowerfence': float(values[inside][0]),
+            'upperfence': float(values[inside][-1]),
+            'outliers': json.dumps([round(float(value), 6) for value in outliers])}
+
+
+def summarize_groups(values, groups):
+    """Box plot statistics of every group of cells.
+
+    Arguments:
+        values (Series): Value of each cell.
+        groups (Series): Group of each cell.
+
+    Returns:
+        DataFrame: One row per group with the SUMMARY_COLUMNS.
+    """
+
+    df = pd.DataFrame({'value': values.values, 'group': groups.map(group_label).values})
+    df.dropna(subset=['value'], inplace=True)
+    rows = []
+    for group, group_values in df.groupby('group', sort=False)['value']:
+        row = summarize_values(group_values.values)
+        row['group_name'] = group
+        rows.append(row)
+
+    return pd.DataFrame(rows, columns=SUMMARY_COLUMNS)
+
+
+def get_grouping_columns(ensemble, modality):
+    """Columns of an ensemble table which assign cells to clusters. ie. cluster_mCH_lv_npc50_k5, annotation_ATAC"""
+
+    engine = db.get_engine(current_app, EMBEDDING_BINDS[modality])
+    columns = read_frame("SELECT * FROM %(ensemble)s LIMIT 1" % {'ensemble': ensemble}, engine).columns
+    return [column for column in columns if column.startswith('cluster_') or column.startswith('annotation_')]
+
+
+def fetch_gene_measures(ensemble, modality, gene_table_name, grouping_columns, methylation_types):
+    """Fetch the value of a gene in every cell of an ensemble, for each measure plotted by the box plots.
+
+    Returns:
+        tuple: DataFrame of the grouping columns and dict of measure name to Series. None if the gene is missing.
+    """
+
+    groupings = ", ".join(ensemble + "." + column for column in grouping_columns)
+    if modality == 'methylation':
+        values = ", ".join("%(gene)s.%(mtype)s, %(gene)s.%(context)s, cells.global_%(mtype)s" % {
+            'gene': gene_table_name, 'mtype': mtype, 'context': mtype[1:]} for mtype in methylation_types)
+    else:
+        values = gene_table_name + ".normalized_counts"
+
+    query = "SELECT %(groupings)s, %(values)s \
+        FROM cells \
+        INNER JOIN %(ensemble)s ON cells.cell_id = %(ensemble)s.cell_id \
+        LEFT JOIN %(gene_table_name)s ON %(ensemble)s.cell_id = %(gene_table_name)s.cell_id" % {
+            'groupings': groupings, 'values': values, 'ensemble': ensemble, 'gene_table_name': gene_table_name}
+
+    try:
+        df = read_frame(query, db.get_engine(current_app, EMBEDDING_BINDS[modality]))
+    except exc.ProgrammingError as e:
+        now = datetime.datetime.now()
+        print("[{}] ERROR in app(fetch_gene_measures): {}".format(str(now), e))
+        sys.stdout.flush()
+        return None
+
+    # Same values as get_gene_methylation, get_gene_snATAC and get_gene_RNA
+    measures = {}
+    if modality == 'methylation':
+        for mtype in methylation_types:
+            original = df[mtype] / df[mtype[1:]]
+            measures[mtype + '_original'] = original
+            measures[mtype + '_normalized'] = original / df['global_' + mtype]
+    else:
+        measures['normalized_counts'] = df['normalized_counts'].fillna(0)
+
+    return df[grouping_columns], measures
+
+
+def compute_box_summaries(ensemble, modality='methylation', methylation_types=('mCH', 'mCG'), genes=None):
+    """Compute and store the box plot summaries of the genes of an ensemble. Needs an application context.
+
+    Existing summaries of the same genes are replaced.
+
+    Arguments:
+        ensemble (str): Ensemble identifier. (Eg. Ens0, Ens1, Ens2...).
+        modality (str): methylation, snATAC or RNA
+        methylation_types ([str]): Methylation types to summarise, ignored for the other modalities.
+        genes ([str]): Gene IDs to summarise. Defaults to every gene.
+
+    Returns:
+        int: Number of genes summarised.
+    """
+
+    # Prevent SQL injection since table and column names cannot be parameterized.
+    if ";" in ensemble or modality not in EMBEDDING_BINDS or any(";" in mtype for mtype in methylation_types):
+        return 0
+
+    engine = db.get_engine(current_app, EMBEDDING_BINDS[modality])
+    engine.execute(CREATE_SUMMARY_TABLE)
+
+    grouping_columns = get_grouping_columns(ensemble, modality)
+    if genes is None:
+        genes = [row.gene_id for row in engine.execute("SELECT gene_id FROM genes").fetchall()]
+
+    insert = "REPLACE INTO " + SUMMARY_TABLE + " (ensemble, gene_id, measure, grouping, " + \
+        ", ".join(SUMMARY_COLUMNS) + ") VALUES (" + ", ".join(["%s"] * (len(SUMMARY_COLUMNS) + 4)) + ")"
+
+    num_genes = 0
+    for gene_id in genes:
+        fetched = fetch_gene_measures(ensemble, modality, 'gene_' + gene_id.replace('.', '_'), grouping_columns,
+                                      methylation_types)
+        if fetched is None:
+            continue
+        groupings, measures = fetched
+
+        rows = []
+        for measure, values in measures.items():
+            for grouping in grouping_columns:
+                summary = summarize_groups(values, groupings[grouping])
+                rows.extend((ensemble, gene_id, measure, grouping) + tuple(row)
+                            for row in summary.astype(object).itertuples(index=False))
+        if not rows:
+            continue
+        engine.execute(insert, rows)
+        num_genes += 1
+
+        if num_genes % 1000 == 0:
+            now = datetime.datetime.now()
+            print("[{}] compute_box_summaries({}, {}): {} genes".format(str(now), ensemble, modality, num_genes))
+            sys.stdout.flush()
+
+    return num_genes
+
+
+@cache.memoize(timeout=3600)
+def get_box_summaries(ensemble, modality, gene, measure, grouping):
+    """Return the precomputed box plot statistics of a gene.
+
+    Arguments:
+        ensemble (str): Ensemble identifier. (Eg. Ens0, Ens1, Ens2...).
+        modality (str): methylation, snATAC or RNA
+        gene (str): Ensembl ID of gene, with or without version number.
+        measure (str): ie. mCH_original, mCG_normalized or normalized_counts
+        grouping (str): Grouping column. ie. cluster_mCH_lv_npc50_k5, annotation_RNA
+
+    Returns:
+        DataFrame: One row per group with the SUMMARY_COLUMNS, outliers decoded to lists.
+            None if the gene has not been summarised.
+    """
+
+    if modality not in EMBEDDING_BINDS:
+        return None
+
+    query = "SELECT " + ", ".join(SUMMARY_COLUMNS) + " FROM " + SUMMARY_TABLE + \
+        " WHERE ensemble = %s AND gene_id LIKE %s AND measure = %s AND grouping = %s"
+
+    try:
+        df = read_frame(query, db.get_engine(current_app, EMBEDDING_BINDS[modality]),
+                         params=(ensemble, gene + "%", measure, grouping))
+    except exc.ProgrammingError as e:
+        now = datetime.datetime.now()
+        print("[{}] ERROR in app(get_box_summaries): {}".format(str(now), e))
+        sys.stdout.flush()
+        return None
+
+    if df.empty:
+        return None
+
+    df['outliers'] = df['outliers'].map(json.loads)
+    return df
+
+
+def summary_box_traces(summaries, names, colors, outliers):
+    """Draw box plots from precomputed statistics.
+
+    plotly.js computes the quartiles of a box itself, so each box is given the
+    eight values [lowerfence, q1, q1, median, median, q3, q3, upperfence],
+    whose quartiles and whiskers are exactly the stored statistics. Outliers
+    are drawn as a separate scatter trace on the same category.
+
+    Arguments:
+        summaries (DataFrame): Rows of get_box_summaries, in plotting order.
+        names ([str]): Category name of each row.
+        colors ([str]): Color of each row.
+        outliers (bool): Whether to draw the outliers.
+
+    Returns:
+        list: Plotly traces as dicts.
+    """
+
+    data = []
+    for summary, name, color in zip(summaries.itertuples(index=False), names, colors):
+        data.append({
+            'type': 'box',
+            'y': [summary.lowerfence, summary.q1, summary.q1, summary.median,
+                  summary.median, summary.q3, summary.q3, summary.upperfence],
+            'name': name,
+            'boxpoints': False,
+            'fillcolor': color,
+            'line': {'color': 'rgba(10,10,10,.5)'},
+            'hoverinfo': 'name+y',
+            'showlegend': False,
+        })
+        if outliers and summary.outliers:
+            data.append({
+                'type': 'scatter',
+                'mode': 'markers',
+                'x': [name] * len(summary.outliers),
+                'y': summary.outliers,
+                'marker': {'color': color, 'size': 6},
+                'hoverinfo': 'y',
+                'showlegend': False,
+            })
+
+    return data
@@ -0,0 +1,210 @@
+"""Per-ensemble cell metadata shared by the plotting functions.
+
+The tSNE embedding of an ensemble never changes once it has been loaded into
+MySQL, so it is fetched once per (ensemble, tSNE type) and reused by every
+gene that is plotted on top of it. Embeddings are shared by the server
+processes (see shared), and fetched again after EMBEDDING_MAX_AGE seconds.
+Each process builds the frame of an embedding once per build of its arrays,
+and does not look for a missing embedding again for MISSING_EMBEDDING_TTL
+seconds.
+
+Frames of cells are cached for every gene and plot setting, so they are kept
+compact: metadata repeated across cells (dataset, annotation, ...) is stored
+as categoricals and coordinates and values as float32.
+"""
+import datetime
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from flask import current_app
+from sqlalchemy import exc
+
+from . import cache, db
+from .fetch import read_frame
+from .shared import load_shared_build
+from .timing import spanned
+
+
+# tSNE column suffix and MySQL bind for each modality. Methylation ensembles
+# have several embeddings (mCH_ndim2_perp20, ...), the other modalities one.
+EMBEDDING_BINDS = {'methylation': 'methylation_data',
+                   'snATAC': 'snATAC_data',
+                   'RNA': 'RNA_data'}
+
+# Metadata columns stored as categoricals, along with every annotation_* column.
+CATEGORICAL_COLUMNS = ['dataset', 'target_region', 'sex', 'grouping']
+
+EMBEDDING_MAX_AGE = 3600
+MISSING_EMBEDDING_TTL = 60
+
+# Embeddings loaded by this process, by shared array key. Flask-Cache pickles cached
+# values, which would copy the frame on every lookup.
+_embeddings = {}
+# Time each missing embedding was looked for, by shared array key.
+_missing = {}
+_lock = threading.Lock()
+
+
+def get_embedding(ensemble, tsne_type, modality='methylation'):
+    """Return the 2D tSNE coordinates of every cell in an ensemble.
+
+    The frame is shared by the callers of this process and must not be modified.
+
+    Arguments:
+        ensemble (str): Ensemble identifier. (Eg. Ens0, Ens1, Ens2...).
+        tsne_type (str): Suffix of the tSNE columns. ie. mCH_ndim2_perp20, ATAC, RNA
+        modality (str): methylation, snATAC or RNA
+
+    Returns:
+        DataFrame: Columns are cell_id, x, y. None if the embedding is not available.
+    """
+
+    embedding = load_embedding(ensemble, tsne_type, modality)
+    return None if embedding is None else embedding['frame']
+
+
+def load_embedding(ensemble, tsne_type, modality='methylation'):
+    """Load the embedding of an ensemble, see get_embedding.
+
+    Returns:
+        dict: build (directory of the shared arrays, changes when they are rebuilt), arrays (shared arrays cell_id,
+            x and y) and frame. None if the embedding is not available.
+    """
+
+    # Prevent SQL injection since table and column names cannot be parameterized.
+    if ";" in ensemble or ";" in tsne_type or modality not in EMBEDDING_BINDS:
+        return None
+
+    def fetch():
+        query = "SELECT cell_id, tsne_x_%(tsne_type)s AS x, tsne_y_%(tsne_type)s AS y \
+            FROM %(ensemble)s" % {'ensemble': ensemble, 'tsne_type': tsne_type}
+
+        try:
+            df = read_frame(query, db.get_engine(current_app, EMBEDDING_BINDS[modality]))
+        except exc.ProgrammingError as e:
+            now = datetime.datetime.now()
+            print("[{}] ERROR in app(get_embedding): {}".format(str(now), e))
+            sys.stdout.flush()
+            return None
+
+        df.dropna(subset=['x', 'y'], inplace=True)
+        if df.empty:
+            return None
+
+        return {'cell_id': df['cell_id'].values.astype(str),
+                'x': df['x'].values.astype(np.float64),
+                'y': df['y'].values.astype(np.float64)}
+
+    key = os.path.join('embeddings', modality, ensemble, tsne_type)
+    with _lock:
+        missing = _missing.get(key)
+    if missing is not None and time.time() - missing < MISSING_EMBEDDING_TTL:
+        return None
+
+    build = load_shared_build(key, fetch, max_age=EMBEDDING_MAX_AGE)
+    if build is None:
+        with _lock:
+            _missing[key] = time.time()
+        return None
+
+    with _lock:
+        embedding = _embeddings.get(key)
+    if embedding is None or embedding['build'] != build['directory']:
+        arrays = build['arrays']
+        frame = pd.DataFrame({'cell_id': arrays['cell_id'].astype(object), 'x': arrays['x'], 'y': arrays['y']},
+                             columns=['cell_id', 'x', 'y'])
+        embedding = {'build': build['directory'], 'arrays': arrays, 'frame': frame}
+        with _lock:
+            _embeddings[key] = embedding
+            _missing.pop(key, None)
+    return embedding
+
+
+@cache.memoize(timeout=3600)
+def get_embedding_bounds(ensemble, tsne_type, modality='methylation'):
+    """Return the bounds of a 2D tSNE embedding, used for the axis ranges of scatter plots.
+
+    Arguments:
+        ensemble (str): Ensemble identifier. (Eg. Ens0, Ens1, Ens2...).
+        tsne_type (str): Suffix of the tSNE columns. ie. mCH_ndim2_perp20, ATAC, RNA
+        modality (str): methylation, snATAC or RNA
+
+    Returns:
+        dict: 'full' bounds of every cell and 'trimmed' bounds ignoring the outer 0.1% of cells on each side,
+            both as [xmin, xmax, ymin, ymax]. None if the embedding is not available.
+    """
+
+    embedding = get_embedding(ensemble, tsne_type, modality)
+    if embedding is None:
+        return None
+
+    x, y = embedding['x'], embedding['y']
+    return {'full': [float(x.min()), float(x.max()), float(y.min()), float(y.max())],
+            'trimmed': [float(x.quantile(0.001)), float(x.quantile(0.999)),
+                        float(y.quantile(0.001)), float(y.quantile(0.999))]}
+
+
+@spanned('transform')
+def compact_cells(df):
+    """Store the repeated metadata of a frame of cells as categoricals and its floats as float32.
+
+    Arguments:
+        df (DataFrame): One row per cell.
+
+    Returns:
+        DataFrame: The same frame, converted in place.
+    """
+
+    for column in df.columns:
+        if df[column].dtype == np.float64:
+            df[column] = df[column].astype(np.float32)
+        elif column in CATEGORICAL_COLUMNS or column.startswith('annotation_'):
+            if not hasattr(df[column], 'cat') and not pd.api.types.is_numeric_dtype(df[column]):
+                df[column] = df[column].astype('category')
+    return df
+
+
+def fill_missing_groups(values, label):
+    """Label the cells without a group, in plain and categorical columns alike.
+
+    Arguments:
+        values (Series): Group of each cell.
+        label (str): Label of missing groups. ie. 'None', 'N/A'
+
+    Returns:
+        Series
+    """
+
+    if hasattr(values, 'cat') and label not in values.cat.categories and values.isnull().any():
+        values = values.cat.add_categories([label])
+    return values.fillna(label)
+
+
+@spanned('transform')
+def sort_cells_by_annotation(df, column, order):
+    """Sort cells by annotation, in the given order of annotations followed by unknown annotations.
+
+    Cells without annotation are labelled 'None'. The rank of each category is looked up once and the cells are
+    sorted by the ranks of their category codes.
+
+    Arguments:
+        df (DataFrame): One row per cell.
+        column (str): Annotation column. ie. annotation_mCH_lv_npc50_k5, annotation_ATAC
+        order ([str]): Annotations in plotting order.
+
+    Returns:
+        DataFrame: Sorted cells.
+    """
+
+    annotations = fill_missing_groups(df[column], 'None')
+    if not hasattr(annotations, 'cat'):
+        annotations = annotations.astype('category')
+    df[column] = annotations
+
+    positions = {annotation: i for i, annotation in enumerate(order)}
+    ranks = np.array([positions.get(category, len(order)) for category in annotations.cat.categories] + [len(order)])
+    return df.iloc[np.argsort(ranks[annotations.cat.codes.values], kind='mergesort')]
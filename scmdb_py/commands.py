@@ -0,0 +1,145 @@
+"""Offline jobs, run from the command line with `flask --app=scmdb_py <command>`."""
+import json
+import os
+import subprocess
+import sys
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from flask_rq import get_worker
+
+from . import basedir
+from .aggregates import build_aggregates
+from .asset_build import build_bundles, manifest_path, render_php_templates
+from .box_stats import compute_box_summaries
+from .cells import EMBEDDING_BINDS
+from .jobs import PLOT_JOB_QUEUE
+from .marker_genes import compute_marker_genes
+
+
+@click.command('box-summaries')
+@click.argument('ensemble')
+@click.option('--modality', type=click.Choice(sorted(EMBEDDING_BINDS)), default='methylation',
+              help='Database of the ensemble.')
+@click.option('--methylation-type', 'methylation_types', multiple=True, default=['mCH', 'mCG'],
+              help='Methylation types to summarise. Can be given several times.')
+@click.option('--gene', 'genes', multiple=True, help='Only summarise these gene IDs. Can be given several times.')
+@with_appcontext
+def box_summaries_command(ensemble, modality, methylation_types, genes):
+    """Precompute the box plot statistics of the genes of ENSEMBLE. Run again after reclustering an ensemble."""
+
+    num_genes = compute_box_summaries(ensemble, modality, methylation_types, list(genes) or None)
+    click.echo('Summarised {} genes of {} ({}).'.format(num_genes, ensemble, modality))
+
+
+@click.command('aggregates')
+@click.argument('ensemble')
+@click.option('--modality', type=click.Choice(sorted(EMBEDDING_BINDS)), default='methylation',
+              help='Database of the ensemble.')
+@click.option('--methylation-type', 'methylation_types', multiple=True, default=['mCH', 'mCG'],
+              help='Methylation types to aggregate. Can be given several times.')
+@click.option('--processes', type=int, default=None, help='Number of worker processes. Defaults to the number of CPUs.')
+@with_appcontext
+def aggregates_command(ensemble, modality, methylation_types, processes):
+    """Precompute the cluster x gene matrices of ENSEMBLE used by the heatmaps. Run again after reclustering."""
+
+    num_genes = build_aggregates(ensemble, modality, methylation_types, processes)
+    click.echo('Aggregated {} genes of {} ({}).'.format(num_genes, ensemble, modality))
+
+
+@click.command('marker-genes')
+@click.argument('ensemble')
+@click.option('--methylation-type', default='mCH', help='Methylation type the genes are scored with.')
+@click.option('--clustering', 'clusterings', multiple=True,
+              help='Only compute this clustering, ie. mCH_lv_npc50_k5. Can be given several times.')
+@click.option('--force', is_flag=True, help='Recompute clusterings which already have marker genes.')
+@click.option('--processes', type=int, default=None, help='Number of worker processes. Defaults to the number of CPUs.')
+@with_appcontext
+def marker_genes_command(ensemble, methylation_type, clusterings, force, processes):
+    """Compute the marker genes of the clusterings of ENSEMBLE. Interrupted runs resume where they stopped."""
+
+    written = compute_marker_genes(ensemble, methylation_type, list(clusterings) or None, force, processes)
+    click.echo('Wrote the marker genes of {} clusterings of {}.'.format(len(written), ensemble))
+
+
+@click.command('plot-worker')
+@with_appcontext
+def plot_worker_command():
+    """Render the heavy plots submitted by the web server (see jobs.py). Needs Redis."""
+
+    get_worker(current_app.config.get('PLOT_JOB_QUEUE', PLOT_JOB_QUEUE)).work()
+
+
+@click.command('build-assets')
+@click.option('--skip-templates', is_flag=True, help='Do not render the PHP templates, ie. where PHP is not installed.')
+@with_appcontext
+def build_assets_command(skip_templates):
+    """Build, minify, version and gzip the asset bundles, and render the PHP templates. Run after changing scripts
+    or styles, before starting servers with ASSETS_PRECOMPILED."""
+
+    if not skip_templates:
+        for path in render_php_templates():
+            click.echo('Rendered {}'.format(path))
+    for path in build_bundles(current_app.jinja_env.assets_environment, current_app):
+        click.echo('Built {}'.format(path))
+    click.echo('Wrote {}'.format(manifest_path(current_app)))
+
+
+# Run by startup-report in a new interpreter: times the import of the package, create_app and the first import of
+# the modules deferred with lazy_import, and prints them as JSON.
+STARTUP_SCRIPT = """
+import importlib, importlib.util, json, sys, time
+spec = importlib.util.spec_from_file_location('_startup_lazy', sys.argv[1])
+lazy = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(lazy)
+timer = lazy.ImportTimer()
+timer.install()
+phases = []
+start = time.perf_counter()
+import scmdb_py
+phases.append(['import scmdb_py', time.perf_counter() - start])
+start = time.perf_counter()
+scmdb_py.create_app()
+phases.append(['create_app()', time.perf_counter() - start])
+from scmdb_py.lazy import DEFERRED
+start = time.perf_counter()
+for name in DEFERRED:
+    importlib.import_module(name)
+phases.append(['first plot imports (' + ', '.join(DEFERRED) + ')', time.perf_counter() - start])
+timer.uninstall()
+print(json.dumps({'phases': phases, 'modules': timer.report(int(sys.argv[2]))}))
+"""
+
+
+@click.command('startup-report')
+@click.option('--top', type=int, default=20, help='Number of modules listed.')
+@click.option('--max-seconds', type=float, default=None,
+              help='Fail when importing the application and creating it takes longer, to catch regressions.')
+def startup_report_command(top, max_seconds):
+    """Time a cold start of the application in a new interpreter, and list the slowest imports."""
+
+    output = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT, os.path.join(basedir, 'lazy.py'), str(top)],
+                                     cwd=os.path.dirname(basedir))
+    report = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+    for phase, seconds in report['phases']:
+        click.echo('{:8.1f} ms  {}'.format(seconds * 1000, phase))
+    click.echo('')
+    for line in report['modules']:
+        click.echo(line)
+
+    startup = sum(seconds for phase, seconds in report['phases'][:2])
+    if max_seconds is not None and startup > max_seconds:
+        raise click.ClickException('Startup took {:.2f}s, more than {:.2f}s.'.format(startup, max_seconds))
+
+
+def register_commands(app):
+    """Add the offline jobs to the flask command line of the application."""
+
+    app.cli.add_command(box_summaries_command)
+    app.cli.add_command(aggregates_command)
+    app.cli.add_command(marker_genes_command)
+    app.cli.add_command(plot_worker_command)
+    app.cli.add_command(startup_report_command)
+    app.cli.add_command(build_assets_command)
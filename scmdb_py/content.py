@@ -10,25 +10,34 @@ from itertools import groupby, chain
 from random import sample
 
 import colorsys
-import colorlover as cl
 from flask import Blueprint, current_app, request
 from sqlalchemy import exc, text
 import numpy as np
 from numpy import nan, linspace, arange, random
 import pandas as pd
-import plotly
-from plotly import tools
-from plotly.graph_objs import Layout, Annotation, Box, Scatter, Scatter3d, Heatmap, Bar # NOTE: Scattergl has some bugs
 import sqlite3
 from sqlite3 import Error
-import plotly.figure_factory as ff
-from scipy.spatial.distance import pdist, squareform
-from scipy.cluster import hierarchy
-from multiprocessing import Pool
 
 from . import cache, db
+from .aggregates import get_aggregate_frame
+from .box_stats import get_box_summaries, summary_box_traces
+from .cells import compact_cells, fill_missing_groups, get_embedding_bounds, sort_cells_by_annotation
+from .correlations import get_correlated_genes
+from .quantiles import quantile_sketch, sketch_range
+from .dendrogram import cluster_leaves, dendrogram_trace, leaf_positions
+from .executor import gather
+from .fetch import read_frame
+from .lazy import lazy_import
+from .render import render_scatter
+from .scatter import counts_scatter_modality, generate_cluster_colors, methylation_scatter_modality, num_sigfigs_ticklabels
+from .timing import spanned, timed
 from os import path
 
+# Imported when the first plot is drawn, see lazy.
+# NOTE: Scattergl has some bugs, see scatter.build_scatter
+plotly = lazy_import('plotly')
+go = lazy_import('plotly.graph_objs')
+
 content = Blueprint('content', __name__) # Flask "bootstrap"
 
 cluster_annotation_order = ['mL2/3', 'mL4', 'mL5-1', 'mL5-2', 'mDL-1', 'mDL-2', \
@@ -36,13 +45,30 @@ cluster_annotation_order = ['mL2/3', 'mL4', 'mL5-1', 'mL5-2', 'mDL-1', 'mDL-2',
 							'mNdnf-2', 'mPv', 'mSst-1', 'mSst-2', 'None']
 methylation_types_order = ['mCH', 'mCG', 'mCA', 'mCHmCG', 'mCHmCA', 'mCAmCG']
 
-num_sigfigs_ticklabels = 2;
-log_file='/var/www/scmdb_py_dev/scmdb_log'
-
 class FailToGraphException(Exception):
 	"""Fail to generate data or graph due to an internal error."""
 	pass
 
+def fetch_all(query, bind):
+	"""Rows of a query on one of the databases. Used to run queries on several databases with executor.gather."""
+
+	return db.get_engine(current_app, bind).execute(query).fetchall()
+
+def dataset_cell_counts(ensemble_tbl, bind):
+	"""Number of cells of an ensemble in each dataset, by dataset name without the CEMBA_ prefix.
+
+	Returns:
+		dict: None if the ensemble is not in the database.
+	"""
+
+	query = "SELECT dataset, COUNT(*) as `num` FROM cells INNER JOIN {} ON cells.cell_id = {}.cell_id GROUP BY dataset".format(ensemble_tbl, ensemble_tbl)
+	try:
+		cell_counts = fetch_all(query, bind)
+	except exc.SQLAlchemyError:
+		return None
+	cell_counts = [ {d['dataset']: d['num']} for d in cell_counts]
+	return { k.split('_',maxsplit=1)[1]: v for d in cell_counts for k, v in d.items() }
+
 # @content.route('/content/metadata/')
 # def get_metadata():
 # 	result = db.get_engine(current_app, 'methylation_data').execute("SELECT * FROM cells LIMIT 1;").fetchall()
@@ -59,37 +85,26 @@ def get_ensembles_summary():
 	regions_lower = [ region.lower() for region in regions ]
 	
 	ensemble_list=[]
-	# ensemble_list = db.get_engine(current_app, 'methylation_data').execute("SELECT * FROM ensembles").fetchall()
-	ensemble_list = db.get_engine(current_app, 'methylation_data').execute("SELECT * FROM ensembles").fetchall()
-	ensemble_list_atac = db.get_engine(current_app, 'snATAC_data').execute("SELECT * FROM ensembles").fetchall()
+	ensemble_list, ensemble_list_atac, total_methylation_cell_each_dataset = gather(
+		(fetch_all, "SELECT * FROM ensembles", 'methylation_data'),
+		(fetch_all, "SELECT * FROM ensembles", 'snATAC_data'),
+		(fetch_all, "SELECT dataset, COUNT(*) as `num` FROM cells GROUP BY dataset", 'methylation_data'))
 	# ensemble_list = ensemble_list.join(ensemble_list_atac, on="ensemble_id", how="outer")
 	ensemble_list_ids = [ensemble['ensemble_id'] for ensemble in ensemble_list]
 	for ensemble_atac in ensemble_list_atac:
 		if (ensemble_atac['ensemble_id'] not in ensemble_list_ids):
 			ensemble_list.append(ensemble_atac)
 
-	total_methylation_cell_each_dataset = db.get_engine(current_app, 'methylation_data').execute("SELECT dataset, COUNT(*) as `num` FROM cells GROUP BY dataset").fetchall()
 	total_methylation_cell_each_dataset = [ {d['dataset']: d['num']} for d in total_methylation_cell_each_dataset ]
 	total_methylation_cell_each_dataset = { k.split('_',maxsplit=1)[1]: v for d in total_methylation_cell_each_dataset for k, v in d.items() }
 
-	ensembles_cell_counts = []
-	for ensemble in ensemble_list:
-		ensemble_tbl = 'Ens' + str(ensemble['ensemble_id'])
-		query_methylation = "SELECT dataset, COUNT(*) as `num` FROM cells INNER JOIN {} ON cells.cell_id = {}.cell_id GROUP BY dataset".format(ensemble_tbl, ensemble_tbl)
-		try:
-			methylation_cell_counts = db.get_engine(current_app, 'methylation_data').execute(query_methylation).fetchall()
-			methylation_cell_counts = [ {d['dataset']: d['num']} for d in methylation_cell_counts]
-			methylation_cell_counts = { k.split('_',maxsplit=1)[1]: v for d in methylation_cell_counts for k, v in d.items() }
-		except:
-			methylation_cell_counts = None
+	# The cell counts of every ensemble in both databases are independent queries.
+	cell_counts = gather(*[ (dataset_cell_counts, 'Ens' + str(ensemble['ensemble_id']), bind)
+							for ensemble in ensemble_list for bind in ['methylation_data', 'snATAC_data'] ])
 
-		query_snATAC = "SELECT dataset, COUNT(*) as `num` FROM cells INNER JOIN {} ON cells.cell_id = {}.cell_id GROUP BY dataset".format(ensemble_tbl, ensemble_tbl)
-		try:
-			snATAC_cell_counts = db.get_engine(current_app, 'snATAC_data').execute(query_snATAC).fetchall()
-			snATAC_cell_counts = [ {d['dataset']: d['num']} for d in snATAC_cell_counts]
-			snATAC_cell_counts = { k.split('_',maxsplit=1)[1]: v for d in snATAC_cell_counts for k, v in d.items() }
-		except exc.ProgrammingError as e:
-			snATAC_cell_counts = None
+	ensembles_cell_counts = []
+	for i, ensemble in enumerate(ensemble_list):
+		methylation_cell_counts, snATAC_cell_counts = cell_counts[2*i], cell_counts[2*i+1]
 
 		annoj_exists = ensemble_annoj_exists(ensemble['ensemble_id'])
 		ensembles_cell_counts.append( {"id": ensemble['ensemble_id'], 
@@ -434,31 +449,6 @@ def build_hover_text(labels):
 	return text.strip('<br>')
 
 
-def generate_cluster_colors(num, grouping):
-	"""Generate a list of colors given number needed.
-
-	Arguments:
-		num (int): Number of colors needed. n <= 35.
-
-	Returns:
-		list: strings containing RGB-style strings e.g. rgb(255,255,255).
-	"""
-
-	if (grouping == 'dataset' or grouping == 'target_region') and num > 2 and num <= 9:
-		c = cl.scales[str(num)]['qual']['Set1'] 
-		return c
-
-	if num>18:
-		# c = ['hsl('+str(round(h*1.8 % 360))+',50%,50%)' for h in linspace(0, 360, num)]
-		c = ['rgb'+str(colorsys.hls_to_rgb((h*1.8/360), 0.5, 0.5)) for h in linspace(0, 360, num)]
-	else:
-		# c = ['hsl('+str(round(h*1.3 % 360))+',50%,50%)' for h in linspace(0, 360, num)]
-		c = ['rgb'+str(colorsys.hls_to_rgb((h*1.3 / 360), 0.5, 0.5)) for h in linspace(0, 360, num)]
-
-	c=c+c
-	return c
-
-
 def set_color_by_percentile(this, start, end):
 	"""Set color below or above percentiles to their given values.
 
@@ -481,6 +471,7 @@ def set_color_by_percentile(this, start, end):
 		return end
 	return this
 
+
 @cache.cached(timeout=3600)
 def all_gene_modules():
 	"""Generate list of gene modules for populating gene modules selector.
@@ -509,6 +500,26 @@ def get_genes_of_module(module):
 
 	return genes_in_module
 
+@cache.memoize(timeout=1800)
+def get_module_genes_query(module):
+	"""Gene IDs of a module, in the form of the genes_query of the scatter plots.
+
+	Arguments:
+		module (str): Name of module.
+	Returns:
+		str: Space separated gene IDs. None if the module has no genes.
+	"""
+
+	gene_ids = [ gene['gene_id'] for gene in get_genes_of_module(module) ]
+	if not gene_ids:
+		return None
+	return " ".join(gene_ids)
+
+def module_title(description, module, genes):
+	"""Title of a scatter plot of the average of a gene module."""
+
+	return 'Avg. ' + description + ': <br>' + module + ' module (' + str(len(genes)) + ' genes)'
+
 @cache.memoize(timeout=3600)
 def get_cluster_marker_genes(ensemble, clustering):
 	"""Retrieves list of top marker genes for each cluster in a clustering of an ensemble.
@@ -525,7 +536,8 @@ def get_cluster_marker_genes(ensemble, clustering):
 	query = "SELECT clustering, cluster, rank, genes.gene_id, genes.gene_name \
 		FROM {0}_cluster_marker_genes \
 		INNER JOIN genes ON {0}_cluster_marker_genes.gene_id = genes.gene_id \
-		WHERE clustering = %s".format(ensemble)
+		WHERE clustering = %s \
+		ORDER BY cluster, rank".format(ensemble)
 
 	try:
 		result = db.get_engine(current_app, 'methylation_data').execute(query, (clustering,)).fetchall()
@@ -535,17 +547,14 @@ def get_cluster_marker_genes(ensemble, clustering):
 		sys.stdout.flush()
 		return []
 
-	result = [ dict(x) for x in result ]
-	num_genes = result[-1]['rank']
-	num_clusters = result[-1]['cluster']
-	columns = [ 'cluster_'+str(i+1) for i in range(num_clusters) ] 
+	if not result:
+		return []
 
-	rows = []
-	for i in range(num_genes):
-		row = {}
-		row = dict(zip(columns, [ gene['gene_name'] for gene in result[i:: num_genes] ] ))
-		row['rank'] = i+1
-		rows.append(row)
+	# Clusters may have fewer marker genes than others, so rows are filled by rank rather than by position.
+	columns = [ 'cluster_'+str(cluster) for cluster in sorted({ gene['cluster'] for gene in result }) ]
+	rows = [ {'rank': i+1} for i in range(max(gene['rank'] for gene in result)) ]
+	for gene in result:
+		rows[gene['rank']-1]['cluster_'+str(gene['cluster'])] = gene['gene_name']
 
 
 	to_json = {'columns': columns}
@@ -567,16 +576,16 @@ def median_cluster_mch(gene_info, grouping, clustering):
 
 	if gene_info is not None:
 		if grouping == 'annotation':
-			gene_info.fillna({'annotation_'+clustering: 'None'}, inplace=True)
+			gene_info['annotation_'+clustering] = fill_missing_groups(gene_info['annotation_'+clustering], 'None')
 			return gene_info.groupby('annotation_'+clustering, sort=False)[gene_info.columns[-1]].median()
 		elif grouping == 'cluster':
 			gene_info.fillna({'cluster_'+clustering: 'None'}, inplace=True)
 			return gene_info.groupby('cluster_'+clustering, sort=False)[gene_info.columns[-1]].median()
 		elif grouping == 'dataset':
-			gene_info.fillna({'dataset': 'None'}, inplace=True)
+			gene_info['dataset'] = fill_missing_groups(gene_info['dataset'], 'None')
 			return gene_info.groupby('dataset', sort=False)[gene_info.columns[-1]].median()
 		elif grouping == 'target_region':
-			gene_info['target_region'].fillna('N/A', inplace=True)
+			gene_info['target_region'] = fill_missing_groups(gene_info['target_region'], 'N/A')
 			return gene_info.groupby('target_region', sort=False)[gene_info.columns[-1]].median()
 		elif grouping == 'slice':
 			datasets_all_cells = gene_info['dataset'].tolist()
@@ -610,14 +619,14 @@ def mean_cluster(gene_info, grouping, modality='ATAC'):
 	# 	return gene_info.groupby(grouping, sort=False)['normalized_counts'].mean()
 
 	if grouping == 'annotation':
-		gene_info.fillna({'annotation_'+modality: 'None'}, inplace=True)
+		gene_info['annotation_'+modality] = fill_missing_groups(gene_info['annotation_'+modality], 'None')
 		return gene_info.groupby('annotation_'+modality, sort=False)['normalized_counts'].mean()
 	elif grouping == 'cluster':
 		return gene_info.groupby('cluster_'+modality, sort=False)['normalized_counts'].mean()
 	elif grouping == 'dataset':
 		return gene_info.groupby('dataset', sort=False)['normalized_counts'].mean()
 	elif grouping == 'target_region':
-		gene_info['target_region'].fillna('N/A', inplace=True)
+		gene_info['target_region'] = fill_missing_groups(gene_info['target_region'], 'N/A')
 		return gene_info.groupby('target_region', sort=False)['normalized_counts'].mean()
 	else:
 		return None
@@ -654,7 +663,7 @@ def get_metadata_options(ensemble):
 	query = "SELECT * FROM %(ensemble)s LIMIT 1" % {'ensemble': ensemble,}
 	
 	try:
-		df = pd.read_sql(query, db.get_engine(current_app, 'methylation_data'))
+		df = read_frame(query, db.get_engine(current_app, 'methylation_data'))
 	except exc.ProgrammingError as e:
 		now = datetime.datetime.now()
 		print("[{}] ERROR in app(get_metadata_options): {}".format(str(now), e))
@@ -691,23 +700,8 @@ def get_metadata_options(ensemble):
 	#list_npc_clustering = sorted(list(set([int(x.split('_')[2].replace('npc', '')) for x in list_clustering_types if (list_mc_types_clustering[0]+'_'+list_algorithms_clustering[0]) in x])))
 	#list_k_clustering = sorted(list(set([int(x.split('_')[3].replace('k', '')) for x in list_clustering_types if (list_mc_types_clustering[0]+'_'+list_algorithms_clustering[0]+'_npc'+str(list_npc_clustering[0])) in x])))
 
-	all_metadata = dict()
-	for modality in ['methylation','snATAC','RNA']:
-		all_metadata[modality] = ['cluster','annotation']
-		if ensemble_exists(ensemble, modality=modality):
-			all_metadata[modality] += ['dataset','sex','brain_region','broad_brain_region']
-			query = "SELECT count(*) AS count FROM ensembles \
-			RIGHT JOIN datasets ON ensembles.datasets LIKE %(x)s \
-			WHERE datasets.target_region!='NULL' \
-			AND ensembles.ensemble_id={0}".format(ensemble.strip('Ens'))
-			df_metadata = pd.read_sql(query, con=db.get_engine(current_app, modality+'_data'), params={'x': "CONCAT('%',datasets.dataset,'%')"})
-			if (not df_metadata['count'].isnull().all()) and max(df_metadata['count'])>0:
-				all_metadata[modality] += ['target_region']
-
-			query = "SELECT * FROM cells LIMIT 1;"
-			df_metadata = pd.read_sql(query, con=db.get_engine(current_app, modality+'_data'))
-			df_metadata = df_metadata.drop(list(df_metadata.filter(regex='cell_.*', axis='columns')), axis=1)
-			all_metadata[modality] += list([i for i in df_metadata.columns.values])
+	all_metadata = dict(zip(['methylation','snATAC','RNA'],
+		gather(*[ (get_metadata_fields, ensemble, modality) for modality in ['methylation','snATAC','RNA'] ])))
 
 	return {'all_tsne_settings': list_tsne_types, 
 			'tsne_methylation': list_mc_types_tsne,
@@ -720,6 +714,35 @@ def get_metadata_options(ensemble):
 			'snATAC_metadata_fields': all_metadata['snATAC'],
 			'RNA_metadata_fields': all_metadata['RNA'],}
 
+def get_metadata_fields(ensemble, modality):
+	"""Fields cells of an ensemble can be grouped by in one modality.
+
+	Arguments:
+		ensemble (str): Name of ensemble.
+		modality (str): methylation, snATAC or RNA
+
+	Returns:
+		list: Field names.
+	"""
+
+	fields = ['cluster','annotation']
+	if ensemble_exists(ensemble, modality=modality):
+		fields += ['dataset','sex','brain_region','broad_brain_region']
+		query = "SELECT count(*) AS count FROM ensembles \
+		RIGHT JOIN datasets ON ensembles.datasets LIKE %(x)s \
+		WHERE datasets.target_region!='NULL' \
+		AND ensembles.ensemble_id={0}".format(ensemble.strip('Ens'))
+		df_metadata = read_frame(query, con=db.get_engine(current_app, modality+'_data'), params={'x': "CONCAT('%',datasets.dataset,'%')"})
+		if (not df_metadata['count'].isnull().all()) and max(df_metadata['count'])>0:
+			fields += ['target_region']
+
+		query = "SELECT * FROM cells LIMIT 1;"
+		df_metadata = read_frame(query, con=db.get_engine(current_app, modality+'_data'))
+		df_metadata = df_metadata.drop(list(df_metadata.filter(regex='cell_.*', axis='columns')), axis=1)
+		fields += list([i for i in df_metadata.columns.values])
+
+	return fields
+
 @cache.memoize(timeout=3600)
 def get_snATAC_tsne_options(ensemble):
 	"""
@@ -732,7 +755,7 @@ def get_snATAC_tsne_options(ensemble):
 	query = "SELECT * FROM %(ensemble)s LIMIT 1" % {'ensemble': ensemble,}
 	
 	try:
-		df = pd.read_sql(query, db.get_engine(current_app, 'snATAC_data'))
+		df = read_frame(query, db.get_engine(current_app, 'snATAC_data'))
 	except exc.ProgrammingError as e:
 		now = datetime.datetime.now()
 		print("[{}] ERROR in app(get_snATAC_tsne_options): {}".format(str(now), e))
@@ -791,7 +814,7 @@ def get_gene_by_name(gene_query):
 	sql_query = "SELECT * FROM genes WHERE " + "lower(gene_name) LIKE %s OR " * len(gene_query)
 	sql_query = sql_query[:-3]
 
-	df = pd.read_sql(sql_query, params=(gene_query,), con=db.get_engine(current_app, 'methylation_data'))
+	df = read_frame(sql_query, params=(gene_query,), con=db.get_engine(current_app, 'methylation_data'))
 
 	return df.to_dict('records')
 
@@ -816,7 +839,7 @@ def get_gene_by_name_exact(gene_query):
 		sql_query += "WHEN '{}' THEN {} ".format(gene, i+1)
 	sql_query += "END"
 
-	df = pd.read_sql(sql_query, params=(gene_query,), con=db.get_engine(current_app, 'methylation_data'))
+	df = read_frame(sql_query, params=(gene_query,), con=db.get_engine(current_app, 'methylation_data'))
 
 	return df.to_dict('records')
 	
@@ -835,7 +858,7 @@ def get_gene_by_id(gene_query):
 	sql_query = "SELECT * FROM genes WHERE " + "gene_id LIKE %s OR " * len(gene_query_wildcard)
 	sql_query = sql_query[:-3]
 
-	df = pd.read_sql(sql_query, params=(gene_query_wildcard,), con=db.get_engine(current_app, 'methylation_data'))
+	df = read_frame(sql_query, params=(gene_query_wildcard,), con=db.get_engine(current_app, 'methylation_data'))
 
 	#reorder genes to original order since SQL doesn't keep order.
 	new_index = []
@@ -850,28 +873,46 @@ def get_gene_by_id(gene_query):
 	return df.to_dict('records')
 
 @cache.memoize(timeout=3600)
-def get_corr_genes(ensemble, query):
+def get_corr_genes(ensemble, query, measure=None, grouping_column=None, method='pearson'):
 	"""Get correlated genes of a certain gene of a ensemble. 
 	
+		Correlations are computed from the aggregate matrices of the ensemble (see correlations). Ensembles without
+		aggregate matrices fall back to their precomputed <ensemble>_correlated_genes table.
+
 		Arguments:
 			ensemble(str): Ensemble identifier. (Eg. Ens0, Ens1, Ens2...).
 			query(str): Gene ID.
+			measure(str): Aggregated measure to correlate. ie. mCH_original. Optional.
+			grouping_column(str): Groups to correlate across. ie. cluster_mCH_lv_npc50_k5. Optional.
+			method(str): "pearson" or "spearman".
 		
 		Returns:
 			dict: information of genes that are correlated with target gene.
 	"""
-	if ";" in query:
+	if ";" in query or ";" in ensemble:
 		return []
 
-	try:
-		corr_genes = db.get_engine(current_app, 'methylation_data').execute("SELECT * FROM {}_correlated_genes WHERE gene1 LIKE %s".format(ensemble), (query+'%%',)).fetchall()
-	except exc.ProgrammingError as e:
-		now = datetime.datetime.now()
-		print("[{}] ERROR in app(get_corr_genes): {}".format(str(now), e))
-		sys.stdout.flush()
+	corr_genes = get_correlated_genes(ensemble, query, measure, grouping_column, method)
+	if corr_genes is None:
+		try:
+			rows = db.get_engine(current_app, 'methylation_data').execute("SELECT * FROM {}_correlated_genes WHERE gene1 LIKE %s".format(ensemble), (query+'%%',)).fetchall()
+		except exc.ProgrammingError as e:
+			now = datetime.datetime.now()
+			print("[{}] ERROR in app(get_corr_genes): {}".format(str(now), e))
+			sys.stdout.flush()
+			return []
+		corr_genes = [(row.gene2, row.correlation) for row in rows]
+
+	if not corr_genes:
 		return []
 
-	corr_genes = [ {"rank": i+1, "gene_name": get_gene_by_id(row.gene2)[0]['gene_name'], "correlation": row.correlation, "gene_id": row.gene2} for i, row in enumerate(corr_genes)]
+	# One query for the names of all the genes rather than one per gene.
+	gene_names = {}
+	for gene in get_gene_by_id([gene_id for gene_id, correlation in corr_genes]):
+		gene_names[gene['gene_id']] = gene['gene_name']
+		gene_names.setdefault(gene['gene_id'].split('.')[0], gene['gene_name'])
+
+	corr_genes = [ {"rank": i+1, "gene_name": gene_names.get(gene_id, gene_names.get(gene_id.split('.')[0], gene_id)), "correlation": correlation, "gene_id": gene_id} for i, (gene_id, correlation) in enumerate(corr_genes)]
 	return corr_genes
 
 @cache.memoize(timeout=3600)
@@ -939,11 +980,12 @@ def get_gene_methylation(ensemble, methylation_type, gene, grouping, clustering,
 			%(ensemble)s.annotation_%(clustering)s, %(ensemble)s.cluster_%(clustering)s, \
 			%(ensemble)s.tsne_x_%(tsne_type)s, %(ensemble)s.tsne_y_%(tsne_type)s, %(ensemble)s.tsne_z_%(tsne_type)s, \
 			%(gene_table_name)s.%(methylation_type)s, %(gene_table_name)s.%(context)s, \
-			datasets.target_region, datasets.sex \
+			datasets.target_region, datasets.sex, %(groupingu)s as grouping \
 			FROM cells \
 			INNER JOIN %(ensemble)s ON cells.cell_id = %(ensemble)s.cell_id \
 			LEFT JOIN %(gene_table_name)s ON %(ensemble)s.cell_id = %(gene_table_name)s.cell_id \
-			LEFT JOIN datasets ON cells.dataset = datasets.dataset " % {'ensemble': ensemble, 
+			LEFT JOIN datasets ON cells.dataset = datasets.dataset \
+			LEFT JOIN ABA_regions ON datasets.brain_region=ABA_regions.ABA_acronym " % {'ensemble': ensemble, 'groupingu': groupingu,
 																	   'gene_table_name': gene_table_name,
 																	   'tsne_type': tsne_type,
 																	   'methylation_type': methylation_type,
@@ -954,7 +996,7 @@ def get_gene_methylation(ensemble, methylation_type, gene, grouping, clustering,
 		# TODO: Check whether we need to randomize the rows 
 
 	try:
-		df = pd.read_sql(query, db.get_engine(current_app, 'methylation_data'))
+		df = read_frame(query, db.get_engine(current_app, 'methylation_data'))
 	except exc.ProgrammingError as e:
 		now = datetime.datetime.now()
 		print("[{}] ERROR in app(get_gene_methylation): {}".format(str(now), e))
@@ -975,11 +1017,9 @@ def get_gene_methylation(ensemble, methylation_type, gene, grouping, clustering,
 		df = df[df[methylation_type + '/' + context + '_' + level] < three_std_dev] 
 
 	
+	df = compact_cells(df)
 	if grouping == 'annotation':
-		df.fillna({'grouping': 'None'}, inplace=True)
-		df['annotation_cat'] = pd.Categorical(df['grouping'], cluster_annotation_order)
-		df.sort_values(by='annotation_cat', inplace=True)
-		df.drop('annotation_cat', axis=1, inplace=True)
+		df = sort_cells_by_annotation(df, 'grouping', cluster_annotation_order)
 	elif grouping == 'cluster':
 		df.sort_values(by='cluster_'+clustering, inplace=True)
 
@@ -990,6 +1030,77 @@ def get_gene_methylation(ensemble, methylation_type, gene, grouping, clustering,
 
 	return df
 
+# Cells of a plot whose genes are fetched with one IN list per statement.
+GENE_CELLS_CHUNK = 5000
+# Above this many cells, the genes are fetched for the whole ensemble and aligned to the cells instead.
+GENE_CELLS_JOIN = 20000
+
+def get_gene_of_cells(ensemble, gene_table_name, columns, cell_ids, bind):
+	"""Values of a gene for the cells of a plot, ie. the other genes of a multi-gene plot.
+
+	Arguments:
+		ensemble (str): Name of ensemble.
+		gene_table_name (str): Table of the gene, ie. gene_ENSMUSG00000026787_3.
+		columns ([str]): Columns of the gene table to fetch.
+		cell_ids (ndarray): Cells of the plot, None for every cell of the ensemble.
+		bind (str): Database of the gene table.
+
+	Returns:
+		DataFrame: cell_id and columns, for the cells which have a row in the gene table. Large samples get the
+			cells of the whole ensemble. None if the query fails.
+	"""
+
+	engine = db.get_engine(current_app, bind)
+	try:
+		if cell_ids is None or len(cell_ids) > GENE_CELLS_JOIN:
+			query = "SELECT {1}.cell_id, {2} FROM {1} INNER JOIN {0} ON {0}.cell_id = {1}.cell_id".format(
+				ensemble, gene_table_name, ', '.join(gene_table_name + '.' + column for column in columns))
+			return read_frame(query, engine)
+
+		cell_ids = cell_ids.tolist()
+		frames = []
+		for start in range(0, len(cell_ids), GENE_CELLS_CHUNK):
+			chunk = tuple(cell_ids[start:start + GENE_CELLS_CHUNK])
+			query = "SELECT cell_id, {} FROM {} WHERE cell_id IN ({})".format(
+				', '.join(columns), gene_table_name, ', '.join(['%s'] * len(chunk)))
+			frames.append(read_frame(query, engine, params=chunk))
+	except exc.ProgrammingError as e:
+		now = datetime.datetime.now()
+		print("[{}] ERROR in app(get_gene_of_cells): {}".format(str(now), e))
+		sys.stdout.flush()
+		return None
+	if not frames:
+		return pd.DataFrame(columns=['cell_id'] + columns)
+	return pd.concat(frames, ignore_index=True)
+
+@spanned('transform')
+def align_gene_values(cell_ids, gene_cell_ids, values):
+	"""Place the values of a gene, fetched for any set of cells, in the order of cell_ids.
+
+	Arguments:
+		cell_ids (ndarray): Cells of the plot.
+		gene_cell_ids (ndarray): Cell of each value, without duplicates.
+		values (ndarray): Values of the gene.
+
+	Returns:
+		ndarray: float32 value of each cell in cell_ids, NaN for cells without a value.
+	"""
+
+	positions = pd.Index(gene_cell_ids).get_indexer(cell_ids)
+	found = positions >= 0
+	aligned = np.full(len(cell_ids), np.nan, dtype=np.float32)
+	aligned[found] = pd.to_numeric(pd.Series(values)).values[positions[found]]
+	return aligned
+
+@spanned('transform')
+def nanmean_rows(matrix):
+	"""Mean of the values of each row of a cell x gene matrix, ignoring NaN like groupby().mean(). NaN for empty rows."""
+
+	counts = (~np.isnan(matrix)).sum(axis=1)
+	sums = np.nansum(matrix, axis=1, dtype=np.float64)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		return sums / counts
+
 def get_gene_from_mysql(ensemble, gene_table_name, methylation_type, clustering, tsne_type, grouping='cluster', max_points='10000'):
 	"""Helper function to fetch a gene's methylation information from mysql.
 
@@ -1012,10 +1123,8 @@ def get_gene_from_mysql(ensemble, gene_table_name, methylation_type, clustering,
 		groupingu = "cells."+grouping
 
 
-	t0=datetime.datetime.now()
-	# print(' Running get_gene_from_mysql for '+gene_table_name+' : '+str(t0)+'; ', file=open(log_file,'a'))# EAM - Profiling SQL
 	if tsne_type=='noTSNE':
-		query = "SELECT %(gene_table_name)s.%(methylation_type)s, %(gene_table_name)s.%(context)s, \
+		query = "SELECT %(ensemble)s.cell_id, %(gene_table_name)s.%(methylation_type)s, %(gene_table_name)s.%(context)s \
 			FROM %(ensemble)s  \
 			LEFT JOIN %(gene_table_name)s ON %(ensemble)s.cell_id = %(gene_table_name)s.cell_id" % {'ensemble': ensemble, 
 																	   'gene_table_name': gene_table_name,
@@ -1042,10 +1151,12 @@ def get_gene_from_mysql(ensemble, gene_table_name, methylation_type, clustering,
 			%(ensemble)s.annotation_%(clustering)s, %(ensemble)s.cluster_%(clustering)s, \
 			%(ensemble)s.tsne_x_%(tsne_type)s, %(ensemble)s.tsne_y_%(tsne_type)s, %(ensemble)s.tsne_z_%(tsne_type)s, \
 			%(gene_table_name)s.%(methylation_type)s, %(gene_table_name)s.%(context)s, \
-			datasets.target_region, datasets.sex \
+			datasets.target_region, datasets.sex, %(groupingu)s as grouping \
 			FROM cells \
 			INNER JOIN %(ensemble)s ON cells.cell_id = %(ensemble)s.cell_id \
-			LEFT JOIN %(gene_table_name)s ON %(ensemble)s.cell_id = %(gene_table_name)s.cell_id " % {'ensemble': ensemble, 
+			LEFT JOIN %(gene_table_name)s ON %(ensemble)s.cell_id = %(gene_table_name)s.cell_id \
+			LEFT JOIN datasets ON cells.dataset = datasets.dataset \
+			LEFT JOIN ABA_regions ON datasets.brain_region=ABA_regions.ABA_acronym " % {'ensemble': ensemble, 'groupingu': groupingu,
 																	   'gene_table_name': gene_table_name,
 																	   'tsne_type': tsne_type,
 																	   'methylation_type': methylation_type,
@@ -1055,7 +1166,7 @@ def get_gene_from_mysql(ensemble, gene_table_name, methylation_type, clustering,
 		query = query+" ORDER BY RAND() LIMIT %(max_points)s" % {'max_points': max_points}
 
 	try:
-		df = pd.read_sql(query, db.get_engine(current_app, 'methylation_data'))
+		df = read_frame(query, db.get_engine(current_app, 'methylation_data'))
 	except exc.ProgrammingError as e:
 		now = datetime.datetime.now()
 		print("[{}] ERROR in app(get_mult_gene_methylation): {}".format(str(now), e))
@@ -1099,29 +1210,31 @@ def get_mult_gene_methylation(ensemble, methylation_type, genes, grouping, clust
 	result = db.get_engine(current_app, 'methylation_data').execute(first_query, (genes,)).fetchall()
 
 	gene_table_names = ['gene_' + gene_id[0].replace('.','_') for gene_id in result]
+	if not gene_table_names:
+		return None
 
-	df_all = pd.DataFrame()
-
-	t0=datetime.datetime.now()
-	df_list = []
-	for i, gene_table_name in enumerate(gene_table_names):
-		t0a=datetime.datetime.now()
-		if i>0:
-			tsne_typeu='noTSNE'
-		else:
-			tsne_typeu=tsne_type
-		df_all = df_all.append(get_gene_from_mysql(ensemble, gene_table_name, methylation_type, clustering, tsne_typeu, grouping, max_points))
-		if i==0:
-			df_coords=df_all
-		t1a=datetime.datetime.now()
-
-	t1=datetime.datetime.now()
-
-	df_all[[methylation_type, context]] = df_all[[methylation_type, context]].apply(pd.to_numeric)
-
-	df_avg_methylation = df_all.groupby(by='cell_id', as_index=False)[[methylation_type, context]].mean()
-	df_coords.update(df_avg_methylation)
-
+	# The cells of the plot come with the first gene. The other genes are fetched concurrently for these cells only
+	# and aligned to them by cell_id in a dense cell x gene matrix, then averaged along the gene axis.
+	df_coords = get_gene_from_mysql(ensemble, gene_table_names[0], methylation_type, clustering, tsne_type, grouping, max_points)
+	if df_coords is None:
+		return None
+	df_coords.reset_index(drop=True, inplace=True)
+	cell_ids = df_coords['cell_id'].values
+	df_genes = gather(*[ (get_gene_of_cells, ensemble, gene_table_name, [methylation_type, context],
+		cell_ids if max_points.isdigit() else None, 'methylation_data') for gene_table_name in gene_table_names[1:] ])
+
+	mc = np.full((len(df_coords), len(gene_table_names)), np.nan, dtype=np.float32)
+	coverage = np.full((len(df_coords), len(gene_table_names)), np.nan, dtype=np.float32)
+	mc[:, 0] = pd.to_numeric(df_coords[methylation_type]).values
+	coverage[:, 0] = pd.to_numeric(df_coords[context]).values
+	for i, df_gene in enumerate(df_genes, 1):
+		if df_gene is None:
+			continue
+		mc[:, i] = align_gene_values(cell_ids, df_gene['cell_id'].values, df_gene[methylation_type].values)
+		coverage[:, i] = align_gene_values(cell_ids, df_gene['cell_id'].values, df_gene[context].values)
+
+	df_coords[methylation_type] = nanmean_rows(mc)
+	df_coords[context] = nanmean_rows(coverage)
 
 	if df_coords[context].isnull().all(): # If no data in column, return None 
 		return None
@@ -1131,41 +1244,34 @@ def get_mult_gene_methylation(ensemble, methylation_type, genes, grouping, clust
 		else:
 			df_coords[methylation_type + '/' + context + '_' + level] = (df_coords[methylation_type] / df_coords[context]) / df_coords['global_'+methylation_type]
 
+	df_coords = compact_cells(df_coords)
 	if grouping == 'annotation':
-		df_coords.fillna({'annotation_'+clustering: 'None'}, inplace=True)
-		df_coords['annotation_cat'] = pd.Categorical(df_coords['annotation_'+clustering], cluster_annotation_order)
-		df_coords.sort_values(by='annotation_cat', inplace=True)
-		df_coords.drop('annotation_cat', axis=1, inplace=True)
+		df_coords = sort_cells_by_annotation(df_coords, 'annotation_'+clustering, cluster_annotation_order)
 	elif grouping == 'cluster':
 		df_coords.sort_values(by='cluster_'+clustering, inplace=True)
 
 	return df_coords
 
 @cache.memoize(timeout=1800)
-def get_methylation_scatter(ensemble, tsne_type, methylation_type, genes_query, level, grouping, 
-	clustering, ptile_start, ptile_end, tsne_outlier_bool, max_points='10000'):
-	"""Generate scatter plot and gene body reads scatter plot using tSNE coordinates from snATAC-seq data.
+def get_methylation_scatter_points(ensemble, tsne_type, methylation_type, genes_query, level, grouping, clustering,
+	max_points='10000', module=None):
+	"""Fetch the cells of a methylation scatter plot and sketch the quantiles of their values.
 
-	Arguments:
-		ensemble (str): Name of ensemble.
-		tsne_type (str): Options for calculating tSNE. ndims = number of dimensions, perp = perplexity.
-		methylation_type (str): Type of methylation to visualize. "mCH", "mCG", or "mCA".
-		genes_query (str):  Ensembl ID of gene(s) separated by spaces.
-		level (str): "original" or "normalized" methylation values.
-		grouping (str): Variable to group cells by. "cluster", "annotation", "dataset".
-		clustering (str): Different clustering algorithms and parameters. 'lv' = Louvain clustering.
-		ptile_start (float): Lower end of color percentile. [0, 1].
-		ptile_end (float): Upper end of color percentile. [0, 1].
-		tsne_outlier_bool (bool): Whether or not to change X and Y axes range to hide outliers. True = do show outliers. 
+	The color percentiles are not arguments, so moving the percentile slider reuses the cells and the sketch.
+	Given a module, the genes of the module are plotted instead of genes_query and the points are cached per module.
 
 	Returns:
-		str: HTML generated by Plot.ly.
+		dict: points, title, grouping (falls back to "cluster" without annotations), continuous, modality and
+			sketch (see quantiles).
 	"""
 
+	if module is not None:
+		genes_query = get_module_genes_query(module)
+		if genes_query is None:
+			raise FailToGraphException
 	genes = genes_query.split()
 
 	gene_name_str = ""
-	x, y, text, mch = list(), list(), list(), list()
 
 	if len(genes) == 1:
 		points = get_gene_methylation(ensemble, methylation_type, genes[0], grouping, clustering, level, True, tsne_type, max_points)
@@ -1180,476 +1286,89 @@ def get_methylation_scatter(ensemble, tsne_type, methylation_type, genes_query,
 			gene_name_str += gene['gene_name'] + '+'
 		gene_name_str = gene_name_str[:-1]
 		title = 'Avg. Gene body ' + methylation_type + ': <br>' + gene_name_str
+	if module is not None:
+		title = module_title('Gene body ' + methylation_type, module, genes)
 
 	if points is None:
 		raise FailToGraphException
 
-	### TSNE ### 
 	if grouping == 'annotation':
 		if grouping+'_'+clustering not in points.columns or points[grouping+'_'+clustering].nunique() <= 1:
 			grouping = "cluster"
-			clustering = "mCH_lv_npc50_k30"
-			# print("**** Using cluster_mCH_lv_npc50_k30")
 
-	datasets = points['dataset'].unique().tolist()
-	if grouping in ['cluster','annotation','dataset','NeuN','sex','slice','brain_region','broad_brain_region','target_region']: # THese are the metadata fields with discrete/categorical values
-		unique_groups = points['grouping'].unique().tolist()
-	else:
-		# For continuous (numerical) metadata (like global_mCH), don't use discrete clusters
-		unique_groups = ['All cells']
+	# For continuous (numerical) metadata (like global_mCH), don't use discrete clusters
+	continuous = grouping not in ['cluster','annotation','dataset','NeuN','sex','slice','brain_region','broad_brain_region','target_region']
 
-	if grouping == 'cluster':
-		annotation_additional_y = 0.025 # Necessary because legend items overlap with legend title (annotation) when there are many legend items
-		num_clusters = points['cluster_'+clustering].max()
-	else:
-		annotation_additional_y = 0.00 
-		num_clusters = len(unique_groups)
-	
-	colors = generate_cluster_colors(len(unique_groups), grouping)
-	symbols = ['circle', 'square', 'cross', 'triangle-up', 'triangle-down', 'octagon', 'star', 'diamond']
-	
-	traces_tsne = OrderedDict()
-
-	legend_x = -.17
-	layout_width = 1100
-	grouping_clustering = grouping
-	if grouping == 'cluster' or grouping == 'annotation':
-		layout_width = 1000
-		legend_x = -.14
-		grouping_clustering = grouping+'_'+clustering
-
-	if tsne_outlier_bool:
-		top_x = points['tsne_x_'+tsne_type].quantile(0.999)
-		bottom_x = points['tsne_x_'+tsne_type].quantile(0.001) 
-		top_y = points['tsne_y_'+tsne_type].quantile(0.999)
-		bottom_y = points['tsne_y_'+tsne_type].quantile(0.001) 
-	else:
-		top_x = points['tsne_x_'+tsne_type].max()
-		bottom_x = points['tsne_x_'+tsne_type].min()
-		top_y = points['tsne_y_'+tsne_type].max()
-		bottom_y = points['tsne_y_'+tsne_type].min()
-
-	range_x = top_x - bottom_x 
-	top_x = top_x + range_x * 0.1
-	bottom_x = bottom_x - range_x*0.1
-	range_y = top_y - bottom_y
-	top_y = top_y + range_y * 0.1
-	bottom_y = bottom_y - range_y*0.1
-
-	if len(points) > 3000: 
-		marker_size = 2
-	else:
-		marker_size = 4
+	modality = methylation_scatter_modality(tsne_type, methylation_type, level, clustering, grouping)
+	return {'points': points, 'title': title, 'grouping': grouping, 'continuous': continuous,
+			'modality': modality, 'sketch': quantile_sketch(points[modality.value])}
 
-	context = methylation_type[1:]
+@cache.memoize(timeout=1800)
+def get_methylation_scatter(ensemble, tsne_type, methylation_type, genes_query, level, grouping, 
+	clustering, ptile_start, ptile_end, tsne_outlier_bool, max_points='10000', module=None):
+	"""Generate scatter plot and gene body reads scatter plot using tSNE coordinates from snATAC-seq data.
 
-	## 2D tSNE coordinates ##
-	if 'ndim2' in tsne_type:
-		for i, group in enumerate(unique_groups):
-			if group == 'All cells':
-				# Continuous variable
-				points_group = points
-				color_num = i
-				color = points['grouping']
-			else:
-				# Categorial variable
-				points_group = points[points['grouping']==group]
-				color_num = i
-				color = colors[color_num]
-
-			if grouping_clustering.startswith('cluster'):
-				group_str = 'cluster_' + str(group)
-			elif grouping_clustering== "dataset":
-				group = "_".join(group.split('_')[1:])
-				group_str = group
-			else:
-				group_str = group
-			if group == 'All cells':
-				group_str = ''
-			
-			
-			trace2d = traces_tsne.setdefault(color_num, Scatter(
-				x=list(),
-				y=list(),
-				text=list(),
-				mode='markers',
-				visible=True,
-				name=group_str,
-				legendgroup=group,
-				showlegend = (group != 'All cells'),
-				marker={
-					   'color': color,
-					   'colorscale': 'Viridis',
-					   'size': marker_size,
-					   #'symbol': symbols[datasets.index(dataset)],
-				},
-				hoverinfo='text'))
-			trace2d['x'] = points_group['tsne_x_'+tsne_type].values.tolist()
-			trace2d['y'] = points_group['tsne_y_'+tsne_type].values.tolist()
-			trace2d['text'] = [build_hover_text(OrderedDict([('Annotation', point[4]),
-														  ('Cluster', point[2]),
-														  ('RS2 Target Region', point[3]),
-														  ('Dataset', point[1]),
-														  ('<b>'+grouping+'</b>', point[7]),]))
-							   for point in points_group.itertuples(index=False)]
-
-		### METHYLATION SCATTER ### 
-		x = points['tsne_x_' + tsne_type].tolist()
-		y = points['tsne_y_' + tsne_type].tolist()
-		mch = points[methylation_type + '/' + context + '_' + level]
-		text_methylation = [build_hover_text(OrderedDict([('Annotation', point[4]),
-														  ('Cluster', point[2]),
-														  ('RS2 Target Region', point[3]),
-														  ('Dataset', point[1]),
-														  ('<b>'+level.title()+' '+methylation_type+'</b>', round(point[5], 6)),]))
-							for point in points.itertuples(index=False)]
-
-
-		mch_dataframe = pd.DataFrame(mch)
-		start = mch_dataframe.dropna().quantile(ptile_start)[0].tolist()
-		end = mch_dataframe.dropna().quantile(ptile_end).values[0].tolist()
-		end = max(end,start+0.01)
-		mch_colors = [set_color_by_percentile(x, start, end) for x in mch]
-
-		colorbar_tickval = list(arange(start, end, (end - start) / 4))
-		colorbar_tickval[0] = start
-		colorbar_tickval.append(end)
-		colorbar_ticktext = [
-			str(round(x, num_sigfigs_ticklabels)) for x in arange(start, end, (end - start) / 4)
-		]
-		colorbar_ticktext[0] = '<' + str(round(start, num_sigfigs_ticklabels))
-		colorbar_ticktext.append('>' + str(round(end, num_sigfigs_ticklabels)))
-
-		trace_methylation = Scatter(
-			mode='markers',
-			x=x,
-			y=y,
-			text=text_methylation,
-			marker={
-				'color': mch_colors,
-				'colorscale': 'Viridis',
-				'size': marker_size,
-				'colorbar': {
-					'x': 1.05,
-					'len': 0.5,
-					'thickness': 10,
-					'title': level.capitalize() + ' ' + methylation_type,
-					'titleside': 'right',
-					'tickmode': 'array',
-					'tickvals': colorbar_tickval,
-					'ticktext': colorbar_ticktext,
-					'tickfont': {'size': 10}
-				}
-			},
-			showlegend=False,
-			yaxis='y',
-			xaxis='x2',
-			hoverinfo='text')
-
-		layout = Layout(
-			autosize=True,
-			height=550,
-			width=layout_width,
-			#title=title,
-			#titlefont={'color': 'rgba(1,2,2,1)',
-			#           'size': 16},
-			legend={'x':legend_x,
-					'y':0.95,
-					'tracegroupgap': 0.5,
-					'bgcolor': 'rgba(0,0,0,0)',},
-			margin={'l': 0,
-					'r': 0,
-					'b': 30,
-					't': 130,},
-			xaxis={
-				'domain': [0, 0.49],
-				'type': 'linear',
-				'ticks': '',
-				'dtick': 10,
-				'tickwidth': 0,
-				'showticklabels': False,
-				'showline': True,
-				'showgrid': False,
-				'zeroline': False,
-				'linecolor': 'black',
-				'linewidth': 0.5,
-				'mirror': False,
-				'scaleanchor': 'x2',
-				'range':[bottom_x,top_x]
-			},
-			xaxis2={
-				'domain': [0.51, 1],
-				'type': 'linear',
-				'ticks': '',
-				'dtick': 10,
-				'tickwidth': 0,
-				'showticklabels': False,
-				'showline': True,
-				'showgrid': False,
-				'zeroline': False,
-				'linecolor': 'black',
-				'linewidth': 0.5,
-				'mirror': False,
-				'scaleanchor': 'y',
-				'range':[bottom_x,top_x]
-			},
-			yaxis={
-				'domain': [0, 1],
-				'type': 'linear',
-				'ticks': '',
-				'dtick': 10,
-				'tickwidth': 0,
-				'showticklabels': False,
-				'showline': True,
-				'showgrid': False,
-				'side': 'right',
-				'zeroline': False,
-				'linecolor': 'black',
-				'linewidth': 0.5,
-				'mirror': False,
-				'range':[bottom_y,top_y]
-			},
-			hovermode='closest',)
-			#hoverdistance='10',)
+	Arguments:
+		ensemble (str): Name of ensemble.
+		tsne_type (str): Options for calculating tSNE. ndims = number of dimensions, perp = perplexity.
+		methylation_type (str): Type of methylation to visualize. "mCH", "mCG", or "mCA".
+		genes_query (str):  Ensembl ID of gene(s) separated by spaces.
+		level (str): "original" or "normalized" methylation values.
+		grouping (str): Variable to group cells by. "cluster", "annotation", "dataset".
+		clustering (str): Different clustering algorithms and parameters. 'lv' = Louvain clustering.
+		ptile_start (float): Lower end of color percentile. [0, 1].
+		ptile_end (float): Upper end of color percentile. [0, 1].
+		tsne_outlier_bool (bool): Whether or not to change X and Y axes range to hide outliers. True = do show outliers. 
+		module (str): Name of a gene module to plot instead of genes_query.
 
-		
-		fig = tools.make_subplots(
-				rows=1,
-				cols=2,
-				shared_xaxes=False,
-				shared_yaxes=True,
-				print_grid=False,
-				subplot_titles=("tSNE", level.title()+" Methylation ("+methylation_type+")"),
-				)
+	Returns:
+		str: HTML generated by Plot.ly.
+	"""
 
-		for trace in traces_tsne.items():
-			fig.append_trace(trace[1], 1,1)
-		fig.append_trace(trace_methylation, 1,2)
-
-		fig['layout'].update(layout)
-		fig['layout']['annotations'].extend([Annotation(text=grouping.title(),
-														x=legend_x+0.05,
-														y=1.02 + annotation_additional_y,
-														xanchor="left",
-														yanchor="top",
-														showarrow=False,
-														xref="paper",
-														yref="paper",
-														font={'size': 12,
-															  'color': 'gray',})])
-
-		fig['layout']['annotations'].extend([Annotation(text=title,
-														x=0.5,
-														y=1.3,
-														xanchor="center",
-														yanchor="top",
-														showarrow=False,
-														xref="paper",
-														yref="paper",
-														font={'size': 16,
-															  'color': 'black',})])
-
-
-	## 3D tSNE coordinates ##
-	else: 
-		for i, group in enumerate(unique_groups):
-
-			points_group = points[points[grouping_clustering]==group]
-			if grouping_clustering.startswith('cluster'):
-				group_str = 'cluster_' + str(group)
-			elif grouping_clustering== "dataset":
-				group = group.strip('CEMBA_')
-				group_str = group
-			else:
-				group_str = group
+	scatter = get_methylation_scatter_points(ensemble, tsne_type, methylation_type, genes_query, level, grouping,
+											 clustering, max_points, module)
+	# Bounds are those of a 2D embedding, 3D plots compute theirs from the points.
+	bounds = get_embedding_bounds(ensemble, tsne_type) if 'ndim2' in tsne_type else None
+	return render_scatter(scatter['points'], scatter['modality'], scatter['grouping'], 'grouping', scatter['title'],
+						 ptile_start, ptile_end, tsne_outlier_bool, continuous=scatter['continuous'],
+						 bounds=bounds, sketch=scatter['sketch'])
 
-			color_num = i
-			
-			trace3d = traces_tsne.setdefault(color_num, Scatter3d(
-				x=list(),
-				y=list(),
-				z=list(),
-				text=list(),
-				mode='markers',
-				visible=True,
-				name=group_str,
-				legendgroup=group,
-				scene='scene1',
-				marker={
-					   'color': colors[color_num],
-					   'size': marker_size,
-					   'opacity': 0.8,
-					   #'symbol': symbols[datasets.index(dataset)],
-				},
-				hoverinfo='text'))
-			trace3d['x'] = points_group['tsne_x_'+tsne_type].values.tolist()
-			trace3d['y'] = points_group['tsne_y_'+tsne_type].values.tolist()
-			trace3d['z'] = points_group['tsne_z_'+tsne_type].values.tolist()
-			trace3d['text'] = [build_hover_text(OrderedDict([('Dataset', point[2]),
-															 ('Annotation', point[4]),
-															 ('Cluster', point[5]),]))
-							   for point in points_group.itertuples(index=False)]
-
-		### METHYLATION SCATTER ### 
-		x = points['tsne_x_' + tsne_type].tolist()
-		y = points['tsne_y_' + tsne_type].tolist()
-		z = points['tsne_z_' + tsne_type].tolist()
-		mch = points[methylation_type + '/' + context + '_' + level]
-		text_methylation = [build_hover_text(OrderedDict([('Annotation', point[4]),
-														  ('Cluster', point[5]),
-														  ('<b>'+methylation_type+'</b>', round(point[-1], 6)),]))
-							for point in points.itertuples(index=False)]
-
-
-		mch_dataframe = pd.DataFrame(mch)
-		start = mch_dataframe.dropna().quantile(ptile_start)[0].tolist()
-		end = mch_dataframe.dropna().quantile(ptile_end).values[0].tolist()
-		end = max(end,start+0.01)
-		mch_colors = [set_color_by_percentile(x, start, end) for x in mch]
-
-		colorbar_tickval = list(arange(start, end, (end - start) / 4))
-		colorbar_tickval[0] = start
-		colorbar_tickval.append(end)
-		colorbar_ticktext = [
-			str(round(x, num_sigfigs_ticklabels)) for x in arange(start, end, (end - start) / 4)
-		]
-		colorbar_ticktext[0] = '<' + str(round(start, num_sigfigs_ticklabels))
-		colorbar_ticktext.append('>' + str(round(end, num_sigfigs_ticklabels)))
-
-		trace_methylation = Scatter3d(
-			mode='markers',
-			x=x,
-			y=y,
-			z=z,
-			text=text_methylation,
-			scene='scene2',
-			marker={
-				'color': mch_colors,
-				'colorscale': 'Viridis',
-				'size': marker_size,
-				'colorbar': {
-					'x': 1.05,
-					'len': 0.5,
-					'thickness': 10,
-					'title': level.capitalize() + ' ' + methylation_type,
-					'titleside': 'right',
-					'tickmode': 'array',
-					'tickvals': colorbar_tickval,
-					'ticktext': colorbar_ticktext,
-					'tickfont': {'size': 10}
-				}
-			},
-			showlegend=False,
-			hoverinfo='text')
-
-		layout = Layout(
-			autosize=True,
-			height=450,
-			width=1000,
-			title=title,
-			titlefont={'color': 'rgba(1,2,2,1)',
-					   'size': 16},
-			legend={'x':-.1, 'y':1, 'bgcolor':"rgba(0,0,0,0)"},
-			margin={'l': 49,
-					'r': 0,
-					'b': 30,
-					't': 100,
-					'pad': 10
-					},
-			hovermode='closest',
-		)
+def get_summary_box_traces(ensemble, modality, gene, measure, grouping, grouping_column, outliers):
+	"""Box plot traces drawn from the precomputed summaries of a gene, see box_stats.
+
+	Arguments:
+		ensemble (str): Name of ensemble.
+		modality (str): methylation, snATAC or RNA
+		gene (str):  Ensembl ID of gene for that ensemble.
+		measure (str): Summarised value. ie. mCH_original, mCG_normalized or normalized_counts
+		grouping (str): "cluster" or "annotation".
+		grouping_column (str): Column of the ensemble table holding the groups. ie. cluster_mCH_lv_npc50_k5
+		outliers (bool): Whether if outliers should be displayed.
+
+	Returns:
+		list: Plotly traces. None if the gene has not been summarised, or if there is a single annotation.
+	"""
+	summaries = get_box_summaries(ensemble, modality, gene, measure, grouping_column)
+	if summaries is None:
+		return None
+
+	# Same order as the cell based plots
+	if grouping == 'annotation':
+		if len(summaries) <= 1:
+			return None
+		summaries = summaries.assign(group_order=pd.Categorical(summaries['group_name'], cluster_annotation_order))
+	else:
+		summaries = summaries.assign(group_order=pd.to_numeric(summaries['group_name'], errors='coerce'))
+	summaries = summaries.sort_values(by=['group_order', 'group_name'])
+
+	if grouping == 'cluster':
+		names = ['cluster_' + group for group in summaries['group_name']]
+	else:
+		names = summaries['group_name'].tolist()
+	colors = generate_cluster_colors(len(summaries), grouping)
+
+	return summary_box_traces(summaries, names, colors, outliers)
 
-		scene={
-			'camera':{
-				'eye': dict(x=1.2, y=1.5, z=0.7),
-				'center': dict(x=0.25, z=-0.1)
-					 },
-			'aspectmode':'data',
-			'xaxis':{
-				'title': 'tSNE 1',
-				'titlefont': {
-					'color': 'rgba(1,2,2,1)',
-					'size': 12
-				},
-				'type': 'linear',
-				'ticks': '',
-				'showticklabels': False,
-				'tickwidth': 0,
-				'showline': True,
-				'showgrid': False,
-				'zeroline': False,
-				'linecolor': 'black',
-				'linewidth': 0.5,
-				'mirror': True
-			},
-			'yaxis':{
-				'title': 'tSNE 2',
-				'titlefont': {
-					'color': 'rgba(1,2,2,1)',
-					'size': 12
-				},
-				'type': 'linear',
-				'ticks': '',
-				'showticklabels': False,
-				'tickwidth': 0,
-				'showline': True,
-				'showgrid': False,
-				'zeroline': False,
-				'linecolor': 'black',
-				'linewidth': 0.5,
-				'mirror': True
-			},
-			'zaxis':{
-				'title': 'tSNE 3',
-				'titlefont': {
-					'color': 'rgba(1,2,2,1)',
-					'size': 12
-				},
-				'type': 'linear',
-				'ticks': '',
-				'showticklabels': False,
-				'tickwidth': 0,
-				'showline': True,
-				'showgrid': False,
-				'zeroline': False,
-				'linecolor': 'black',
-				'linewidth': 0.5,
-				'mirror': True
-			},
-		}
-
-		fig = tools.make_subplots(rows=1,
-								  cols=2,
-								  shared_xaxes=True,
-								  #shared_yaxes=True,
-								  print_grid=False,
-								  subplot_titles=("tSNE", "Methylation"),
-								  specs=[[{'is_3d':True}, {'is_3d':True}]])
-
-		for trace in traces_tsne.items():
-			fig.append_trace(trace[1], 1,1)
-		fig.append_trace(trace_methylation, 1,2)
-
-		fig['layout'].update(layout)
-		fig['layout']['scene1'].update(scene)
-		fig['layout']['scene2'].update(scene)
-	
-		fig['layout']['annotations'].extend([Annotation(text="Cluster Labels",
-														x=-.09,
-														y=1.03 + annotation_additional_y,
-														xanchor="left",
-														yanchor="top",
-														showarrow=False,
-														xref="paper",
-														yref="paper",
-														font={'size': 12,
-															  'color': 'gray',})])
-
-	return plotly.offline.plot(
-		figure_or_data=fig,
-		output_type='div',
-		show_link=False,
-			include_plotlyjs=False)
 
 @cache.memoize(timeout=3600)
 def get_mch_box(ensemble, methylation_type, gene, grouping, clustering, level, outliers, max_points='10000'):
@@ -1669,94 +1388,107 @@ def get_mch_box(ensemble, methylation_type, gene, grouping, clustering, level, o
 	Returns:
 		str: HTML generated by Plot.ly.
 	"""
-	tsne_type='mCH_ndim2_perp20'; # Note this doesn't matter, since we won't use tSNE for the box plot
-	points = get_gene_methylation(ensemble, methylation_type, gene, grouping, clustering, level, outliers, tsne_type, max_points)
-	context = methylation_type[1:]
+	# Precomputed summaries of every cell, see box_stats. Other groupings and ensembles which have not been
+	# summarised yet are plotted from a sample of the cells.
+	data = None
+	if grouping == 'annotation':
+		data = get_summary_box_traces(ensemble, 'methylation', gene, methylation_type+'_'+level, grouping,
+									  'annotation_'+clustering, outliers)
+	if data is None and grouping in ['cluster', 'annotation']:
+		data = get_summary_box_traces(ensemble, 'methylation', gene, methylation_type+'_'+level, 'cluster',
+									  'cluster_'+clustering, outliers)
+		if data is not None:
+			grouping = 'cluster'
+
+	if data is None:
+		tsne_type='mCH_ndim2_perp20'; # Note this doesn't matter, since we won't use tSNE for the box plot
+		points = get_gene_methylation(ensemble, methylation_type, gene, grouping, clustering, level, outliers, tsne_type, max_points)
+		context = methylation_type[1:]
+
+		if points is None:
+			raise FailToGraphException
+		if grouping == 'annotation' and points['annotation_'+clustering].nunique() <= 1:
+			grouping = "cluster"
 
-	if points is None:
-		raise FailToGraphException
-	if grouping == 'annotation' and points['annotation_'+clustering].nunique() <= 1:
-		grouping = "cluster"
+		traces = OrderedDict()
+		if grouping == "dataset":
+			groups = points[grouping]
+			unique_groups = points["dataset"].unique()
+		elif grouping == 'target_region':
+			points['target_region'] = fill_missing_groups(points['target_region'], 'N/A')
+			groups = points[grouping]
+			unique_groups = points['target_region'].unique()
+		elif grouping == 'slice':
+			datasets_all_cells = points['dataset'].tolist()
+			slices_list = [d.split('_')[1] if 'RS2' not in d else d.split('_')[2][2:4] for d in datasets_all_cells]
+			points['slice'] = slices_list
+			groups = points[grouping]
+			slices_set = set(slices_list)
+			unique_groups = np.array(list(slices_set))
+		elif grouping == 'sex':
+			unique_groups = points['sex'].unique()
+			groups = points[grouping]
+		elif grouping == 'cluster' or grouping == 'annotation':
+			unique_groups = points[grouping+'_'+clustering].unique()
+			groups = points[grouping+'_'+clustering]
+		else:
+			grouping = 'cluster'
+			unique_groups = points[grouping+'_'+clustering].unique()
+			groups = points[grouping+'_'+clustering]
+		num_clusters = len(unique_groups)
 
-	traces = OrderedDict()
-	if grouping == "dataset":
-		groups = points[grouping]
-		unique_groups = points["dataset"].unique()
-	elif grouping == 'target_region':
-		points['target_region'].fillna('N/A', inplace=True)
-		groups = points[grouping]
-		unique_groups = points['target_region'].unique()
-	elif grouping == 'slice':
-		datasets_all_cells = points['dataset'].tolist()
-		slices_list = [d.split('_')[1] if 'RS2' not in d else d.split('_')[2][2:4] for d in datasets_all_cells]
-		points['slice'] = slices_list
-		groups = points[grouping]
-		slices_set = set(slices_list)
-		unique_groups = np.array(list(slices_set))
-	elif grouping == 'sex':
-		unique_groups = points['sex'].unique()
-		groups = points[grouping]
-	elif grouping == 'cluster' or grouping == 'annotation':
-		unique_groups = points[grouping+'_'+clustering].unique()
-		groups = points[grouping+'_'+clustering]
-	else:
-		grouping = 'cluster'
-		unique_groups = points[grouping+'_'+clustering].unique()
-		groups = points[grouping+'_'+clustering]
-	num_clusters = len(unique_groups)
-
-	# ## ############
-	# gene_info_df = pd.DataFrame()
-	# gene_info_df = median_cluster_mch(points, grouping, clustering)
-	# gene_info_dict = gene_info_df.to_dict(into=OrderedDict)    
-	# mch = list()
-	# for key in list(gene_info_dict.keys()):
-	# 	mch.append(list(gene_info_dict[key].values()))
-	# mch = np.array(mch)
-	# figure = ff.create_dendrogram(mch.transpose(), orientation="bottom", labels=tuple([i for i in range(mch.shape[1])]), 
-	# 	colorscale=['bbbbbbb'])
-	# for i in range(len(dendro_top['data'])):
-	# 	dendro_top['data'][i]['yaxis'] = 'y2'
-	# dendro_top_leaves = dendro_top['layout']['xaxis']['ticktext']
-	# dendro_top_leaves = list(map(int, dendro_top_leaves))
-	# mch = mch[:,dendro_top_leaves] # Reorder the columns according to the clustering
-	# unique_groups = [unique_groups[i] for i in dendro_top_leaves]
-	# mch = list(mch)
-	# figure['data'].extend(dendro_top['data'])
-	# ## ###########
-
-	colors = generate_cluster_colors(num_clusters, grouping)
-	if grouping == "cluster":
-		name_prepend="cluster_"
-	else:
-		name_prepend=""
-	data = []
-	for group in unique_groups:
-		color = colors[int(np.where(unique_groups==group)[0]) % len(colors)]
-		if outliers:
-			boxpoints='suspectedoutliers';
+		# ## ############
+		# gene_info_df = pd.DataFrame()
+		# gene_info_df = median_cluster_mch(points, grouping, clustering)
+		# gene_info_dict = gene_info_df.to_dict(into=OrderedDict)    
+		# mch = list()
+		# for key in list(gene_info_dict.keys()):
+		# 	mch.append(list(gene_info_dict[key].values()))
+		# mch = np.array(mch)
+		# figure = ff.create_dendrogram(mch.transpose(), orientation="bottom", labels=tuple([i for i in range(mch.shape[1])]), 
+		# 	colorscale=['bbbbbbb'])
+		# for i in range(len(dendro_top['data'])):
+		# 	dendro_top['data'][i]['yaxis'] = 'y2'
+		# dendro_top_leaves = dendro_top['layout']['xaxis']['ticktext']
+		# dendro_top_leaves = list(map(int, dendro_top_leaves))
+		# mch = mch[:,dendro_top_leaves] # Reorder the columns according to the clustering
+		# unique_groups = [unique_groups[i] for i in dendro_top_leaves]
+		# mch = list(mch)
+		# figure['data'].extend(dendro_top['data'])
+		# ## ###########
+
+		colors = generate_cluster_colors(num_clusters, grouping)
+		if grouping == "cluster":
+			name_prepend="cluster_"
 		else:
-			boxpoints=False
-		trace = {
-			"type": 'violin',
-			"x": group,
-			"y": points[methylation_type + '/' + context + '_' + level][groups==group],
-			"name": name_prepend + str(group),
-			"points": boxpoints,
-			"box": {
-				"visible": True,
-				"width": .8,
-				'fillcolor': color,
-			},
-			"line": {
-				"color" : 'rgba(10,10,10,.5)'
+			name_prepend=""
+		data = []
+		for group in unique_groups:
+			color = colors[int(np.where(unique_groups==group)[0]) % len(colors)]
+			if outliers:
+				boxpoints='suspectedoutliers';
+			else:
+				boxpoints=False
+			trace = {
+				"type": 'violin',
+				"x": group,
+				"y": points[methylation_type + '/' + context + '_' + level][groups==group],
+				"name": name_prepend + str(group),
+				"points": boxpoints,
+				"box": {
+					"visible": True,
+					"width": .8,
+					'fillcolor': color,
+				},
+				"line": {
+					"color" : 'rgba(10,10,10,.5)'
+				}
 			}
-		}
-		data.append(trace)
+			data.append(trace)
 
 	gene_name = get_gene_by_id([ gene ])[0]['gene_name']
 
-	layout = Layout(
+	layout = go.Layout(
 		autosize=True,
 		height=450,
 		width=1000,
@@ -1808,7 +1540,7 @@ def get_mch_box(ensemble, methylation_type, gene, grouping, clustering, level, o
 		showlegend=False,
 	)
 
-	return plotly.offline.plot(
+	return timed('serialize', plotly.offline.plot,
 		{
 			'data': data,
 			'layout': layout
@@ -1819,21 +1551,24 @@ def get_mch_box(ensemble, methylation_type, gene, grouping, clustering, level, o
 		validate=False,)
 
 @cache.memoize(timeout=3600)
-def get_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, ptile_start, ptile_end, normalize_row, query):
-	"""Generate mCH heatmap comparing multiple genes.
+def get_mch_heatmap_order(ensemble, methylation_type, grouping, clustering, level, normalize_row, query):
+	"""Return the cluster medians shown in the mCH heatmap, ordered by hierarchical clustering.
+
+	Both the gene and the cluster orderings are cached, so changing the color percentiles of a heatmap does
+	not cluster it again.
 
 	Arguments:
 		ensemble (str): Name of ensemble.
 		methylation_type (str): Type of methylation to visualize.        "mch" or "mcg"
+		grouping (str): Variable for grouping cells. "cluster", "annotation", or "dataset".
+		clustering (str): Different clustering algorithms and parameters. 'lv' = Louvain clustering.
 		level (str): "original" or "normalized" methylation values.
-		outliers (bool): Whether if outliers should be displayed.
-		ptile_start (float): Lower end of color percentile. [0, 1].
-		ptile_end (float): Upper end of color percentile. [0, 1].
 		normalize_row (bool): Whether to normalize by each row (gene). 
 		query ([str]): Ensembl IDs of genes to display.
 
 	Returns:
-		str: HTML generated by Plot.ly
+		dict: title, mch (genes x clusters, in dendrogram order), sketch (quantiles of mch for the color scale,
+			see quantiles), gene_labels, clusters_labels, gene_leaves, cluster_leaves, gene_linkage and cluster_linkage.
 	"""
 	tsne_type = 'mCH_ndim2_perp20'
 
@@ -1850,7 +1585,6 @@ def get_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, pti
 		s=s+','+i
 
 	gene_labels = list()
-	gene_info_df = pd.DataFrame()
 	gene_infos = get_gene_by_id(genes)
 	for i, gene in enumerate(gene_infos):
 		gene_name = gene['gene_name']
@@ -1858,12 +1592,23 @@ def get_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, pti
 		if i > 0 and i % 10 == 0:
 			title += "<br>"
 		title += gene_name + "+"
-		gene_info_df[gene_name] = median_cluster_mch(get_gene_methylation(ensemble, methylation_type, gene['gene_id'], grouping, clustering, level, True), grouping, clustering)
-		if gene_info_df[gene_name].empty:
-			raise FailToGraphException
 
 	title = title[:-1] # Gets rid of last '+'
 
+	# Rows of the precomputed cluster medians, see aggregates. Other groupings and ensembles which have not
+	# been aggregated yet take the medians of a sample of cells, one gene at a time.
+	gene_info_df = None
+	if grouping in ['cluster', 'annotation']:
+		gene_info_df = get_aggregate_frame(ensemble, methylation_type+'_'+level, grouping+'_'+clustering,
+										   [gene['gene_id'] for gene in gene_infos], gene_labels)
+	if gene_info_df is None:
+		gene_info_df = pd.DataFrame()
+		for gene in gene_infos:
+			gene_name = gene['gene_name']
+			gene_info_df[gene_name] = median_cluster_mch(get_gene_methylation(ensemble, methylation_type, gene['gene_id'], grouping, clustering, level, True), grouping, clustering)
+			if gene_info_df[gene_name].empty:
+				raise FailToGraphException
+
 	gene_info_df.reset_index(inplace=True)
 	if grouping == 'annotation':
 		gene_info_df['annotation_cat'] = pd.Categorical(gene_info_df['annotation_'+clustering], cluster_annotation_order)
@@ -1899,72 +1644,72 @@ def get_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, pti
 			gene_info_df[gene] = (gene_info_df[gene] - gene_info_df[gene].min()) / gene_range
 		normal_or_original = 'Normalized'
 
-	gene_info_dict = gene_info_df.to_dict(into=OrderedDict)    
+	mch = gene_info_df.transpose().values.astype(float) # genes x clusters
 
-	x, y, text, hover, mch = list(), list(), list(), list(), list()
-	i = 0
-	name_prepend = ""
-	if grouping == 'cluster':
-		name_prepend = 'cluster_'
-	for key in list(gene_info_dict.keys()):
-		j = 0
-		y.append(key)
-		mch.append(list(gene_info_dict[key].values()))
-		for cluster in list(gene_info_dict[key].keys()):
-			x.append(name_prepend+str(cluster))
-			text.append(build_hover_text(OrderedDict([('Gene', key),
-													  (grouping.title(), x[j]),
-													  (methylation_type, mch[i][j])
-													  ])))
-			j += 1
-		hover.append(text)
-		text = []
-		i += 1
+	# Hierarchical clustering of the genes (rows) and the clusters (columns)
+	gene_linkage, gene_leaves = cluster_leaves(mch)
+	mch = mch[gene_leaves,:]
+	cluster_linkage, cluster_leaves_order = cluster_leaves(mch.transpose())
+	mch = mch[:,cluster_leaves_order]
 
-	flat_mch = list(chain.from_iterable(mch))
-	mch_dataframe = pd.DataFrame(flat_mch).dropna()
-
-	# Hierarchical clustering and dendrogram
-	mch = np.array(mch)
-	figure = ff.create_dendrogram(mch, orientation="right", labels=tuple([i for i in range(len(genes))]), 
-		colorscale=['bbbbbbb']) # TODO: Figure out how to set the colorscale
-	for i in range(len(figure['data'])):
-		figure['data'][i]['xaxis'] = 'x2'
-	dendro_leaves = figure['layout']['yaxis']['ticktext']
-	dendro_leaves = list(map(int, dendro_leaves))
-	mch = mch[dendro_leaves,:] # Reorder the genes according to the clustering
-	genes_labels = [gene_labels[i] for i in dendro_leaves]
-	hover_old = hover
-	# hover = [hover_old[i] for i in dendro_leaves]
-	hover = [str(i) for i in dendro_leaves]
-
-	dendro_top = ff.create_dendrogram(mch.transpose(), orientation="bottom", labels=tuple([i for i in range(mch.shape[1])]), 
-		colorscale=['bbbbbbb'])
-	for i in range(len(dendro_top['data'])):
-		dendro_top['data'][i]['yaxis'] = 'y2'
-	dendro_top_leaves = dendro_top['layout']['xaxis']['ticktext']
-	dendro_top_leaves = list(map(int, dendro_top_leaves))
-	mch = mch[:,dendro_top_leaves] # Reorder the genes according to the clustering
-	clusters_labels = [clusters_labels[i] for i in dendro_top_leaves]
-	mch = list(mch)
-	figure['data'].extend(dendro_top['data'])
+	return {'title': title,
+			'mch': mch,
+			'sketch': quantile_sketch(mch.flatten()),
+			'gene_labels': [gene_labels[i] for i in gene_leaves],
+			'clusters_labels': [clusters_labels[i] for i in cluster_leaves_order],
+			'gene_leaves': gene_leaves,
+			'cluster_leaves': cluster_leaves_order,
+			'gene_linkage': gene_linkage,
+			'cluster_linkage': cluster_linkage,}
 
-	# Set color scale limits
-	start = mch_dataframe.quantile(ptile_start).values[0].tolist()
-	end = mch_dataframe.quantile(ptile_end).values[0].tolist()
-	end = max(end,start+0.01)
-	
-	colorbar_tickval = list(arange(start, end, (end - start) / 4))
-	colorbar_tickval[0] = start
-	colorbar_tickval.append(end)
-	colorbar_ticktext = [
-		str(round(x, num_sigfigs_ticklabels)) for x in arange(start, end, (end - start) / 4)
-	]
-	if normalize_row == True:
-		colorbar_ticktext[0] = str(round(start, num_sigfigs_ticklabels))
-	else:
-		if (round(start,num_sigfigs_ticklabels)) == 0:
-			colorbar_ticktext[0] = str(round(start,num_sigfigs_ticklabels))
+
+@cache.memoize(timeout=3600)
+def get_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, ptile_start, ptile_end, normalize_row, query):
+	"""Generate mCH heatmap comparing multiple genes.
+
+	Arguments:
+		ensemble (str): Name of ensemble.
+		methylation_type (str): Type of methylation to visualize.        "mch" or "mcg"
+		level (str): "original" or "normalized" methylation values.
+		outliers (bool): Whether if outliers should be displayed.
+		ptile_start (float): Lower end of color percentile. [0, 1].
+		ptile_end (float): Upper end of color percentile. [0, 1].
+		normalize_row (bool): Whether to normalize by each row (gene). 
+		query ([str]): Ensembl IDs of genes to display.
+
+	Returns:
+		str: HTML generated by Plot.ly
+	"""
+
+	heatmap = get_mch_heatmap_order(ensemble, methylation_type, grouping, clustering, level, normalize_row, query)
+	genes = query.split()
+	title = heatmap['title']
+	mch = list(heatmap['mch'])
+	genes_labels = heatmap['gene_labels']
+	clusters_labels = heatmap['clusters_labels']
+	hover = [[build_hover_text(OrderedDict([('Gene', gene_label),
+											(grouping.title(), cluster_label),
+											(methylation_type, value)]))
+			  for cluster_label, value in zip(clusters_labels, row)]
+			 for gene_label, row in zip(genes_labels, mch)]
+
+	figure = {'data': [dendrogram_trace(heatmap['gene_linkage'], 'right', xaxis='x2', yaxis='y'),
+					   dendrogram_trace(heatmap['cluster_linkage'], 'bottom', xaxis='x', yaxis='y2')]}
+
+	# Set color scale limits
+	start, end = sketch_range(heatmap['sketch'], ptile_start, ptile_end)
+	
+	colorbar_tickval = list(arange(start, end, (end - start) / 4))
+	colorbar_tickval[0] = start
+	colorbar_tickval.append(end)
+	colorbar_ticktext = [
+		str(round(x, num_sigfigs_ticklabels)) for x in arange(start, end, (end - start) / 4)
+	]
+	if normalize_row == True:
+		colorbar_ticktext[0] = str(round(start, num_sigfigs_ticklabels))
+	else:
+		if (round(start,num_sigfigs_ticklabels)) == 0:
+			colorbar_ticktext[0] = str(round(start,num_sigfigs_ticklabels))
 		else:
 			colorbar_ticktext[0] = '<' + str(round(start, num_sigfigs_ticklabels))
 	colorbar_ticktext.append('>' + str(round(end, num_sigfigs_ticklabels)))
@@ -1979,9 +1724,9 @@ def get_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, pti
 		else:
 			colorbar_ticktext.insert(0, '<' + str(round(start, num_sigfigs_ticklabels)))
 
-	trace = Heatmap(
-		x=dendro_top_leaves,
-		y=dendro_leaves,
+	trace = go.Heatmap(
+		x=heatmap['cluster_leaves'],
+		y=heatmap['gene_leaves'],
 		z=mch,
 		xtype="array", ytype="array",
 		text=hover,
@@ -2000,11 +1745,11 @@ def get_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, pti
 		hoverinfo='text',
 		zmin=start,zmax=end,zauto=False, # Clip the extreme edges of the colorscale
 		)
-	trace['y'] = figure['layout']['yaxis']['tickvals']
-	trace['x'] = dendro_top['layout']['xaxis']['tickvals']
-	figure['data'].extend([trace])
+	trace['y'] = leaf_positions(len(genes_labels))
+	trace['x'] = leaf_positions(len(clusters_labels))
+	figure['data'].append(trace)
 
-	layout = Layout(
+	layout = go.Layout(
 		height=max(600*len(genes)/20,550), # EAM Adjust the height of the heatmap according to the number of genes displayed
 		width=1000,
 		paper_bgcolor='rgba(0,0,0,0)',
@@ -2122,7 +1867,7 @@ def get_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, pti
 
 	layout['updatemenus'] = updatemenus
 
-	# layout['annotations'].extend([Annotation(text=title,
+	# layout['annotations'].extend([go.Annotation(text=title,
 	#                                          x=0.5,
 	#                                          y=1.3,
 	#                                          xanchor="center",
@@ -2135,7 +1880,7 @@ def get_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, pti
 
 	figure['layout'] = layout
 
-	return plotly.offline.plot(figure,
+	return timed('serialize', plotly.offline.plot, figure,
 		output_type='div',
 		show_link=False,
 		include_plotlyjs=False)
@@ -2168,55 +1913,49 @@ def get_clusters(ensemble, grouping, clustering):
 		groupingu = "cells."+grouping
 
 	# Get methylation info
-	query = "SELECT count(cells.cell_id) ncells, 'snmC' as modality, \
+	query_methylation = "SELECT count(cells.cell_id) ncells, 'snmC' as modality, \
 		%(groupingu)s as groups \
 		FROM cells \
 		INNER JOIN %(ensemble)s ON cells.cell_id = %(ensemble)s.cell_id \
 		GROUP BY groups " % {'ensemble': ensemble,
 					'groupingu': groupingu,
 					'clustering': clustering}
-	try:
-		df = pd.read_sql(query, db.get_engine(current_app, 'methylation_data'))
-	except exc.ProgrammingError as e:
-		now = datetime.datetime.now()
-		print("[{}] ERROR in app(get_clusters): {}".format(str(now), e))
-		sys.stdout.flush()
-		# return None
 
 	# Get snATAC info
-	query = "SELECT count(cells.cell_id) ncells, 'snATAC' AS modality, %(ensemble)s.cluster_ATAC groups \
+	query_snATAC = "SELECT count(cells.cell_id) ncells, 'snATAC' AS modality, %(ensemble)s.cluster_ATAC groups \
 		FROM cells \
 		INNER JOIN %(ensemble)s ON cells.cell_id = %(ensemble)s.cell_id \
 		GROUP BY groups " % {'ensemble': ensemble,
 					'grouping': grouping,
 					'clustering': clustering}
 
-	try:
-		df_atac = pd.read_sql(query, db.get_engine(current_app, 'snATAC_data'))
-		df=df.append(df_atac)
-	except exc.ProgrammingError as e:
-		now = datetime.datetime.now()
-		print("[{}] ERROR in app(get_clusters): {}".format(str(now), e))
-		sys.stdout.flush()
-
-
 	# Get snRNA info
-	query = "SELECT count(cells.cell_id) ncells, 'RNA' AS modality, %(ensemble)s.cluster_RNA groups \
+	query_RNA = "SELECT count(cells.cell_id) ncells, 'RNA' AS modality, %(ensemble)s.cluster_RNA groups \
 		FROM cells \
 		INNER JOIN %(ensemble)s ON cells.cell_id = %(ensemble)s.cell_id \
 		GROUP BY groups " % {'ensemble': ensemble,
 					'grouping': grouping,
 					'clustering': clustering}
 
+	frames = gather((read_cluster_counts, query_methylation, 'methylation_data'),
+					(read_cluster_counts, query_snATAC, 'snATAC_data'),
+					(read_cluster_counts, query_RNA, 'RNA_data'))
+	frames = [ frame for frame in frames if frame is not None ]
+	if not frames:
+		return None
+
+	return pd.concat(frames)
+
+def read_cluster_counts(query, bind):
+	"""Run one of the cell count queries of get_clusters. None if the ensemble is not in the database."""
+
 	try:
-		df_rna = pd.read_sql(query, db.get_engine(current_app, 'RNA_data'))
-		df=df.append(df_rna)
+		return read_frame(query, db.get_engine(current_app, bind))
 	except exc.ProgrammingError as e:
 		now = datetime.datetime.now()
 		print("[{}] ERROR in app(get_clusters): {}".format(str(now), e))
 		sys.stdout.flush()
-
-	return df
+		return None
 
 @cache.memoize(timeout=3600)
 def get_clusters_bar(ensemble, grouping, clustering, normalize):
@@ -2236,6 +1975,8 @@ def get_clusters_bar(ensemble, grouping, clustering, normalize):
 	if grouping not in ['cluster','annotation','dataset','NeuN']:
 		grouping = 'cluster'
 	clusters = get_clusters(ensemble, grouping, clustering)
+	if clusters is None:
+		raise FailToGraphException
 
 	if (normalize=='true'):
 		clusters['ncells_norm'] = clusters.groupby('groups')['ncells'].transform(lambda x: 100*x / x.sum())
@@ -2250,7 +1991,7 @@ def get_clusters_bar(ensemble, grouping, clustering, normalize):
 	data = list();
 	for mi in mu:
 		clustersu = clusters[clusters['modality']==mi]
-		trace = Bar(
+		trace = go.Bar(
 			y=clustersu['y'],
 			x=clustersu['groups'],
 			name=mi+' cells',
@@ -2262,7 +2003,7 @@ def get_clusters_bar(ensemble, grouping, clustering, normalize):
 			trace['text'] = [str(i)+' '+mi+' cells' for i in clustersu['y']]
 		data.append(trace)
 	
-	layout = Layout(
+	layout = go.Layout(
 	    autosize=True,
 	    height=450,
 	    width=1000,
@@ -2314,7 +2055,7 @@ def get_clusters_bar(ensemble, grouping, clustering, normalize):
 	        'mirror': True,
 	    },
 	)
-	return plotly.offline.plot(
+	return timed('serialize', plotly.offline.plot,
 		{
 			'data': data,
 			'layout': layout
@@ -2374,7 +2115,7 @@ def get_gene_snATAC(ensemble, gene, grouping, outliers, smoothing=False, max_poi
 		query = query+" ORDER BY RAND() LIMIT %(max_points)s" % {'max_points': max_points}
 
 	try:
-		df = pd.read_sql(query, db.get_engine(current_app, 'snATAC_data'))
+		df = read_frame(query, db.get_engine(current_app, 'snATAC_data'))
 	except exc.ProgrammingError as e:
 		now = datetime.datetime.now()
 		print("[{}] ERROR in app(get_gene_snATAC): {}".format(str(now), e))
@@ -2387,11 +2128,9 @@ def get_gene_snATAC(ensemble, gene, grouping, outliers, smoothing=False, max_poi
 		sys.stdout.flush()
 		return None
 
+	df = compact_cells(df)
 	if grouping == 'annotation':
-		df.fillna({'annotation_ATAC': 'None'}, inplace=True)
-		df['annotation_cat'] = pd.Categorical(df['annotation_ATAC'], cluster_annotation_order)
-		df.sort_values(by='annotation_cat', inplace=True)
-		df.drop('annotation_cat', axis=1, inplace=True)
+		df = sort_cells_by_annotation(df, 'annotation_ATAC', cluster_annotation_order)
 	elif grouping == 'cluster':
 		df.sort_values(by='cluster_ATAC', inplace=True)
 
@@ -2406,12 +2145,10 @@ def get_gene_snatac_from_mysql(ensemble, gene_table_name, counts_type, tsne_type
 		DataFrame
 	"""
 
-	t0=datetime.datetime.now()
 	if tsne_type=='noTSNE':
-		query = "SELECT %(gene_table_name)s.%(counts_type)s as normalized_counts \
+		query = "SELECT %(ensemble)s.cell_id, %(gene_table_name)s.%(counts_type)s as normalized_counts \
 			FROM %(ensemble)s  \
-			LEFT JOIN %(gene_table_name)s ON %(ensemble)s.cell_id = %(gene_table_name)s.cell_id \
-			LIMIT 5000" % {'ensemble': ensemble, 
+			LEFT JOIN %(gene_table_name)s ON %(ensemble)s.cell_id = %(gene_table_name)s.cell_id" % {'ensemble': ensemble, 
 			   'gene_table_name': gene_table_name,
 			   'counts_type': counts_type,}
 	else:
@@ -2430,15 +2167,13 @@ def get_gene_snatac_from_mysql(ensemble, gene_table_name, counts_type, tsne_type
 		query = query+" ORDER BY RAND() LIMIT %(max_points)s" % {'max_points': max_points}
 
 	try:
-		df = pd.read_sql(query, db.get_engine(current_app, 'snATAC_data'))
+		df = read_frame(query, db.get_engine(current_app, 'snATAC_data'))
 	except exc.ProgrammingError as e:
 		now = datetime.datetime.now()
 		print("[{}] ERROR in app(get_gene_snatac_from_mysql): {}".format(str(now), e))
 		sys.stdout.flush()
 		return None
 
-	t1=datetime.datetime.now()
-
 	return df
 
 @cache.memoize(timeout=1800)
@@ -2472,67 +2207,62 @@ def get_mult_gene_snATAC(ensemble, genes, grouping, smoothing=False, max_points=
 
 	gene_table_names = ['gene_' + gene_id[0].replace('.','_') for gene_id in result]
 
-	df_all = pd.DataFrame()
-	
+	if not gene_table_names:
+		return None
+
 	if smoothing:
 		counts_type='smoothed_normalized_counts'
 	else:
 		counts_type='normalized_counts'
 
-	t0=datetime.datetime.now()
-	df_list = []
-	df = get_gene_snatac_from_mysql(ensemble, gene_table_names[0], counts_type, 'TSNE', max_points)
-	df_all = df_all.append(df)
-	df_coords = df;
-	for gene_table_name in gene_table_names[1:]:
-		df_all = df_all.append(get_gene_snatac_from_mysql(ensemble, gene_table_name, counts_type, 'noTSNE', max_points))
-
-	t1=datetime.datetime.now()
-
-	t1=datetime.datetime.now()
-
-	if df_all.empty: # If no data in column, return None 
+	df_coords = get_gene_snatac_from_mysql(ensemble, gene_table_names[0], counts_type, 'TSNE', max_points)
+	if df_coords is None or df_coords.empty: # If no data in column, return None 
 		now = datetime.datetime.now()
 		print("[{}] ERROR in app(get_gene_snATAC): No snATAC data for {}".format(str(now), ensemble))
 		sys.stdout.flush()
 		return None
-
-	df_all['normalized_counts'].fillna(0, inplace=True)
-
-	df_avg_methylation = df_all.groupby(by='cell_id', as_index=False)['normalized_counts'].mean()
-	df_coords.update(df_avg_methylation)
-
+	df_coords.reset_index(drop=True, inplace=True)
+	cell_ids = df_coords['cell_id'].values
+	# The other genes only need their counts for the cells of the first gene.
+	df_genes = gather(*[ (get_gene_of_cells, ensemble, gene_table_name, [counts_type],
+		cell_ids if max_points.isdigit() else None, 'snATAC_data') for gene_table_name in gene_table_names[1:] ])
+
+	# Cells x genes, missing counts are 0 like for a single gene.
+	counts = np.zeros((len(df_coords), len(gene_table_names)), dtype=np.float32)
+	counts[:, 0] = pd.to_numeric(df_coords['normalized_counts']).fillna(0).values
+	for i, df_gene in enumerate(df_genes, 1):
+		if df_gene is None:
+			continue
+		counts[:, i] = np.nan_to_num(align_gene_values(cell_ids, df_gene['cell_id'].values, df_gene[counts_type].values))
+
+	df_coords['normalized_counts'] = counts.mean(axis=1, dtype=np.float64)
+
+	df_coords = compact_cells(df_coords)
 	if grouping == 'annotation':
-		df_coords.fillna({'annotation_ATAC': 'None'}, inplace=True)
-		df_coords['annotation_cat'] = pd.Categorical(df_coords['annotation_ATAC'], cluster_annotation_order)
-		df_coords.sort_values(by='annotation_cat', inplace=True)
-		df_coords.drop('annotation_cat', axis=1, inplace=True)
+		df_coords = sort_cells_by_annotation(df_coords, 'annotation_ATAC', cluster_annotation_order)
 	elif grouping == 'cluster':
 		df_coords.sort_values(by='cluster_ATAC', inplace=True)
 	return df_coords
 
 @cache.memoize(timeout=1800)
-def get_snATAC_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end, tsne_outlier_bool, smoothing=False, max_points='10000'):
-	"""Generate scatter plot and gene body snATAC scatter plot using tSNE coordinates from methylation(snmC-seq) data.
+def get_snATAC_scatter_points(ensemble, genes_query, grouping, smoothing=False, max_points='10000', module=None):
+	"""Fetch the cells of a snATAC scatter plot and sketch the quantiles of their values.
 
-	Arguments:
-		ensemble (str): Name of ensemble.
-		tsne_type (str): Options for calculating tSNE. ndims = number of dimensions, perp = perplexity.
-		genes_query (str):  Ensembl ID of gene(s) separated by spaces.
-		grouping (str): Variable to group cells by. "cluster", "annotation", "dataset".
-		clustering (str): Different clustering algorithms and parameters. 'lv' = Louvain clustering.
-		ptile_start (float): Lower end of color percentile. [0, 1].
-		ptile_end (float): Upper end of color percentile. [0, 1].
-		tsne_outlier_bool (bool): Whether or not to change X and Y axes range to hide outliers. True = show outliers. 
+	The color percentiles are not arguments, so moving the percentile slider reuses the cells and the sketch.
+	Given a module, the genes of the module are plotted instead of genes_query and the points are cached per module.
 
 	Returns:
-		str: HTML generated by Plot.ly.
+		dict: points, title, grouping (falls back to "cluster" without annotations), group_column and sketch
+			(see quantiles).
 	"""
 
+	if module is not None:
+		genes_query = get_module_genes_query(module)
+		if genes_query is None:
+			raise FailToGraphException
 	genes = genes_query.split()
 
 	gene_name_str = ""
-	x, y, text, mch = list(), list(), list(), list()
 
 	if len(genes) == 1:
 		points = get_gene_snATAC(ensemble, genes[0], grouping, True, smoothing, max_points)
@@ -2547,6 +2277,8 @@ def get_snATAC_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end,
 			gene_name_str += gene['gene_name'] + '+'
 		gene_name_str = gene_name_str[:-1]
 		title = 'Avg. Gene body snATAC normalized counts: <br>' + gene_name_str
+	if module is not None:
+		title = module_title('Gene body snATAC normalized counts', module, genes)
 
 	if points is None:
 		raise FailToGraphException
@@ -2561,260 +2293,38 @@ def get_snATAC_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end,
 				points = get_mult_gene_snATAC(ensemble, genes, grouping, smoothing, max_points)
 			print("**** Grouping by cluster")
 
-	datasets = points['dataset'].unique().tolist()
-	annotation_additional_y = 0.00 
-	if grouping == 'dataset':
-		unique_groups = datasets
-		num_clusters = len(unique_groups)
-	elif grouping == 'target_region':
-		points['target_region'].fillna('N/A', inplace=True)
-		unique_groups = points['target_region'].unique().tolist()
-		num_clusters = len(unique_groups)
-	else:
-		if grouping == 'cluster':
-			annotation_additional_y = 0.025 # Necessary because legend items overlap with legend title (annotation) when there are many legend items
-		num_clusters = points['cluster_ATAC'].max()
-		unique_groups = points[grouping+'_ATAC'].unique().tolist()
-	
-	colors = generate_cluster_colors(len(unique_groups), grouping)
-	symbols = ['circle', 'square', 'cross', 'triangle-up', 'triangle-down', 'octagon', 'star', 'diamond']
-	
-	traces_tsne = OrderedDict()
-
-	legend_x = -.17
-	layout_width = 1100;
+	group_column = grouping
+	if grouping == 'target_region':
+		points['target_region'] = fill_missing_groups(points['target_region'], 'N/A')
+	elif grouping != 'dataset':
+		group_column = grouping+'_ATAC'
 
-	grouping_clustering = grouping
-	if grouping != 'dataset' and grouping != 'target_region':
-		layout_width = 1000;
-		legend_x = -.14
-		grouping_clustering = grouping+'_ATAC'
-
-	if tsne_outlier_bool:
-		top_x = points['tsne_x_ATAC'].quantile(0.999)
-		bottom_x = points['tsne_x_ATAC'].quantile(0.001) 
-		top_y = points['tsne_y_ATAC'].quantile(0.999)
-		bottom_y = points['tsne_y_ATAC'].quantile(0.001) 
-		
-	else:
-		top_x = points['tsne_x_ATAC'].max()
-		bottom_x = points['tsne_x_ATAC'].min()
-		top_y = points['tsne_y_ATAC'].max()
-		bottom_y = points['tsne_y_ATAC'].min()
-
-	range_x = top_x - bottom_x 
-	top_x = top_x + range_x * 0.1
-	bottom_x = bottom_x - range_x*0.1
-	range_y = top_y - bottom_y
-	top_y = top_y + range_y * 0.1
-	bottom_y = bottom_y - range_y*0.1
-
-	if len(points) > 3000: 
-		marker_size = 2
-	else:
-		marker_size = 4
-
-	## 2D tSNE coordinates ##
-	for i, group in enumerate(unique_groups):
-		points_group = points[points[grouping_clustering]==group]
-		if grouping_clustering.startswith('cluster'):
-			group_str = 'cluster_' + str(group)
-		elif grouping_clustering== "dataset":
-			group = group.strip('CEMBA_')
-			group_str = group
-		else:
-			group_str = group
-
-		color_num = i
-		
-		trace2d = traces_tsne.setdefault(color_num, Scatter(
-			x=list(),
-			y=list(),
-			text=list(),
-			mode='markers',
-			visible=True,
-			name=group_str,
-			legendgroup=group,
-			marker={
-				   'color': colors[color_num],
-				   'size': marker_size,
-				   #'symbol': symbols[datasets.index(dataset)],
-			},
-			hoverinfo='text'))
-		trace2d['x'] = points_group['tsne_x_ATAC'].values.tolist()
-		trace2d['y'] = points_group['tsne_y_ATAC'].values.tolist()
-		# for point in points_group.itertuples(index=False):  # Maybe there's a more elegant way to do this... EAM
-		# 	text = OrderedDict([('Cluster', point[4]),('Dataset', point[2]),])
-		# 	if point[3]!='Null':
-		# 		text['Annotation'] = point[3]
-		# 	if point[-1]!='None':
-		# 		text['RS2 Target Region'] = point[-1]
-		# 	trace2d['text'] = [build_hover_text(OrderedDict(text))]
-		trace2d['text'] = [build_hover_text(OrderedDict([('Annotation', point[3]),
-														 ('Cluster', point[4]),
-														 ('RS2 Target Region', point[-1]),
-														 ('Dataset', point[2]),]))
-						   for point in points_group.itertuples(index=False)]
-
-	### snATAC normalized counts scatter plot ### 
-	x = points['tsne_x_ATAC'].tolist()
-	y = points['tsne_y_ATAC'].tolist()
-	ATAC_counts = points['normalized_counts'].copy()
-	text_ATAC = [build_hover_text(OrderedDict([('Annotation', point[3]),
-											   ('Cluster', point[4]),
-											   ('RS2 Target Region', point[-1]),
-											   ('Dataset', point[2]),
-											   ('<b>Normalized Counts</b>', round(point[-2], 5)),]))
-				 for point in points.itertuples(index=False)]
-
-
-	ATAC_dataframe = pd.DataFrame(ATAC_counts)
-	start = ATAC_dataframe.dropna().quantile(ptile_start)[0].tolist()
-	end = ATAC_dataframe.dropna().quantile(ptile_end).values[0].tolist()
-	end = max(end,start+0.01)
-	ATAC_colors = [set_color_by_percentile(x, start, end) for x in ATAC_counts]
-
-	colorbar_tickval = list(arange(start, end, (end - start) / 4))
-	colorbar_tickval[0] = start
-	colorbar_tickval.append(end)
-	colorbar_ticktext = [
-		str(round(x, num_sigfigs_ticklabels)) for x in arange(start, end, (end - start) / 4)
-	]
-	colorbar_ticktext[0] = '<' + str(round(start, num_sigfigs_ticklabels))
-	colorbar_ticktext.append('>' + str(round(end, num_sigfigs_ticklabels)))
+	return {'points': points, 'title': title, 'grouping': grouping, 'group_column': group_column,
+			'sketch': quantile_sketch(points['normalized_counts'])}
 
-	trace_ATAC = Scatter(
-		mode='markers',
-		x=x,
-		y=y,
-		text=text_ATAC,
-		marker={
-			'color': ATAC_colors,
-			'colorscale': 'Viridis',
-			'size': marker_size,
-			'colorbar': {
-				'x': 1.05,
-				'len': 0.5,
-				'thickness': 10,
-				'title': 'Normalized Counts',
-				'titleside': 'right',
-				'tickmode': 'array',
-				'tickvals': colorbar_tickval,
-				'ticktext': colorbar_ticktext,
-				'tickfont': {'size': 10}
-			}
-		},
-		showlegend=False,
-		yaxis='y',
-		xaxis='x2',
-		hoverinfo='text')
+@cache.memoize(timeout=1800)
+def get_snATAC_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end, tsne_outlier_bool, smoothing=False, max_points='10000', module=None):
+	"""Generate scatter plot and gene body snATAC scatter plot using tSNE coordinates from methylation(snmC-seq) data.
 
-	layout = Layout(
-		autosize=True,
-		height=550,
-		width=layout_width,
-		# title=title,
-		# titlefont={'color': 'rgba(1,2,2,1)',
-		#            'size': 16},
-		legend={'x':legend_x,
-				'y':0.95,
-				'tracegroupgap': 0.5,
-				'bgcolor': 'rgba(0,0,0,0)'},
-		margin={'l': 0,
-				'r': 0,
-				'b': 30,
-				't': 130,},
-		xaxis={
-			'domain': [0, 0.49],
-			'type': 'linear',
-			'ticks': '',
-			'dtick': 10,
-			'tickwidth': 0,
-			'showticklabels': False,
-			'showline': True,
-			'showgrid': False,
-			'zeroline': False,
-			'linecolor': 'black',
-			'linewidth': 0.5,
-			'mirror': False,
-			'scaleanchor': 'x2',
-			'range':[bottom_x,top_x]
-		},
-		xaxis2={
-			'domain': [0.51, 1],
-			'type': 'linear',
-			'ticks': '',
-			'dtick': 10,
-			'tickwidth': 0,
-			'showticklabels': False,
-			'showline': True,
-			'showgrid': False,
-			'zeroline': False,
-			'linecolor': 'black',
-			'linewidth': 0.5,
-			'mirror': False,
-			'scaleanchor': 'y',
-			'range':[bottom_x,top_x]
-		},
-		yaxis={
-			'domain': [0,1],
-			'type': 'linear',
-			'ticks': '',
-			'dtick': 10,
-			'tickwidth': 0,
-			'showticklabels': False,
-			'showline': True,
-			'showgrid': False,
-			'side': 'right',
-			'zeroline': False,
-			'linecolor': 'black',
-			'linewidth': 0.5,
-			'mirror': False,
-			'range':[bottom_y,top_y]
-		},
-		hovermode='closest',)
+	Arguments:
+		ensemble (str): Name of ensemble.
+		tsne_type (str): Options for calculating tSNE. ndims = number of dimensions, perp = perplexity.
+		genes_query (str):  Ensembl ID of gene(s) separated by spaces.
+		grouping (str): Variable to group cells by. "cluster", "annotation", "dataset".
+		clustering (str): Different clustering algorithms and parameters. 'lv' = Louvain clustering.
+		ptile_start (float): Lower end of color percentile. [0, 1].
+		ptile_end (float): Upper end of color percentile. [0, 1].
+		tsne_outlier_bool (bool): Whether or not to change X and Y axes range to hide outliers. True = show outliers. 
+		module (str): Name of a gene module to plot instead of genes_query.
 
-	
-	fig = tools.make_subplots(
-			rows=1,
-			cols=2,
-			shared_xaxes=False,
-			shared_yaxes=True,
-			print_grid=False,
-			subplot_titles=("tSNE", "Normalized Counts"),
-			)
+	Returns:
+		str: HTML generated by Plot.ly.
+	"""
 
-	for trace in traces_tsne.items():
-		fig.append_trace(trace[1], 1,1)
-	fig.append_trace(trace_ATAC, 1,2)
-
-	fig['layout'].update(layout)
-	fig['layout']['annotations'].extend([Annotation(text=grouping.title(),
-													x=legend_x+0.05,
-													y=1.02 + annotation_additional_y,
-													xanchor="left",
-													yanchor="top",
-													showarrow=False,
-													xref="paper",
-													yref="paper",
-													font={'size': 12,
-														  'color': 'gray',})])
-	fig['layout']['annotations'].extend([Annotation(text=title,
-													x=0.5,
-													y=1.3,
-													xanchor="center",
-													yanchor="top",
-													showarrow=False,
-													xref="paper",
-													yref="paper",
-													font={'size': 16,
-														  'color': 'black',})])
-
-	return plotly.offline.plot(
-		figure_or_data=fig,
-		output_type='div',
-		show_link=False,
-		include_plotlyjs=False)
+	scatter = get_snATAC_scatter_points(ensemble, genes_query, grouping, smoothing, max_points, module)
+	return render_scatter(scatter['points'], counts_scatter_modality('ATAC'), scatter['grouping'], scatter['group_column'],
+						 scatter['title'], ptile_start, ptile_end, tsne_outlier_bool,
+						 bounds=get_embedding_bounds(ensemble, 'ATAC', 'snATAC'), sketch=scatter['sketch'])
 
 @cache.memoize(timeout=3600)
 def get_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row, query):
@@ -2840,17 +2350,25 @@ def get_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row
 	title = "Gene body snATAC normalized counts by cluster " + normal_or_original + ":<br>"
 	genes = query.split()
 
-	gene_info_df = pd.DataFrame()
 	gene_infos = get_gene_by_id(genes)
 	for i, gene in enumerate(gene_infos):
 		gene_name = gene['gene_name']
 		if i > 0 and i % 10 == 0:
 			title += "<br>"
 		title += gene_name + "+"
-		gene_info_df[gene_name] = mean_cluster(get_gene_snATAC(ensemble, gene['gene_id'], grouping, True), grouping, 'ATAC')
 
 	title = title[:-1] # Gets rid of last '+'
 
+	# Rows of the precomputed cluster means, see aggregates.
+	gene_info_df = None
+	if grouping in ['cluster', 'annotation']:
+		gene_info_df = get_aggregate_frame(ensemble, 'normalized_counts', grouping+'_ATAC',
+										   [gene['gene_id'] for gene in gene_infos], [gene['gene_name'] for gene in gene_infos])
+	if gene_info_df is None:
+		gene_info_df = pd.DataFrame()
+		for gene in gene_infos:
+			gene_info_df[gene['gene_name']] = mean_cluster(get_gene_snATAC(ensemble, gene['gene_id'], grouping, True), grouping, 'ATAC')
+
 	gene_info_df.reset_index(inplace=True)
 	if grouping == 'annotation':
 		gene_info_df['annotation_cat'] = pd.Categorical(gene_info_df['annotation_ATAC'], cluster_annotation_order)
@@ -2904,11 +2422,7 @@ def get_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row
 		text = []
 		i += 1
 
-	flat_snATAC_counts = list(chain.from_iterable(snATAC_counts))
-	snATAC_counts_dataframe = pd.DataFrame(flat_snATAC_counts).dropna()
-	start = snATAC_counts_dataframe.quantile(ptile_start).values[0].tolist()
-	end = snATAC_counts_dataframe.quantile(ptile_end).values[0].tolist()
-	end = max(end,start+0.01)
+	start, end = sketch_range(quantile_sketch(list(chain.from_iterable(snATAC_counts))), ptile_start, ptile_end)
 
 	colorbar_tickval = list(arange(start, end, (end - start) / 4))
 	colorbar_tickval[0] = start
@@ -2932,7 +2446,7 @@ def get_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row
 		else:
 			colorbar_ticktext.insert(0, '<' + str(round(start, num_sigfigs_ticklabels)))
 
-	trace = Heatmap(
+	trace = go.Heatmap(
 		x=x,
 		y=y,
 		z=snATAC_counts,
@@ -2953,7 +2467,7 @@ def get_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row
 		zmin=start,zmax=end,zauto=False, # Clip the extreme edges of the colorscale
 		)
 
-	layout = Layout(
+	layout = go.Layout(
 		autosize=True,
 		height=max(600*len(genes)/20,550), # EAM Adjust the height of the heatmap according to the number of genes displayed
 		width=1000,
@@ -3040,7 +2554,7 @@ def get_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row
 
 	layout['updatemenus'] = updatemenus
 
-	layout['annotations'].extend([Annotation(text=title,
+	layout['annotations'].extend([go.Annotation(text=title,
 											 x=0.5,
 											 y=1.4,
 											 xanchor="center",
@@ -3052,7 +2566,7 @@ def get_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row
 												   'color': 'black',})])
 
 
-	return plotly.offline.plot(
+	return timed('serialize', plotly.offline.plot,
 		{
 			'data': [trace],
 			'layout': layout
@@ -3081,89 +2595,95 @@ def get_snATAC_box(ensemble, gene, grouping, outliers):
 	# print("Running get_snATAC_box: {}".format(str(now)))
 	# sys.stdout.flush()
 
-	points = get_gene_snATAC(ensemble, gene, grouping, outliers)
+	# snATAC ensembles are always grouped by cluster
+	x_label = 'cluster_ATAC'
+	data = get_summary_box_traces(ensemble, 'snATAC', gene, 'normalized_counts', 'cluster', 'cluster_ATAC', outliers)
 
-	if points is None:
-		raise FailToGraphException
-	grouping = 'cluster'
-	grouping += "_ATAC"
-	name_prepend="cluster_"
-	unique_groups = points[grouping].unique()
-	x_label = grouping
+	if data is None:
+		points = get_gene_snATAC(ensemble, gene, grouping, outliers)
 
-	traces = OrderedDict()
-	# if grouping == "dataset":
-	# 	unique_groups = points["dataset"].unique()
-	# elif grouping == 'target_region':
-	# 	points['target_region'].fillna('N/A', inplace=True)
-	# 	unique_groups = points['target_region'].unique()
-	# elif grouping == 'slice':
-	# 	datasets_all_cells = points['dataset'].tolist()
-	# 	slices_list = [d.split('_')[1] if 'RS2' not in d else d.split('_')[2][2:4] for d in datasets_all_cells]
-	# 	points['slice'] = slices_list
-	# 	slices_set = set(slices_list)
-	# 	unique_groups = np.array(list(slices_set))
-	# elif grouping == 'sex':
-	# 	unique_groups = points['sex'].unique()
-	# elif grouping == 'cluster' or grouping == 'annotation':
-	# 	unique_groups = points[grouping+'_'+clustering].unique()
-	# else:
-	# 	grouping = 'cluster'
-	# 	unique_groups = points[grouping+'_'+clustering].unique()
-	num_clusters = len(unique_groups)
-
-	# name_prepend = ""
-	# x_label = grouping
-	# if grouping != "dataset" or grouping != "target_region":
-	# 	if grouping == "cluster":
-	# 		name_prepend="cluster_"
-	# 	grouping += "_ATAC"
-	if outliers:
-		boxpoints='suspectedoutliers';
-	else:
-		boxpoints=False
-
-	colors = generate_cluster_colors(num_clusters, grouping)
-	# for point in points.to_dict('records'):
-	# 	name_prepend = ""
-	# 	if grouping == "dataset" or grouping == 'target_region' or grouping == 'slice' or grouping == 'sex':
-	# 		color = colors[int(np.where(unique_groups==point[grouping])[0]) % len(colors)]
-	# 		group = point[grouping]
-	# 	else:
-	# 		if grouping == "cluster":
-	# 			name_prepend="cluster_"
-	# 		color = colors[int(np.where(unique_groups==point[grouping+'_'+clustering])[0]) % len(colors)]
-	# 		group = point[grouping+'_'+clustering]
-	# 	if outliers:
-	# 		boxpoints='suspectedoutliers';
-	# 	else:
-	# 		boxpoints=False	
-	for point in points.to_dict('records'):
-		color = colors[int(np.where(unique_groups==point[grouping])[0]) % len(colors)]
-		group = point[grouping]
-		# if grouping == "dataset" or grouping == 'target_region' or grouping == 'slice' or grouping == 'sex':
-		# 	color = colors[int(np.where(unique_groups==point[grouping])[0]) % len(colors)]
-		# 	group = point[grouping]
+		if points is None:
+			raise FailToGraphException
+		grouping = 'cluster'
+		grouping += "_ATAC"
+		name_prepend="cluster_"
+		unique_groups = points[grouping].unique()
+		x_label = grouping
+
+		traces = OrderedDict()
+		# if grouping == "dataset":
+		# 	unique_groups = points["dataset"].unique()
+		# elif grouping == 'target_region':
+		# 	points['target_region'].fillna('N/A', inplace=True)
+		# 	unique_groups = points['target_region'].unique()
+		# elif grouping == 'slice':
+		# 	datasets_all_cells = points['dataset'].tolist()
+		# 	slices_list = [d.split('_')[1] if 'RS2' not in d else d.split('_')[2][2:4] for d in datasets_all_cells]
+		# 	points['slice'] = slices_list
+		# 	slices_set = set(slices_list)
+		# 	unique_groups = np.array(list(slices_set))
+		# elif grouping == 'sex':
+		# 	unique_groups = points['sex'].unique()
+		# elif grouping == 'cluster' or grouping == 'annotation':
+		# 	unique_groups = points[grouping+'_'+clustering].unique()
 		# else:
-		# 	color = colors[int(np.where(unique_groups==point[grouping])[0]) % len(colors)]
-		# 	group = point[grouping]
-		trace = traces.setdefault(group, Box(
-				y=list(),
-				name=name_prepend + str(group),
-				marker={
-					'color': color,
-					'outliercolor': color,
-					'size': 6
-				},
-				boxpoints=boxpoints,
-				visible=True,
-				showlegend=False,
-				))
-		trace['y'].append(point['normalized_counts'])
+		# 	grouping = 'cluster'
+		# 	unique_groups = points[grouping+'_'+clustering].unique()
+		num_clusters = len(unique_groups)
+
+		# name_prepend = ""
+		# x_label = grouping
+		# if grouping != "dataset" or grouping != "target_region":
+		# 	if grouping == "cluster":
+		# 		name_prepend="cluster_"
+		# 	grouping += "_ATAC"
+		if outliers:
+			boxpoints='suspectedoutliers';
+		else:
+			boxpoints=False
+
+		colors = generate_cluster_colors(num_clusters, grouping)
+		# for point in points.to_dict('records'):
+		# 	name_prepend = ""
+		# 	if grouping == "dataset" or grouping == 'target_region' or grouping == 'slice' or grouping == 'sex':
+		# 		color = colors[int(np.where(unique_groups==point[grouping])[0]) % len(colors)]
+		# 		group = point[grouping]
+		# 	else:
+		# 		if grouping == "cluster":
+		# 			name_prepend="cluster_"
+		# 		color = colors[int(np.where(unique_groups==point[grouping+'_'+clustering])[0]) % len(colors)]
+		# 		group = point[grouping+'_'+clustering]
+		# 	if outliers:
+		# 		boxpoints='suspectedoutliers';
+		# 	else:
+		# 		boxpoints=False	
+		for point in points.to_dict('records'):
+			color = colors[int(np.where(unique_groups==point[grouping])[0]) % len(colors)]
+			group = point[grouping]
+			# if grouping == "dataset" or grouping == 'target_region' or grouping == 'slice' or grouping == 'sex':
+			# 	color = colors[int(np.where(unique_groups==point[grouping])[0]) % len(colors)]
+			# 	group = point[grouping]
+			# else:
+			# 	color = colors[int(np.where(unique_groups==point[grouping])[0]) % len(colors)]
+			# 	group = point[grouping]
+			trace = traces.setdefault(group, go.Box(
+					y=list(),
+					name=name_prepend + str(group),
+					marker={
+						'color': color,
+						'outliercolor': color,
+						'size': 6
+					},
+					boxpoints=boxpoints,
+					visible=True,
+					showlegend=False,
+					))
+			trace['y'].append(point['normalized_counts'])
+		data = list(traces.values())
 
 	gene_name = get_gene_by_id([ gene ])[0]['gene_name']
 
-	layout = Layout(
+	layout = go.Layout(
 		autosize=True,
 		height=450,
 		width=1000,
@@ -3213,9 +2733,9 @@ def get_snATAC_box(ensemble, gene, grouping, outliers):
 		},
 	)
 	
-	return plotly.offline.plot(
+	return timed('serialize', plotly.offline.plot,
 		{
-			'data': list(traces.values()),
+			'data': data,
 			'layout': layout
 		},
 		output_type='div',
@@ -3265,7 +2785,7 @@ def get_gene_RNA(ensemble, gene, grouping, outliers, max_points='10000'):
 		query = query+" ORDER BY RAND() LIMIT %(max_points)s" % {'max_points': max_points}
 
 	try:
-		df = pd.read_sql(query, db.get_engine(current_app, 'RNA_data'))
+		df = read_frame(query, db.get_engine(current_app, 'RNA_data'))
 	except exc.ProgrammingError as e:
 		now = datetime.datetime.now()
 		print("[{}] ERROR in app(get_gene_RNA): {}".format(str(now), e))
@@ -3278,11 +2798,9 @@ def get_gene_RNA(ensemble, gene, grouping, outliers, max_points='10000'):
 		sys.stdout.flush()
 		return None
 
+	df = compact_cells(df)
 	if grouping == 'annotation':
-		df.fillna({'annotation_RNA': 'None'}, inplace=True)
-		df['annotation_cat'] = pd.Categorical(df['annotation_RNA'], cluster_annotation_order)
-		df.sort_values(by='annotation_cat', inplace=True)
-		df.drop('annotation_cat', axis=1, inplace=True)
+		df = sort_cells_by_annotation(df, 'annotation_RNA', cluster_annotation_order)
 	elif grouping == 'cluster':
 		df.sort_values(by='cluster_RNA', inplace=True)
 
@@ -3321,84 +2839,83 @@ def get_mult_gene_RNA(ensemble, genes, grouping, max_points='10000'):
 
 	gene_table_names = ['gene_' + gene_id[0].replace('.','_') for gene_id in result]
 
-	df_all = pd.DataFrame()
-	
-	first = True
-	for gene_table_name in gene_table_names:
-		query = "SELECT cells.cell_id, cells.cell_name, cells.dataset, \
-			%(ensemble)s.annotation_RNA, %(ensemble)s.cluster_RNA, \
-			%(ensemble)s.tsne_x_RNA, %(ensemble)s.tsne_y_RNA, \
-			%(gene_table_name)s.normalized_counts, \
-			datasets.target_region \
-			FROM cells \
-			INNER JOIN %(ensemble)s ON cells.cell_id = %(ensemble)s.cell_id \
-			LEFT JOIN %(gene_table_name)s ON %(ensemble)s.cell_id = %(gene_table_name)s.cell_id \
-			LEFT JOIN datasets ON cells.dataset = datasets.dataset" % {'ensemble': ensemble, 
-																	   'gene_table_name': gene_table_name}
-		if max_points.isdigit():
-			query = query+" ORDER BY RAND() LIMIT %(max_points)s()" % {'max_points': max_points}
+	if not gene_table_names:
+		return None
 
-		try:
-			df_all = df_all.append(pd.read_sql(query, db.get_engine(current_app, 'RNA_data')))
-		except exc.ProgrammingError as e:
-			now = datetime.datetime.now()
-			print("[{}] ERROR in app(get_mult_gene_RNA): {}".format(str(now), e))
-			sys.stdout.flush()
-			return None
-		
-		if first:
-			df_coords = df_all
-		first = False
+	query = "SELECT cells.cell_id, cells.cell_name, cells.dataset, \
+		%(ensemble)s.annotation_RNA, %(ensemble)s.cluster_RNA, \
+		%(ensemble)s.tsne_x_RNA, %(ensemble)s.tsne_y_RNA, \
+		%(gene_table_name)s.normalized_counts, \
+		datasets.target_region \
+		FROM cells \
+		INNER JOIN %(ensemble)s ON cells.cell_id = %(ensemble)s.cell_id \
+		LEFT JOIN %(gene_table_name)s ON %(ensemble)s.cell_id = %(gene_table_name)s.cell_id \
+		LEFT JOIN datasets ON cells.dataset = datasets.dataset" % {'ensemble': ensemble, 
+																   'gene_table_name': gene_table_names[0]}
+	if max_points.isdigit():
+		query = query+" ORDER BY RAND() LIMIT %(max_points)s" % {'max_points': max_points}
 
-	if df_all.empty: # If no data in column, return None 
+	try:
+		df_coords = read_frame(query, db.get_engine(current_app, 'RNA_data'))
+	except exc.ProgrammingError as e:
 		now = datetime.datetime.now()
-		print("[{}] ERROR in app(get_gene_RNA): No RNA data for {}".format(str(now), ensemble))
+		print("[{}] ERROR in app(get_mult_gene_RNA): {}".format(str(now), e))
 		sys.stdout.flush()
 		return None
 
-	df_all['normalized_counts'].fillna(0, inplace=True)
-
-	df_avg_methylation = df_all.groupby(by='cell_id', as_index=False)['normalized_counts'].mean()
-	df_coords.update(df_avg_methylation)
-
+	if df_coords.empty: # If no data in column, return None 
+		now = datetime.datetime.now()
+		print("[{}] ERROR in app(get_gene_RNA): No RNA data for {}".format(str(now), ensemble))
+		sys.stdout.flush()
+		return None
+	cell_ids = df_coords['cell_id'].values
+	# The other genes only need their counts for the cells of the first gene.
+	df_genes = gather(*[ (get_gene_of_cells, ensemble, gene_table_name, ['normalized_counts'],
+		cell_ids if max_points.isdigit() else None, 'RNA_data') for gene_table_name in gene_table_names[1:] ])
+
+	# Cells x genes, missing counts are 0 like for a single gene.
+	counts = np.zeros((len(df_coords), len(gene_table_names)), dtype=np.float32)
+	counts[:, 0] = pd.to_numeric(df_coords['normalized_counts']).fillna(0).values
+	for i, df_gene in enumerate(df_genes, 1):
+		if df_gene is None:
+			continue
+		counts[:, i] = np.nan_to_num(align_gene_values(cell_ids, df_gene['cell_id'].values, df_gene['normalized_counts'].values))
+
+	df_coords['normalized_counts'] = counts.mean(axis=1, dtype=np.float64)
+
+	df_coords = compact_cells(df_coords)
 	if grouping == 'annotation':
-		df_coords.fillna({'annotation_RNA': 'None'}, inplace=True)
-		df_coords['annotation_cat'] = pd.Categorical(df_coords['annotation_RNA'], cluster_annotation_order)
-		df_coords.sort_values(by='annotation_cat', inplace=True)
-		df_coords.drop('annotation_cat', axis=1, inplace=True)
+		df_coords = sort_cells_by_annotation(df_coords, 'annotation_RNA', cluster_annotation_order)
 	elif grouping == 'cluster':
 		df_coords.sort_values(by='cluster_RNA', inplace=True)
 	return df_coords
 
 @cache.memoize(timeout=1800)
-def get_RNA_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end, tsne_outlier_bool):
-	"""Generate RNA scatter plot using tSNE coordinates from methylation(snmC-seq) data.
+def get_RNA_scatter_points(ensemble, genes_query, grouping, max_points='10000', module=None):
+	"""Fetch the cells of an RNA scatter plot and sketch the quantiles of their values.
 
-	Arguments:
-		ensemble (str): Name of ensemble.
-		tsne_type (str): Options for calculating tSNE. ndims = number of dimensions, perp = perplexity.
-		genes_query (str):  Ensembl ID of gene(s) separated by spaces.
-		grouping (str): Variable to group cells by. "cluster", "annotation", "dataset".
-		clustering (str): Different clustering algorithms and parameters. 'lv' = Louvain clustering.
-		ptile_start (float): Lower end of color percentile. [0, 1].
-		ptile_end (float): Upper end of color percentile. [0, 1].
-		tsne_outlier_bool (bool): Whether or not to change X and Y axes range to hide outliers. True = show outliers. 
+	The color percentiles are not arguments, so moving the percentile slider reuses the cells and the sketch.
+	Given a module, the genes of the module are plotted instead of genes_query and the points are cached per module.
 
 	Returns:
-		str: HTML generated by Plot.ly.
+		dict: points, title, grouping (falls back to "cluster" without annotations), group_column and sketch
+			(see quantiles).
 	"""
 
+	if module is not None:
+		genes_query = get_module_genes_query(module)
+		if genes_query is None:
+			raise FailToGraphException
 	genes = genes_query.split()
 
 	gene_name_str = ""
-	x, y, text, mch = list(), list(), list(), list()
 
 	if len(genes) == 1:
-		points = get_gene_RNA(ensemble, genes[0], grouping, True)
+		points = get_gene_RNA(ensemble, genes[0], grouping, True, max_points)
 		gene_name = get_gene_by_id([ genes[0] ])[0]['gene_name']
 		title = 'Gene body RNA normalized counts: ' + gene_name
 	else:
-		points = get_mult_gene_RNA(ensemble, genes, grouping)
+		points = get_mult_gene_RNA(ensemble, genes, grouping, max_points)
 		gene_infos = get_gene_by_id(genes)
 		for i, gene in enumerate(gene_infos):
 			if i > 0 and i % 10 == 0:
@@ -3406,6 +2923,8 @@ def get_RNA_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end, tsn
 			gene_name_str += gene['gene_name'] + '+'
 		gene_name_str = gene_name_str[:-1]
 		title = 'Avg. Gene body RNA normalized counts: <br>' + gene_name_str
+	if module is not None:
+		title = module_title('Gene body RNA normalized counts', module, genes)
 
 	if points is None:
 		raise FailToGraphException
@@ -3415,258 +2934,43 @@ def get_RNA_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end, tsn
 		if grouping+'_RNA' not in points.columns: # If no cluster annotations available, group by cluster number instead
 			grouping = "cluster"
 			if len(genes) == 1:
-				points = get_gene_RNA(ensemble, genes[0], grouping, True)
+				points = get_gene_RNA(ensemble, genes[0], grouping, True, max_points)
 			else:
-				points = get_mult_gene_RNA(ensemble, genes, grouping)
+				points = get_mult_gene_RNA(ensemble, genes, grouping, max_points)
 			print("**** Grouping by cluster")
 
-	datasets = points['dataset'].unique().tolist()
-	annotation_additional_y = 0.00 
-	if grouping == 'dataset':
-		unique_groups = datasets
-		num_clusters = len(unique_groups)
-	elif grouping == 'target_region':
-		points['target_region'].fillna('N/A', inplace=True)
-		unique_groups = points['target_region'].unique().tolist()
-		num_clusters = len(unique_groups)
-	else:
-		if grouping == 'cluster':
-			annotation_additional_y = 0.025 # Necessary because legend items overlap with legend title (annotation) when there are many legend items
-		num_clusters = points['cluster_RNA'].max()
-		unique_groups = points[grouping+'_RNA'].unique().tolist()
-	
-	colors = generate_cluster_colors(len(unique_groups), grouping)
-	symbols = ['circle', 'square', 'cross', 'triangle-up', 'triangle-down', 'octagon', 'star', 'diamond']
-	
-	traces_tsne = OrderedDict()
+	group_column = grouping
+	if grouping == 'target_region':
+		points['target_region'] = fill_missing_groups(points['target_region'], 'N/A')
+	elif grouping != 'dataset':
+		group_column = grouping+'_RNA'
 
-	legend_x = -.17
-	layout_width = 1100;
+	return {'points': points, 'title': title, 'grouping': grouping, 'group_column': group_column,
+			'sketch': quantile_sketch(points['normalized_counts'])}
 
-	grouping_clustering = grouping
-	if grouping != 'dataset' and grouping != 'target_region':
-		layout_width = 1000;
-		legend_x = -.14
-		grouping_clustering = grouping+'_RNA'
-
-	if tsne_outlier_bool:
-		top_x = points['tsne_x_RNA'].quantile(0.999)
-		bottom_x = points['tsne_x_RNA'].quantile(0.001) 
-		top_y = points['tsne_y_RNA'].quantile(0.999)
-		bottom_y = points['tsne_y_RNA'].quantile(0.001) 
-		
-	else:
-		top_x = points['tsne_x_RNA'].max()
-		bottom_x = points['tsne_x_RNA'].min()
-		top_y = points['tsne_y_RNA'].max()
-		bottom_y = points['tsne_y_RNA'].min()
-
-	range_x = top_x - bottom_x 
-	top_x = top_x + range_x * 0.1
-	bottom_x = bottom_x - range_x*0.1
-	range_y = top_y - bottom_y
-	top_y = top_y + range_y * 0.1
-	bottom_y = bottom_y - range_y*0.1
-
-	if len(points) > 3000: 
-		marker_size = 2
-	else:
-		marker_size = 4
-
-	## 2D tSNE coordinates ##
-	for i, group in enumerate(unique_groups):
-		points_group = points[points[grouping_clustering]==group]
-		if grouping_clustering.startswith('cluster'):
-			group_str = 'cluster_' + str(group)
-		elif grouping_clustering== "dataset":
-			group = group.strip('CEMBA_')
-			group_str = group
-		else:
-			group_str = group
-
-		color_num = i
-		
-		trace2d = traces_tsne.setdefault(color_num, Scatter(
-			x=list(),
-			y=list(),
-			text=list(),
-			mode='markers',
-			visible=True,
-			name=group_str,
-			legendgroup=group,
-			marker={
-				   'color': colors[color_num],
-				   'size': marker_size,
-				   #'symbol': symbols[datasets.index(dataset)],
-			},
-			hoverinfo='text'))
-		trace2d['x'] = points_group['tsne_x_RNA'].values.tolist()
-		trace2d['y'] = points_group['tsne_y_RNA'].values.tolist()
-		trace2d['text'] = [build_hover_text(OrderedDict([('Annotation', point[3]),
-														 ('Cluster', point[4]),
-														 ('RS2 Target Region', point[-1]),
-														 ('Dataset', point[2]),]))
-						   for point in points_group.itertuples(index=False)]
-
-	### RNA normalized counts scatter plot ### 
-	x = points['tsne_x_RNA'].tolist()
-	y = points['tsne_y_RNA'].tolist()
-	RNA_counts = points['normalized_counts'].copy()
-	text_RNA = [build_hover_text(OrderedDict([('Annotation', point[3]),
-											   ('Cluster', point[4]),
-											   ('RS2 Target Region', point[-1]),
-											   ('Dataset', point[2]),
-											   ('<b>Normalized Counts</b>', round(point[-2], 5)),]))
-				 for point in points.itertuples(index=False)]
-
-
-	RNA_dataframe = pd.DataFrame(RNA_counts)
-	start = RNA_dataframe.dropna().quantile(ptile_start)[0].tolist()
-	end = RNA_dataframe.dropna().quantile(ptile_end).values[0].tolist()
-	end = max(end,start+0.01)
-	RNA_colors = [set_color_by_percentile(x, start, end) for x in RNA_counts]
-
-	colorbar_tickval = list(arange(start, end, (end - start) / 4))
-	colorbar_tickval[0] = start
-	colorbar_tickval.append(end)
-	colorbar_ticktext = [
-		str(round(x, num_sigfigs_ticklabels)) for x in arange(start, end, (end - start) / 4)
-	]
-	colorbar_ticktext[0] = '<' + str(round(start, num_sigfigs_ticklabels))
-	colorbar_ticktext.append('>' + str(round(end, num_sigfigs_ticklabels)))
-
-	trace_RNA = Scatter(
-		mode='markers',
-		x=x,
-		y=y,
-		text=text_RNA,
-		marker={
-			'color': RNA_colors,
-			'colorscale': 'Viridis',
-			'size': marker_size,
-			'colorbar': {
-				'x': 1.05,
-				'len': 0.5,
-				'thickness': 10,
-				'title': 'Normalized Counts',
-				'titleside': 'right',
-				'tickmode': 'array',
-				'tickvals': colorbar_tickval,
-				'ticktext': colorbar_ticktext,
-				'tickfont': {'size': 10}
-			}
-		},
-		showlegend=False,
-		yaxis='y',
-		xaxis='x2',
-		hoverinfo='text')
+@cache.memoize(timeout=1800)
+def get_RNA_scatter(ensemble, genes_query, grouping, ptile_start, ptile_end, tsne_outlier_bool, max_points='10000', module=None):
+	"""Generate RNA scatter plot using tSNE coordinates from methylation(snmC-seq) data.
 
-	layout = Layout(
-		autosize=True,
-		height=550,
-		width=layout_width,
-		# title=title,
-		# titlefont={'color': 'rgba(1,2,2,1)',
-		#            'size': 16},
-		legend={'x':legend_x,
-				'y':0.95,
-				'tracegroupgap': 0.5,
-				'bgcolor': 'rgba(0,0,0,0)'},
-		margin={'l': 0,
-				'r': 0,
-				'b': 30,
-				't': 130,},
-		xaxis={
-			'domain': [0, 0.49],
-			'type': 'linear',
-			'ticks': '',
-			'dtick': 10,
-			'tickwidth': 0,
-			'showticklabels': False,
-			'showline': True,
-			'showgrid': False,
-			'zeroline': False,
-			'linecolor': 'black',
-			'linewidth': 0.5,
-			'mirror': False,
-			'scaleanchor': 'x2',
-			'range':[bottom_x,top_x]
-		},
-		xaxis2={
-			'domain': [0.51, 1],
-			'type': 'linear',
-			'ticks': '',
-			'dtick': 10,
-			'tickwidth': 0,
-			'showticklabels': False,
-			'showline': True,
-			'showgrid': False,
-			'zeroline': False,
-			'linecolor': 'black',
-			'linewidth': 0.5,
-			'mirror': False,
-			'scaleanchor': 'y',
-			'range':[bottom_x,top_x]
-		},
-		yaxis={
-			'domain': [0,1],
-			'type': 'linear',
-			'ticks': '',
-			'dtick': 10,
-			'tickwidth': 0,
-			'showticklabels': False,
-			'showline': True,
-			'showgrid': False,
-			'side': 'right',
-			'zeroline': False,
-			'linecolor': 'black',
-			'linewidth': 0.5,
-			'mirror': False,
-			'range':[bottom_y,top_y]
-		},
-		hovermode='closest',)
+	Arguments:
+		ensemble (str): Name of ensemble.
+		tsne_type (str): Options for calculating tSNE. ndims = number of dimensions, perp = perplexity.
+		genes_query (str):  Ensembl ID of gene(s) separated by spaces.
+		grouping (str): Variable to group cells by. "cluster", "annotation", "dataset".
+		clustering (str): Different clustering algorithms and parameters. 'lv' = Louvain clustering.
+		ptile_start (float): Lower end of color percentile. [0, 1].
+		ptile_end (float): Upper end of color percentile. [0, 1].
+		tsne_outlier_bool (bool): Whether or not to change X and Y axes range to hide outliers. True = show outliers. 
+		module (str): Name of a gene module to plot instead of genes_query.
 
-	
-	fig = tools.make_subplots(
-			rows=1,
-			cols=2,
-			shared_xaxes=False,
-			shared_yaxes=True,
-			print_grid=False,
-			subplot_titles=("tSNE", "Normalized Counts"),
-			)
+	Returns:
+		str: HTML generated by Plot.ly.
+	"""
 
-	for trace in traces_tsne.items():
-		fig.append_trace(trace[1], 1,1)
-	fig.append_trace(trace_RNA, 1,2)
-
-	fig['layout'].update(layout)
-	fig['layout']['annotations'].extend([Annotation(text=grouping.title(),
-													x=legend_x+0.05,
-													y=1.02 + annotation_additional_y,
-													xanchor="left",
-													yanchor="top",
-													showarrow=False,
-													xref="paper",
-													yref="paper",
-													font={'size': 12,
-														  'color': 'gray',})])
-	fig['layout']['annotations'].extend([Annotation(text=title,
-													x=0.5,
-													y=1.3,
-													xanchor="center",
-													yanchor="top",
-													showarrow=False,
-													xref="paper",
-													yref="paper",
-													font={'size': 16,
-														  'color': 'black',})])
-
-	return plotly.offline.plot(
-		figure_or_data=fig,
-		output_type='div',
-		show_link=False,
-		include_plotlyjs=False)
+	scatter = get_RNA_scatter_points(ensemble, genes_query, grouping, max_points, module)
+	return render_scatter(scatter['points'], counts_scatter_modality('RNA'), scatter['grouping'], scatter['group_column'],
+						 scatter['title'], ptile_start, ptile_end, tsne_outlier_bool,
+						 bounds=get_embedding_bounds(ensemble, 'RNA', 'RNA'), sketch=scatter['sketch'])
 
 @cache.memoize(timeout=3600)
 def get_RNA_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row, query):
@@ -3692,17 +2996,25 @@ def get_RNA_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row, q
 	title = "Gene body RNA normalized counts by cluster " + normal_or_original + ":<br>"
 	genes = query.split()
 
-	gene_info_df = pd.DataFrame()
 	gene_infos = get_gene_by_id(genes)
 	for i, gene in enumerate(gene_infos):
 		gene_name = gene['gene_name']
 		if i > 0 and i % 10 == 0:
 			title += "<br>"
 		title += gene_name + "+"
-		gene_info_df[gene_name] = mean_cluster(get_gene_RNA(ensemble, gene['gene_id'], grouping, True), grouping, 'RNA')
 
 	title = title[:-1] # Gets rid of last '+'
 
+	# Rows of the precomputed cluster means, see aggregates.
+	gene_info_df = None
+	if grouping in ['cluster', 'annotation']:
+		gene_info_df = get_aggregate_frame(ensemble, 'normalized_counts', grouping+'_RNA',
+										   [gene['gene_id'] for gene in gene_infos], [gene['gene_name'] for gene in gene_infos])
+	if gene_info_df is None:
+		gene_info_df = pd.DataFrame()
+		for gene in gene_infos:
+			gene_info_df[gene['gene_name']] = mean_cluster(get_gene_RNA(ensemble, gene['gene_id'], grouping, True), grouping, 'RNA')
+
 	gene_info_df.reset_index(inplace=True)
 	if grouping == 'annotation':
 		gene_info_df['annotation_cat'] = pd.Categorical(gene_info_df['annotation_RNA'], cluster_annotation_order)
@@ -3756,11 +3068,7 @@ def get_RNA_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row, q
 		text = []
 		i += 1
 
-	flat_RNA_counts = list(chain.from_iterable(RNA_counts))
-	RNA_counts_dataframe = pd.DataFrame(flat_RNA_counts).dropna()
-	start = RNA_counts_dataframe.quantile(ptile_start).values[0].tolist()
-	end = RNA_counts_dataframe.quantile(ptile_end).values[0].tolist()
-	end = max(end,start+0.01)
+	start, end = sketch_range(quantile_sketch(list(chain.from_iterable(RNA_counts))), ptile_start, ptile_end)
 
 	colorbar_tickval = list(arange(start, end, (end - start) / 4))
 	colorbar_tickval[0] = start
@@ -3784,7 +3092,7 @@ def get_RNA_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row, q
 		else:
 			colorbar_ticktext.insert(0, '<' + str(round(start, num_sigfigs_ticklabels)))
 
-	trace = Heatmap(
+	trace = go.Heatmap(
 		x=x,
 		y=y,
 		z=RNA_counts,
@@ -3805,7 +3113,7 @@ def get_RNA_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row, q
 		zmin=start,zmax=end,zauto=False, # Clip the extreme edges of the colorscale
 		)
 
-	layout = Layout(
+	layout = go.Layout(
 		autosize=True,
 		height=max(600*len(genes)/20,550), # EAM Adjust the height of the heatmap according to the number of genes displayed
 		width=1000,
@@ -3892,7 +3200,7 @@ def get_RNA_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row, q
 
 	layout['updatemenus'] = updatemenus
 
-	layout['annotations'].extend([Annotation(text=title,
+	layout['annotations'].extend([go.Annotation(text=title,
 											 x=0.5,
 											 y=1.4,
 											 xanchor="center",
@@ -3904,7 +3212,7 @@ def get_RNA_heatmap(ensemble, grouping, ptile_start, ptile_end, normalize_row, q
 												   'color': 'black',})])
 
 
-	return plotly.offline.plot(
+	return timed('serialize', plotly.offline.plot,
 		{
 			'data': [trace],
 			'layout': layout
@@ -3928,60 +3236,73 @@ def get_RNA_box(ensemble, gene, grouping, outliers):
 	Returns:
 		str: HTML generated by Plot.ly.
 	"""
-	points = get_gene_RNA(ensemble, gene, grouping, outliers)
+	# Precomputed summaries of every cell, see box_stats. Groupings by dataset and ensembles which have not
+	# been summarised yet are plotted from a sample of the cells.
+	data = None
+	x_label = grouping
+	if grouping == 'annotation':
+		data = get_summary_box_traces(ensemble, 'RNA', gene, 'normalized_counts', grouping, 'annotation_RNA', outliers)
+	if data is None and grouping in ['cluster', 'annotation']:
+		data = get_summary_box_traces(ensemble, 'RNA', gene, 'normalized_counts', 'cluster', 'cluster_RNA', outliers)
+		if data is not None:
+			x_label = 'cluster'
 
-	if points is None:
-		raise FailToGraphException
+	if data is None:
+		points = get_gene_RNA(ensemble, gene, grouping, outliers)
 
-	if grouping == "dataset":
-		unique_groups = points["dataset"].unique()
-	elif grouping == "target_region":
-		points['target_region'].fillna('N/A', inplace=True)
-		unique_groups = points["target_region"].unique()
-	elif grouping == 'annotation' or grouping == 'cluster':
-		if grouping == 'annotation' and grouping+'_RNA' not in points.columns: # If no cluster annotations available, group by cluster number instead
-			grouping = "cluster"
-			points = get_gene_RNA(ensemble, gene, grouping, outliers)
-			print("**** Grouping by cluster")
-		unique_groups = points[grouping+'_RNA'].unique()
-	else: 
-		raise FailToGraphException
+		if points is None:
+			raise FailToGraphException
 
-	num_clusters = len(unique_groups)
-	colors = generate_cluster_colors(num_clusters, grouping)
+		if grouping == "dataset":
+			unique_groups = points["dataset"].unique()
+		elif grouping == "target_region":
+			points['target_region'] = fill_missing_groups(points['target_region'], 'N/A')
+			unique_groups = points["target_region"].unique()
+		elif grouping == 'annotation' or grouping == 'cluster':
+			if grouping == 'annotation' and grouping+'_RNA' not in points.columns: # If no cluster annotations available, group by cluster number instead
+				grouping = "cluster"
+				points = get_gene_RNA(ensemble, gene, grouping, outliers)
+				print("**** Grouping by cluster")
+			unique_groups = points[grouping+'_RNA'].unique()
+		else: 
+			raise FailToGraphException
 
-	name_prepend = ""
-	x_label = grouping
-	if grouping != "dataset" or grouping != "target_region":
-		if grouping == "cluster":
-			name_prepend="cluster_"
-		grouping += "_RNA"
-	if outliers:
-		boxpoints='suspectedoutliers';
-	else:
-		boxpoints=False
-
-	traces = OrderedDict()
-	for point in points.to_dict('records'):
-		color = colors[int(np.where(unique_groups==point[grouping])[0]) % len(colors)]
-		group = point[grouping]
-		trace = traces.setdefault(group, Box(
-				y=list(),
-				name=name_prepend + str(group),
-				marker={
-					'color': color,
-					'outliercolor': color,
-					'size': 6
-				},
-				boxpoints=boxpoints,
-				visible=True,
-				showlegend=False,
-				))
-		trace['y'].append(point['normalized_counts'])
+		num_clusters = len(unique_groups)
+		colors = generate_cluster_colors(num_clusters, grouping)
+
+		name_prepend = ""
+		x_label = grouping
+		if grouping != "dataset" or grouping != "target_region":
+			if grouping == "cluster":
+				name_prepend="cluster_"
+			grouping += "_RNA"
+		if outliers:
+			boxpoints='suspectedoutliers';
+		else:
+			boxpoints=False
+
+		traces = OrderedDict()
+		for point in points.to_dict('records'):
+			color = colors[int(np.where(unique_groups==point[grouping])[0]) % len(colors)]
+			group = point[grouping]
+			trace = traces.setdefault(group, go.Box(
+					y=list(),
+					name=name_prepend + str(group),
+					marker={
+						'color': color,
+						'outliercolor': color,
+						'size': 6
+					},
+					boxpoints=boxpoints,
+					visible=True,
+					showlegend=False,
+					))
+			trace['y'].append(point['normalized_counts'])
+		data = list(traces.values())
 
 	gene_name = get_gene_by_id([ gene ])[0]['gene_name']
 
-	layout = Layout(
+	layout = go.Layout(
 		autosize=True,
 		height=450,
 		width=1000,
@@ -4031,9 +3352,9 @@ def get_RNA_box(ensemble, gene, grouping, outliers):
 		},
 	)
 
-	return plotly.offline.plot(
+	return timed('serialize', plotly.offline.plot,
 		{
-			'data': list(traces.values()),
+			'data': data,
 			'layout': layout
 		},
 		output_type='div',
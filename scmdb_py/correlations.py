@@ -0,0 +1,138 @@
+"""Genes correlated with a gene across the clusters of an ensemble.
+
+Correlations used to be read from a `<ensemble>_correlated_genes` table which
+had to be computed separately for each ensemble. They are now computed on
+demand from the cluster x gene aggregate matrices (see aggregates): the rows of
+a matrix are standardized once (ranked first for Spearman) into a matrix shared
+by the server processes (see shared), after which the correlations of one gene
+with every other gene are a single matrix-vector product, and the top genes are
+picked with argpartition.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from . import cache
+from .aggregates import aggregates_dir, is_aggregate_name, load_aggregate
+from .shared import load_shared_arrays
+
+CORRELATION_METHODS = ['pearson', 'spearman']
+TOP_GENES = 50
+
+
+def available_aggregates(ensemble):
+    """Aggregate matrices built for an ensemble.
+
+    Returns:
+        list: (measure, grouping column) tuples.
+    """
+
+    if not is_aggregate_name(ensemble):
+        return []
+    try:
+        names = [name[:-len('.npy')] for name in os.listdir(os.path.join(aggregates_dir(), ensemble))
+                 if name.endswith('.npy')]
+    except OSError:
+        return []
+    return [tuple(name.split('__', 1)) for name in names if '__' in name]
+
+
+def default_aggregate(ensemble):
+    """Matrix correlations are computed over when the caller does not choose one.
+
+    Prefers mCH/mCG over counts, original over normalized levels and clusters over annotations.
+
+    Returns:
+        tuple: measure, grouping column. None if the ensemble has no aggregate matrix.
+    """
+
+    aggregates = available_aggregates(ensemble)
+    if not aggregates:
+        return None
+
+    def preference(aggregate):
+        measure, grouping_column = aggregate
+        return (not measure.startswith('mCH'), not measure.startswith('mCG'), not measure.endswith('_original'),
+                not grouping_column.startswith('cluster_'), grouping_column)
+
+    return sorted(aggregates, key=preference)[0]
+
+
+def standardized_matrix(ensemble, measure, grouping_column, method):
+    """Rows of an aggregate matrix scaled so that the dot product of two rows is their correlation.
+
+    Missing values are replaced by the mean of their row. Spearman correlations are the Pearson correlations of
+    the ranks.
+
+    Returns:
+        dict: matrix (genes x groups, float32), gene_rows and genes (gene id of each row). None if the aggregate
+            matrix has not been built.
+    """
+
+    aggregate = load_aggregate(ensemble, measure, grouping_column)
+    if aggregate is None:
+        return None
+
+    def standardize():
+        values = np.asarray(aggregate['matrix'], dtype=np.float64)
+        if method == 'spearman':
+            values = pd.DataFrame(values).rank(axis=1).values
+        values = values - np.nanmean(values, axis=1, keepdims=True)
+        values[np.isnan(values)] = 0
+        norms = np.sqrt((values ** 2).sum(axis=1, keepdims=True))
+        norms[norms == 0] = 1  # Constant rows correlate with nothing
+        return {'matrix': (values / norms).astype(np.float32)}
+
+    # Rebuilt when the aggregate matrix changes.
+    arrays = load_shared_arrays(os.path.join('correlations', ensemble, measure + '__' + grouping_column + '__' + method),
+                                standardize, version=aggregate['mtime'])
+    return {'matrix': arrays['matrix'],
+            'gene_rows': aggregate['gene_rows'],
+            'genes': aggregate['genes']}
+
+
+@cache.memoize(timeout=3600)
+def get_correlated_genes(ensemble, gene, measure=None, grouping_column=None, method='pearson', top=TOP_GENES):
+    """Return the genes whose aggregates across groups correlate best with a gene.
+
+    Arguments:
+        ensemble (str): Ensemble identifier. (Eg. Ens0, Ens1, Ens2...).
+        gene (str): Ensembl ID of gene, with or without version number.
+        measure (str): ie. mCH_original. Defaults to the matrix chosen by default_aggregate, as do a measure and
+            grouping column without a matrix.
+        grouping_column (str): ie. cluster_mCH_lv_npc50_k5.
+        method (str): "pearson" or "spearman".
+        top (int): Number of genes to return.
+
+    Returns:
+        list: (gene_id, correlation) tuples, best first. None if there is no aggregate matrix for the ensemble or
+            the gene is not in it.
+    """
+
+    if method not in CORRELATION_METHODS:
+        return None
+    # Only names of built matrices reach the file system, request arguments could be paths.
+    if (measure, grouping_column) not in available_aggregates(ensemble):
+        aggregate = default_aggregate(ensemble)
+        if aggregate is None:
+            return None
+        measure, grouping_column = aggregate
+
+    standardized = standardized_matrix(ensemble, measure, grouping_column, method)
+    if standardized is None:
+        return None
+    row = standardized['gene_rows'].get(gene, standardized['gene_rows'].get(gene.split('.')[0]))
+    if row is None:
+        return None
+
+    matrix = standardized['matrix']
+    correlations = matrix.dot(matrix[row])
+    correlations[row] = -np.inf  # Not correlated with itself
+
+    top = min(top, len(correlations) - 1)
+    if top <= 0:
+        return []
+    best = np.argpartition(-correlations, top - 1)[:top]
+    best = best[np.argsort(-correlations[best], kind='mergesort')]
+    return [(standardized['genes'][i], round(float(correlations[i]), 4)) for i in best]
@@ -16,6 +16,42 @@ MINIFY_PAGE = True
 
 THREADS_PER_PAGE = 2
 
+# tSNE scatter plots with at least this many cells are drawn with WebGL
+SCATTER_WEBGL_MIN_POINTS = 5000
+
+# Reorder heatmap dendrogram leaves so that neighbours are as similar as possible (slower)
+HEATMAP_OPTIMAL_LEAF_ORDERING = False
+
+# Cluster x gene matrices built by `flask aggregates`, defaults to scmdb_py/tmp/aggregates
+#AGGREGATES_DIR = ''
+
+# Threads each server process runs independent database queries on.
+#QUERY_THREADS = 8
+
+# Heavy plots are rendered as RQ jobs (see jobs.py), run `flask plot-worker` to render them
+#PLOT_JOB_QUEUE = 'plots'
+#PLOT_JOB_HEATMAP_GENES = 50
+#PLOT_JOB_RESULT_TTL = 600
+
+# Worker processes each server process builds scatter plots with (see render.py), 0 builds them on the request thread
+#RENDER_PROCESSES = 0
+# How the workers are started, forkserver or spawn: forking a threaded server process is unsafe
+#RENDER_START_METHOD = 'forkserver'
+
+# Arrays memory-mapped by every server process (see shared.py), defaults to /dev/shm/scmdb_py
+#SHARED_ARRAYS_DIR = ''
+
+# Serve the asset bundles built by `flask build-assets` instead of building them on requests (see asset_build.py)
+#ASSETS_PRECOMPILED = True
+
+# Fraction of the requests whose timings are logged as JSON lines, to TIMING_LOG_FILE or the standard output (see timing.py)
+#TIMING_LOG_SAMPLE = 0.01
+#TIMING_LOG_FILE = '/var/www/scmdb_py_dev/scmdb_log'
+
+# SELECT statements slower than this many seconds have their EXPLAIN plan captured, see /admin/slow_queries (slow_queries.py)
+#SLOW_QUERY_SECONDS = 1.0
+#SLOW_QUERY_WINDOW = 86400
+
 MAIL_SERVER = ''
 MAIL_PORT = 
 MAIL_USE_TLS = False
@@ -0,0 +1,110 @@
+"""Independent queries run concurrently on a bounded thread pool.
+
+Pages of the browser often need the same information from each modality
+database (methylation_data, snATAC_data, RNA_data). The queries do not depend
+on each other and MySQL does the work, so running them on threads makes a page
+wait for the slowest database rather than for all of them in turn. Each call
+runs in an application context of its own and uses the usual SQLAlchemy
+engines, whose connection pools are thread safe. Its spans are counted in the
+timings of the request which submitted it (see timing).
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from flask import current_app
+
+from .timing import bind, current_timings
+
+QUERY_THREADS = 8
+
+_pool = {}
+_lock = threading.Lock()
+# Set on the threads of the pool.
+_worker = threading.local()
+
+
+def query_pool():
+    """Thread pool of this process, of QUERY_THREADS threads.
+
+    Threads do not survive a fork, so each server process starts its own pool.
+    """
+
+    pid = os.getpid()
+    with _lock:
+        if _pool.get('pid') != pid:
+            _pool['pid'] = pid
+            _pool['executor'] = ThreadPoolExecutor(
+                max_workers=current_app.config.get('QUERY_THREADS', QUERY_THREADS))
+        return _pool['executor']
+
+
+def gather(*calls):
+    """Run calls concurrently and return their results in order.
+
+    An exception raised by a call is raised again here, once every call has finished. Calls made from a thread of
+    the pool, by a function which is itself gathered, run one after the other on that thread, since waiting for
+    other threads of the pool could wait forever.
+
+    Arguments:
+        calls: (function, arg, ...) tuples.
+
+    Returns:
+        list: Result of each call.
+    """
+
+    if getattr(_worker, 'active', False):
+        return [call[0](*call[1:]) for call in calls]
+
+    futures = submit_calls(calls)
+    errors = [future.exception() for future in futures]
+    for error in errors:
+        if error is not None:
+            raise error
+    return [future.result() for future in futures]
+
+
+def submit_calls(calls):
+    """Submit calls to the pool, each in an application context of its own.
+
+    Returns:
+        list: Future of each call.
+    """
+
+    app = current_app._get_current_object()
+    timings = current_timings()
+
+    def run(function, *args):
+        _worker.active = True
+        with app.app_context(), bind(timings):
+            return function(*args)
+
+    return [query_pool().submit(run, *call) for call in calls]
+
+
+def gather_as_completed(*calls):
+    """Run calls concurrently like gather, yielding each result as soon as its call has finished.
+
+    Calls which have not started yet are cancelled when the generator is closed, ie. when a streamed response
+    is interrupted.
+
+    Arguments:
+        calls: (function, arg, ...) tuples.
+
+    Yields:
+        tuple: Position of the call in calls and its result. An exception raised by the call is raised again.
+    """
+
+    if getattr(_worker, 'active', False):
+        for i, call in enumerate(calls):
+            yield i, call[0](*call[1:])
+        return
+
+    futures = submit_calls(calls)
+    positions = {future: i for i, future in enumerate(futures)}
+    try:
+        for future in as_completed(futures):
+            yield positions[future], future.result()
+    finally:
+        for future in futures:
+            future.cancel()
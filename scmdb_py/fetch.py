@@ -0,0 +1,115 @@
+"""Query results read straight into NumPy columns.
+
+pd.read_sql materialises every row of a result as a tuple, then builds the
+frame from the rows and infers the type of every column again. The content
+layer fetches up to hundreds of thousands of cells at a time, so read_frame
+streams rows from a server-side cursor in chunks of CHUNK_SIZE instead, and
+copies each chunk into one preallocated array per column. The type of a column
+(integers, floats or objects) is inferred from each chunk and widened when a
+chunk needs it: integers to floats when a NULL or a fraction shows up, like
+pandas does, and numbers to objects when a string shows up, ie. in a column of
+a LEFT JOIN whose first rows are all NULL.
+"""
+from collections import OrderedDict
+from decimal import Decimal
+from numbers import Integral, Real
+
+import numpy as np
+import pandas as pd
+
+from .slow_queries import record_streamed
+from .timing import span
+
+CHUNK_SIZE = 10000
+
+# Types of columns, each of which can hold the values of the previous ones.
+WIDENING = [np.dtype(np.int64), np.dtype(np.float64), np.dtype(object)]
+
+
+def column_dtype(values):
+    """NumPy type of a column, from its first values.
+
+    Returns:
+        dtype: int64 if every value is an integer, float64 if every value is a number or NULL, object otherwise.
+    """
+
+    present = [value for value in values if value is not None]
+    if not present:
+        return np.dtype(np.float64)
+    if all(isinstance(value, Integral) and not isinstance(value, bool) for value in present):
+        if len(present) < len(values):
+            return np.dtype(np.float64)
+        return np.dtype(np.int64)
+    if all(isinstance(value, (Real, Decimal)) and not isinstance(value, bool) for value in present):
+        return np.dtype(np.float64)
+    return np.dtype(object)
+
+
+def widen_column(column, dtype):
+    """Copy of a column as a wider type. NaN floats become None objects, they were NULL."""
+
+    widened = column.astype(dtype)
+    if dtype == object and column.dtype == np.float64:
+        widened[np.isnan(column)] = None
+    return widened
+
+
+def read_frame(query, con, params=None, chunk_size=CHUNK_SIZE):
+    """Run a query and return its result as a DataFrame, like pd.read_sql.
+
+    Errors are raised as the SQLAlchemy exceptions pd.read_sql would raise.
+
+    Arguments:
+        query (str): SQL query.
+        con (Engine): SQLAlchemy engine, ie. db.get_engine(current_app, 'methylation_data').
+        params (tuple, list or dict): Query parameters.
+        chunk_size (int): Number of rows read from the cursor at a time.
+
+    Returns:
+        DataFrame
+    """
+
+    with con.connect() as connection:
+        connection = connection.execution_options(stream_results=True)
+        if params is None:
+            result = connection.execute(query)
+        else:
+            result = connection.execute(query, params)
+
+        # Reading the rows of a streamed result, the statement itself is timed as sql (see timing).
+        with span('fetch'):
+            try:
+                names = list(result.keys())
+                columns = None
+                num_rows = 0
+                while True:
+                    rows = result.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    chunk = list(zip(*rows))
+                    if columns is None:
+                        # Narrowest type, widened below to the type of the first chunk.
+                        columns = [np.empty(len(rows), dtype=WIDENING[0]) for values in chunk]
+
+                    # Grow the arrays geometrically so that each row is copied a bounded number of times.
+                    if num_rows + len(rows) > len(columns[0]):
+                        capacity = max(2 * len(columns[0]), num_rows + len(rows))
+                        columns = [np.resize(column, capacity) for column in columns]
+
+                    for i, values in enumerate(chunk):
+                        if columns[i].dtype != object:
+                            dtype = max(columns[i].dtype, column_dtype(values), key=WIDENING.index)
+                            if dtype != columns[i].dtype:
+                                columns[i] = widen_column(columns[i], dtype)
+                        columns[i][num_rows:num_rows + len(rows)] = np.array(values, dtype=columns[i].dtype)
+                    num_rows += len(rows)
+            finally:
+                result.close()
+                record_streamed(connection)
+
+    if columns is None:
+        return pd.DataFrame(columns=names)
+    # Columns are keyed by position, queries may select two columns of the same name.
+    df = pd.DataFrame(OrderedDict((i, column[:num_rows]) for i, column in enumerate(columns)))
+    df.columns = names
+    return df
@@ -6,19 +6,27 @@ import json
 # from os import walk
 # import os.path
 import datetime
+from collections import OrderedDict
 
 import dominate
 from dominate.tags import img
-from flask import Blueprint, render_template, jsonify, request, redirect, current_app, flash, abort, url_for
+from flask import (Blueprint, Response, render_template, jsonify, request, redirect, current_app, flash, abort,
+                   url_for, stream_with_context)
 from flask_login import (current_user, login_required, login_user,
                          logout_user)
 from flask_mail import Mail, Message
 from flask_nav.elements import Navbar, Link, View, Text, Subgroup
 from flask_rq import get_queue
+from werkzeug.exceptions import HTTPException
+from werkzeug.urls import url_unquote
 
 from . import nav, cache, db, mail
 from .content import *
+from .executor import gather, gather_as_completed
+from .jobs import get_plot_job, is_heavy_heatmap, run_plot_job, submit_plot_job
+from .slow_queries import top_queries
 from .decorators import admin_required
+from .tiles import get_tile_info, get_methylation_tile
 from .email import send_email
 from .forms import LoginForm, ChangeUserEmailForm, ChangeAccountTypeForm, InviteUserForm, CreatePasswordForm, NewUserForm, RequestResetPasswordForm, ResetPasswordForm, ChangePasswordForm
 from .user import User, Role
@@ -48,9 +56,8 @@ def index():
 @frontend.route('/<ensemble_id>')
 def ensemble(ensemble_id):
     ensemble_info = get_ensemble_info(ensemble_id=ensemble_id)
-    snATAC_included = ensemble_exists(ensemble_info['ensemble_id'], modality='snATAC')
-    methylation_included = ensemble_exists(ensemble_info['ensemble_id'], modality='methylation')
-    RNA_included = ensemble_exists(ensemble_info['ensemble_id'],modality='RNA')
+    snATAC_included, methylation_included, RNA_included = gather(
+        *[(ensemble_exists, ensemble_info['ensemble_id'], modality) for modality in ['snATAC', 'methylation', 'RNA']])
     ensemble_name = str(ensemble_info['ensemble_name'])
     RS2_included = 0
     if 'RS2' in ensemble_info['datasets']:
@@ -123,10 +130,136 @@ def nav_bar_screen():
 
 
 # API routes
+def plot_job_response(name, *args):
+    """Render a heavy plot as a job (see jobs.py).
+
+    Returns:
+        The plot if it has already been rendered, else 202 and the job id to poll /plot/job/<job_id> with. Without
+        a worker to submit the job to, the plot is rendered in the request.
+    """
+
+    job_id = submit_plot_job(name, *args)
+    if job_id is None:
+        try:
+            return run_plot_job(name, args)
+        except Exception as e:
+            now = datetime.datetime.now()
+            print("[{}] ERROR in app(plot job {}): {}".format(str(now), name, e))
+            sys.stdout.flush()
+            return 'Failed to produce plot. Contact maintainer.', 500
+    job = get_plot_job(job_id)
+    if job['status'] == 'finished':
+        return job['result']
+    return jsonify({'job': job_id, 'status': job['status']}), 202
+
+
+@frontend.route('/plot/job/<job_id>')
+def plot_job(job_id):
+    job = get_plot_job(job_id)
+    if job['status'] == 'finished':
+        return job['result']
+    if job['status'] == 'failed':
+        return 'Failed to produce plot. Contact maintainer.', 500
+    if job['status'] == 'unknown':
+        return 'Plot not found, it may have expired. Please update the plot again.', 404
+    return jsonify({'job': job_id, 'status': job['status']}), 202
+
+
+# Plots the gene view can request together.
+GENE_VIEW_PLOTS = ['frontend.plot_methylation_scatter', 'frontend.plot_snATAC_scatter', 'frontend.plot_RNA_scatter',
+                   'frontend.plot_mch_box', 'frontend.plot_snATAC_box', 'frontend.plot_RNA_box',
+                   'frontend.plot_clusters_bar', 'frontend.plot_mch_heatmap', 'frontend.plot_snATAC_heatmap',
+                   'frontend.plot_RNA_heatmap']
+
+
+def render_gene_view_part(url):
+    """Render one plot of the gene view as if it had been requested on its own.
+
+    Arguments:
+        url (str): URL of the plot, relative to the page. ie. ./plot/RNA/box/Ens1/<gene>/cluster/false
+
+    Returns:
+        dict: status (HTTP status code) and body of the response.
+    """
+
+    path, _, query_string = url.partition('?')
+    if not path.startswith('./plot/'):
+        return {'status': 404, 'body': ''}
+    path = url_unquote(path[1:])
+
+    try:
+        endpoint, view_args = current_app.url_map.bind('localhost').match(path, method='GET')
+    except HTTPException:
+        return {'status': 404, 'body': ''}
+    if endpoint not in GENE_VIEW_PLOTS:
+        return {'status': 404, 'body': ''}
+
+    try:
+        with current_app.test_request_context(path, query_string=query_string):
+            response = current_app.make_response(current_app.view_functions[endpoint](**view_args))
+    except Exception as e:
+        now = datetime.datetime.now()
+        print("[{}] ERROR in app(plot_gene_view {}): {}".format(str(now), endpoint, e))
+        sys.stdout.flush()
+        return {'status': 500, 'body': 'Failed to produce plot. Contact maintainer.'}
+    return {'status': response.status_code, 'body': response.get_data(as_text=True)}
+
+
+@frontend.route('/plot/gene_view', methods=['POST'])
+def plot_gene_view():
+    """Plots of the gene view in one round trip, rendered concurrently.
+
+    The body is a JSON object whose parts are a JSON object of names to plot URLs (see render_gene_view_part).
+    Posted rather than sent in the query string, since each URL carries the genes of the view and all of them would
+    go past the length limit of request lines. Responds with a JSON object of the same names to the status and body
+    of each plot.
+    """
+
+    parts = gene_view_parts()
+    names = list(parts)
+    responses = gather(*[(render_gene_view_part, str(parts[name])) for name in names])
+    return jsonify(dict(zip(names, responses)))
+
+
+@frontend.route('/plot/gene_view/stream', methods=['POST'])
+def plot_gene_view_stream():
+    """Plots of the gene view streamed as newline delimited JSON, each one as soon as it has been rendered.
+
+    Takes the same body as plot_gene_view. Each line is a JSON object with the name, status and body of
+    a plot. Plots are started in the order of parts, so the fastest plots should come first.
+    """
+
+    parts = gene_view_parts()
+    names = list(parts)
+
+    def generate():
+        for i, response in gather_as_completed(*[(render_gene_view_part, str(parts[name])) for name in names]):
+            yield json.dumps(dict(response, name=names[i])) + '\n'
+
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    # Proxies must not hold the plots back until the last one.
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def gene_view_parts():
+    """The parts of the body of the gene view requests, aborts with 400 if they are not a JSON object."""
+
+    try:
+        body = json.loads(request.get_data(as_text=True) or '{}', object_pairs_hook=OrderedDict)
+    except ValueError:
+        abort(400)
+    parts = body.get('parts', {}) if isinstance(body, dict) else None
+    if not isinstance(parts, dict):
+        abort(400)
+    return parts
+
+
 @frontend.route('/plot/methylation/scatter/<ensemble>/<tsne_type>/<methylation_type>/<level>/<grouping>/<clustering>/<ptile_start>/<ptile_end>/<tsne_outlier>/<max_points>')
 def plot_methylation_scatter(ensemble, tsne_type, methylation_type, level, grouping, clustering, ptile_start, ptile_end, tsne_outlier, max_points):
 
     genes = request.args.get('q', 'MustHaveAQueryString')
+    module = request.args.get('module')
     if tsne_type == 'null':
         tsne_type = 'mCH_ndim2_perp20'
     if clustering == 'null':
@@ -138,26 +271,57 @@ def plot_methylation_scatter(ensemble, tsne_type, methylation_type, level, group
     if tsne_outlier == 'true':
         tsne_outlier_bool = True
 
+    args = (ensemble,
+            tsne_type,
+            methylation_type,
+            genes, 
+            level,
+            grouping,
+            clustering,
+            float(ptile_start),
+            float(ptile_end),
+            tsne_outlier_bool,
+            max_points,
+            module)
+    if max_points == 'all':
+        return plot_job_response('get_methylation_scatter', *args)
     try:
-        return get_methylation_scatter(ensemble,
-                                       tsne_type,
-                                       methylation_type,
-                                       genes, 
-                                       level,
-                                       grouping,
-                                       clustering,
-                                       float(ptile_start),
-                                       float(ptile_end),
-                                       tsne_outlier_bool,
-                                       max_points)
+        return get_methylation_scatter(*args)
     except FailToGraphException:
         return "Failed to generate methylation tsne scatter plots for {}, please contact maintainer".format(ensemble)
 
 
+@frontend.route('/plot/methylation/tiles/<ensemble>/<tsne_type>')
+def plot_methylation_tile_info(ensemble, tsne_type):
+
+    if tsne_type == 'null':
+        tsne_type = 'mCH_ndim2_perp20'
+
+    info = get_tile_info(ensemble, tsne_type)
+    if info is None:
+        return jsonify({})
+    return jsonify(info)
+
+
+@frontend.route('/plot/methylation/tile/<ensemble>/<tsne_type>/<methylation_type>/<level>/<int:zoom>/<int:tile_x>/<int:tile_y>')
+def plot_methylation_tile(ensemble, tsne_type, methylation_type, level, zoom, tile_x, tile_y):
+
+    # Tiles are only drawn for single gene queries.
+    gene = request.args.get('q', 'MustHaveAQueryString').split('+')[0]
+    if tsne_type == 'null':
+        tsne_type = 'mCH_ndim2_perp20'
+
+    tile = get_methylation_tile(ensemble, tsne_type, methylation_type, gene, level, zoom, tile_x, tile_y)
+    if tile is None:
+        return jsonify({})
+    return jsonify(tile)
+
+
 @frontend.route('/plot/snATAC/scatter/<ensemble>/<grouping>/<ptile_start>/<ptile_end>/<tsne_outlier>/<smoothing>/<max_points>')
 def plot_snATAC_scatter(ensemble, grouping, ptile_start, ptile_end, tsne_outlier, smoothing, max_points):
 
     genes_query = request.args.get('q', 'MustHaveAQueryString')
+    module = request.args.get('module')
     if grouping == 'NaN' or grouping == 'null':
         grouping = 'cluster'
 
@@ -169,15 +333,19 @@ def plot_snATAC_scatter(ensemble, grouping, ptile_start, ptile_end, tsne_outlier
     if smoothing == 'true':
         smoothing_bool = True
 
+    args = (ensemble,
+            genes_query, 
+            grouping,
+            float(ptile_start),
+            float(ptile_end),
+            tsne_outlier_bool,
+            smoothing_bool,
+            max_points,
+            module)
+    if max_points == 'all':
+        return plot_job_response('get_snATAC_scatter', *args)
     try:
-        return get_snATAC_scatter(ensemble,
-                                  genes_query, 
-                                  grouping,
-                                  float(ptile_start),
-                                  float(ptile_end),
-                                  tsne_outlier_bool,
-                                  smoothing_bool,
-                                  max_points,)
+        return get_snATAC_scatter(*args)
     except FailToGraphException:
         return "Failed to load snATAC-seq data for {}, please contact maintainer".format(ensemble)
 
@@ -186,6 +354,7 @@ def plot_snATAC_scatter(ensemble, grouping, ptile_start, ptile_end, tsne_outlier
 def plot_RNA_scatter(ensemble, grouping, ptile_start, ptile_end, tsne_outlier, max_points):
 
     genes_query = request.args.get('q', 'MustHaveAQueryString')
+    module = request.args.get('module')
     if grouping == 'NaN' or grouping == 'null':
         grouping = 'cluster'
 
@@ -193,14 +362,18 @@ def plot_RNA_scatter(ensemble, grouping, ptile_start, ptile_end, tsne_outlier, m
     if tsne_outlier == 'true':
         tsne_outlier_bool = True
 
+    args = (ensemble,
+            genes_query, 
+            grouping,
+            float(ptile_start),
+            float(ptile_end),
+            tsne_outlier_bool,
+            max_points,
+            module)
+    if max_points == 'all':
+        return plot_job_response('get_RNA_scatter', *args)
     try:
-        return get_RNA_scatter(ensemble,
-                                  genes_query, 
-                                  grouping,
-                                  float(ptile_start),
-                                  float(ptile_end),
-                                  tsne_outlier_bool,
-                                  max_points)
+        return get_RNA_scatter(*args)
     except FailToGraphException:
         return "Failed to load RNA-seq data for {}, please contact maintainer".format(ensemble)
 
@@ -321,8 +494,11 @@ def plot_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, pt
         normalize_row = True
     else:
         normalize_row = False
+    args = (ensemble, methylation_type, grouping, clustering, level, float(ptile_start), float(ptile_end), normalize_row, query)
+    if is_heavy_heatmap(query):
+        return plot_job_response('get_mch_heatmap', *args)
     try:
-        return get_mch_heatmap(ensemble, methylation_type, grouping, clustering, level, float(ptile_start), float(ptile_end), normalize_row, query)
+        return get_mch_heatmap(*args)
     except (FailToGraphException, ValueError) as e:
         print("ERROR (plot_mch_heatmap): {}".format(e))
         return 'Failed to produce mCH levels heatmap plot. Contact maintainer. '.format(e)
@@ -340,8 +516,11 @@ def plot_snATAC_heatmap(ensemble, grouping, ptile_start, ptile_end):
         normalize_row = True
     else:
         normalize_row = False
+    args = (ensemble, grouping, float(ptile_start), float(ptile_end), normalize_row, query)
+    if is_heavy_heatmap(query):
+        return plot_job_response('get_snATAC_heatmap', *args)
     try:
-        return get_snATAC_heatmap(ensemble, grouping, float(ptile_start), float(ptile_end), normalize_row, query)
+        return get_snATAC_heatmap(*args)
     except (FailToGraphException, ValueError) as e:
         print("ERROR (plot_snATAC_heatmap): {}".format(e))
         return 'Failed to produce snATAC normalized counts heatmap plot. Contact maintainer.'
@@ -359,8 +538,11 @@ def plot_RNA_heatmap(ensemble, grouping, ptile_start, ptile_end):
         normalize_row = True
     else:
         normalize_row = False
+    args = (ensemble, grouping, float(ptile_start), float(ptile_end), normalize_row, query)
+    if is_heavy_heatmap(query):
+        return plot_job_response('get_RNA_heatmap', *args)
     try:
-        return get_RNA_heatmap(ensemble, grouping, float(ptile_start), float(ptile_end), normalize_row, query)
+        return get_RNA_heatmap(*args)
     except (FailToGraphException, ValueError) as e:
         print("ERROR (plot_RNA_heatmap): {}".format(e))
         return 'Failed to produce RNA normalized counts heatmap plot. Contact maintainer.'
@@ -453,9 +635,9 @@ def cluster_specific_marker_genes(ensemble, clustering):
 
 
 @frontend.route('/gene/corr/<ensemble>/<gene_id>')
-@cache.memoize(timeout=3600)
 def correlated_genes(ensemble, gene_id):
-    return jsonify(get_corr_genes(ensemble, gene_id))
+    return jsonify(get_corr_genes(ensemble, gene_id, request.args.get('measure'), request.args.get('grouping'),
+                                  request.args.get('method', 'pearson')))
 
 
 @frontend.route('/plot/delete_cache/<ensemble>/<grouping>')
@@ -508,6 +690,16 @@ def admin():
     """Admin dashboard page."""
     return render_template('admin/index.html')
 
+@frontend.route('/admin/slow_queries')
+@login_required
+@admin_required
+def slow_queries():
+    """Queries of the data databases which took the most time, with the plans of the slowest."""
+    sort = request.args.get('sort', 'total')
+    if sort not in ['total', 'max', 'count', 'slow']:
+        abort(400)
+    return render_template('admin/slow_queries.html', queries=top_queries(sort=sort), sort=sort)
+
 @frontend.route('/users')
 @login_required
 @admin_required
@@ -0,0 +1,178 @@
+"""Heavy plots rendered outside of the request which asked for them.
+
+Heatmaps of hundreds of genes and scatters of every cell can take longer than
+the mod_wsgi timeout, and hold a server thread meanwhile. Their routes submit
+them as jobs instead and answer 202 with the job id, which the browser polls at
+/plot/job/<job_id> until the plot is ready.
+
+Jobs go to the PLOT_JOB_QUEUE queue of RQ (run a worker with
+`flask --app=scmdb_py plot-worker`), whose results are kept in Redis for
+PLOT_JOB_RESULT_TTL seconds and so are seen by every server process. When Redis
+or the worker is not running, debug servers run jobs on a small thread pool of
+the server process instead and put their results in the cache. The cache is
+only seen by that process, so other servers render the plot in the request,
+like before jobs: their other processes would answer the polls with 404.
+
+The id of a job is a hash of the plot and its arguments, so asking for the same
+plot again while it is rendered, or after, does not render it twice.
+"""
+import datetime
+import hashlib
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from flask_rq import get_connection, get_queue
+from redis.exceptions import RedisError
+from rq import Worker
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+
+from . import cache
+
+# Functions of the content module which can be run as jobs.
+PLOT_JOBS = ['get_mch_heatmap', 'get_snATAC_heatmap', 'get_RNA_heatmap',
+             'get_methylation_scatter', 'get_snATAC_scatter', 'get_RNA_scatter']
+
+PLOT_JOB_QUEUE = 'plots'
+PLOT_JOB_TIMEOUT = 900
+PLOT_JOB_RESULT_TTL = 600
+# Heatmaps of at least this many genes are rendered as jobs.
+PLOT_JOB_HEATMAP_GENES = 50
+# Threads of the in-process fallback.
+PLOT_JOB_THREADS = 2
+
+# Jobs of the in-process fallback, by id, until they finish.
+_local = {}
+_lock = threading.Lock()
+
+
+def run_plot_job(name, args):
+    """Render a plot. This is what runs in the RQ worker or on the local thread pool."""
+
+    from . import content
+
+    if name not in PLOT_JOBS:
+        raise ValueError("Not a plot job: {}".format(name))
+    return getattr(content, name)(*args)
+
+
+def plot_job_id(name, args):
+    """Id of the job rendering a plot, the same for the same plot."""
+
+    key = json.dumps([name, list(args)], sort_keys=True, default=str)
+    return 'plot-' + hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def is_heavy_heatmap(query):
+    """Whether a heatmap of the genes of query (separated by spaces) should be rendered as a job."""
+
+    return len(query.split(' ')) >= current_app.config.get('PLOT_JOB_HEATMAP_GENES', PLOT_JOB_HEATMAP_GENES)
+
+
+def workers_running():
+    """Whether an RQ worker listens to the plot queue. False if Redis cannot be reached."""
+
+    queue = current_app.config.get('PLOT_JOB_QUEUE', PLOT_JOB_QUEUE)
+    try:
+        return any(queue in worker.queue_names() for worker in Worker.all(connection=get_connection(queue)))
+    except RedisError:
+        return False
+
+
+def local_pool():
+    """Thread pool of the in-process fallback, one per server process."""
+
+    pid = os.getpid()
+    with _lock:
+        if _local.get('pid') != pid:
+            _local.clear()
+            _local['pid'] = pid
+            _local['executor'] = ThreadPoolExecutor(
+                max_workers=current_app.config.get('PLOT_JOB_THREADS', PLOT_JOB_THREADS))
+            _local['jobs'] = {}
+        return _local['executor']
+
+
+def _run_local_job(app, job_id, name, args):
+    """Run a job of the in-process fallback and put its outcome in the cache."""
+
+    with app.app_context():
+        try:
+            outcome = {'status': 'finished', 'result': run_plot_job(name, args)}
+        except Exception as e:
+            now = datetime.datetime.now()
+            print("[{}] ERROR in app(plot job {}): {}".format(str(now), name, e))
+            sys.stdout.flush()
+            outcome = {'status': 'failed', 'result': None}
+        cache.set(job_id, outcome, timeout=app.config.get('PLOT_JOB_RESULT_TTL', PLOT_JOB_RESULT_TTL))
+        with _lock:
+            _local['jobs'].pop(job_id, None)
+
+
+def submit_plot_job(name, *args):
+    """Render a plot as a job, unless it is already being or has been rendered.
+
+    Arguments:
+        name (str): Function of the content module, one of PLOT_JOBS.
+        args: Arguments of the function.
+
+    Returns:
+        str: Job id, to be given to get_plot_job. None if no worker is running and the server is not in debug mode,
+            the plot is then to be rendered in the request.
+    """
+
+    job_id = plot_job_id(name, args)
+    if get_plot_job(job_id)['status'] not in ['unknown', 'failed']:
+        return job_id
+
+    if workers_running():
+        queue = current_app.config.get('PLOT_JOB_QUEUE', PLOT_JOB_QUEUE)
+        try:
+            get_queue(queue).enqueue_call(run_plot_job, args=(name, list(args)), job_id=job_id,
+                                          timeout=current_app.config.get('PLOT_JOB_TIMEOUT', PLOT_JOB_TIMEOUT),
+                                          result_ttl=current_app.config.get('PLOT_JOB_RESULT_TTL', PLOT_JOB_RESULT_TTL))
+            return job_id
+        except RedisError as e:
+            now = datetime.datetime.now()
+            print("[{}] ERROR in app(submit_plot_job): {}".format(str(now), e))
+            sys.stdout.flush()
+
+    # Results of the local pool are only seen by this process.
+    if not current_app.debug:
+        return None
+    pool = local_pool()
+    with _lock:
+        _local['jobs'][job_id] = pool.submit(_run_local_job, current_app._get_current_object(), job_id, name, args)
+    return job_id
+
+
+def get_plot_job(job_id):
+    """Status of a job, and its plot once it has finished.
+
+    Returns:
+        dict: status ('queued', 'started', 'finished', 'failed' or 'unknown') and result (the plot, or None).
+    """
+
+    with _lock:
+        future = _local.get('jobs', {}).get(job_id) if _local.get('pid') == os.getpid() else None
+    if future is not None:
+        return {'status': 'started' if future.running() else 'queued', 'result': None}
+
+    outcome = cache.get(job_id)
+    if outcome is not None:
+        return outcome
+
+    try:
+        job = Job.fetch(job_id, connection=get_connection(current_app.config.get('PLOT_JOB_QUEUE', PLOT_JOB_QUEUE)))
+        status = job.get_status()
+    except (NoSuchJobError, RedisError):
+        return {'status': 'unknown', 'result': None}
+    if status == 'finished':
+        return {'status': status, 'result': job.result}
+    if status == 'failed':
+        return {'status': status, 'result': None}
+    return {'status': 'queued' if status in ['queued', 'deferred'] else 'started', 'result': None}
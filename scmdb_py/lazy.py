@@ -0,0 +1,126 @@
+"""Modules imported on first use, and the import times of a cold start.
+
+Plotly and SciPy take seconds to import and are only needed to draw plots, yet
+every server process used to import them before serving its first page.
+lazy_import returns a stand-in which imports the module the first time one of
+its attributes is used:
+
+    plotly = lazy_import('plotly')
+    ...
+    plotly.offline.plot(...)  # plotly is imported here
+
+ImportTimer records how long each module takes to import, like the
+-X importtime option of Python 3.7, which the servers do not have. It is used by
+`flask --app=scmdb_py startup-report`. This module only imports the standard
+library, so that the report can load it before anything else.
+"""
+import importlib
+import sys
+import time
+import types
+
+# Names of the modules given to lazy_import and not imported at the time.
+DEFERRED = []
+
+
+class LazyModule(types.ModuleType):
+    """Stand-in for a module, which imports it when one of its attributes is first used."""
+
+    def __getattr__(self, attribute):
+        module = importlib.import_module(self.__name__)
+        # Later lookups find the attributes without going through __getattr__.
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attribute)
+
+
+def lazy_import(name):
+    """Module imported when one of its attributes is first used.
+
+    Arguments:
+        name (str): Absolute name of the module. ie. scipy.cluster.hierarchy
+
+    Returns:
+        module: The module itself if it has already been imported, else a LazyModule.
+    """
+
+    if name in sys.modules:
+        return sys.modules[name]
+    if name not in DEFERRED:
+        DEFERRED.append(name)
+    return LazyModule(name)
+
+
+class ImportTimer:
+    """Import hook recording the time taken to import each module.
+
+    Install it with install() before the imports to time. times maps module names to their cumulative time (the
+    module and the modules it imported) and their own time, in seconds.
+    """
+
+    def __init__(self):
+        self.times = {}
+        self._stack = []
+
+    def install(self):
+        sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        sys.meta_path.remove(self)
+
+    def find_spec(self, name, path=None, target=None):
+        # Find the module with the other finders, then time its loader.
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = TimedLoader(spec.loader, self)
+                return spec
+        return None
+
+    def timed(self, name, execute):
+        """Run execute(), the import of module name, and record its times."""
+
+        self._stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            execute()
+        finally:
+            cumulative = time.perf_counter() - start
+            nested = self._stack.pop()
+            self.times[name] = (cumulative, cumulative - nested)
+            if self._stack:
+                self._stack[-1] += cumulative
+
+    def report(self, top=20):
+        """Lines of the modules which took the longest to import, cumulative time first."""
+
+        lines = ['{:>10} {:>10}  {}'.format('cumul. ms', 'self ms', 'module')]
+        slowest = sorted(self.times.items(), key=lambda item: item[1][0], reverse=True)[:top]
+        for name, (cumulative, own) in slowest:
+            lines.append('{:10.1f} {:10.1f}  {}'.format(cumulative * 1000, own * 1000, name))
+        return lines
+
+
+class TimedLoader:
+    """Loader wrapper used by ImportTimer."""
+
+    def __init__(self, loader, timer):
+        self._loader = loader
+        self._timer = timer
+
+    def __getattr__(self, attribute):
+        return getattr(self._loader, attribute)
+
+    def create_module(self, spec):
+        if hasattr(self._loader, 'create_module'):
+            return self._loader.create_module(spec)
+        return None
+
+    def exec_module(self, module):
+        # Modules see their own loader, pkg_resources looks resources up by the type of the loader.
+        module.__loader__ = self._loader
+        if getattr(module, '__spec__', None) is not None:
+            module.__spec__.loader = self._loader
+        self._timer.timed(module.__name__, lambda: self._loader.exec_module(module))
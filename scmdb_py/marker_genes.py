@@ -0,0 +1,259 @@
+"""Cluster marker genes computed from the methylation of every cell.
+
+The marker gene table of an ensemble (`<ensemble>_cluster_marker_genes`) used
+to be computed and loaded by hand, so ensembles without it had no marker genes.
+An offline job (`flask --app=scmdb_py marker-genes <ensemble>`) now fetches the
+normalized gene body methylation of every cell, one gene per task in a pool of
+worker processes, and scores each gene in every cluster of every clustering
+with a Welch t statistic of the cluster against the other cells. Genes are
+hypomethylated where they are expressed, so the markers of a cluster are its
+lowest scoring genes.
+
+The job is incremental: clusterings already in the table are skipped unless
+--force is given. It is also resumable: scores are checkpointed next to the
+aggregate matrices while genes are processed, and an interrupted run continues
+from its last checkpoint.
+"""
+import datetime
+import json
+import os
+import sys
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+from flask import current_app
+
+from . import db
+from .aggregates import aggregates_dir
+from .box_stats import fetch_gene_measures, get_grouping_columns
+from .cells import EMBEDDING_BINDS
+from .fetch import read_frame
+
+TOP_MARKERS = 100
+
+# Scores are saved every CHECKPOINT_GENES genes.
+CHECKPOINT_GENES = 2000
+
+CREATE_MARKER_TABLE = "CREATE TABLE IF NOT EXISTS %(ensemble)s_cluster_marker_genes ( \
+    clustering VARCHAR(64) NOT NULL, \
+    cluster INT NOT NULL, \
+    rank INT NOT NULL, \
+    gene_id VARCHAR(32) NOT NULL, \
+    PRIMARY KEY (clustering, cluster, rank))"
+
+# State shared with the worker processes of compute_marker_genes, inherited when they are forked.
+_build = {}
+
+
+def cluster_scores(values, codes, num_clusters):
+    """Welch t statistic of each cluster against the rest of the cells, for one gene.
+
+    Arguments:
+        values (ndarray): Value of the gene in each cell, NaN if missing.
+        codes (ndarray): Cluster index of each cell, -1 if the cell is not clustered.
+        num_clusters (int): Number of clusters.
+
+    Returns:
+        ndarray: Score of each cluster, negative where the gene is lower than in the other cells.
+            NaN where a cluster or the rest of the cells have no spread.
+    """
+
+    valid = (codes >= 0) & ~np.isnan(values)
+    codes, values = codes[valid], values[valid]
+
+    n = np.bincount(codes, minlength=num_clusters).astype(np.float64)
+    sums = np.bincount(codes, weights=values, minlength=num_clusters)
+    squares = np.bincount(codes, weights=values ** 2, minlength=num_clusters)
+    n_rest = n.sum() - n
+    sums_rest = sums.sum() - sums
+    squares_rest = squares.sum() - squares
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = sums / n
+        mean_rest = sums_rest / n_rest
+        var = np.maximum(squares / n - mean ** 2, 0)
+        var_rest = np.maximum(squares_rest / n_rest - mean_rest ** 2, 0)
+        scores = (mean - mean_rest) / np.sqrt(var / n + var_rest / n_rest)
+    scores[~np.isfinite(scores)] = np.nan
+
+    return scores
+
+
+def rank_markers(scores, top=TOP_MARKERS):
+    """Lowest scoring genes of each cluster.
+
+    Arguments:
+        scores (ndarray): Genes x clusters scores, NaN for genes without a score.
+        top (int): Number of genes to keep per cluster.
+
+    Returns:
+        list: For each cluster, the rows of its marker genes, best first.
+    """
+
+    markers = []
+    for column in scores.T:
+        rows = np.flatnonzero(~np.isnan(column))
+        if len(rows) > top:
+            rows = rows[np.argpartition(column[rows], top - 1)[:top]]
+        markers.append(rows[np.argsort(column[rows], kind='mergesort')])
+    return markers
+
+
+def _init_build_worker():
+    """Give each worker its own database connections and an application context."""
+
+    app = _build['app']
+    db.get_engine(app, EMBEDDING_BINDS['methylation']).dispose()
+    app.app_context().push()
+
+
+def _score_gene(gene_id):
+    """Score one gene in every cluster of every clustering being computed.
+
+    Returns:
+        tuple: gene_id and a dict of grouping column to the scores of its clusters.
+            The dict is None if the gene could not be fetched.
+    """
+
+    fetched = fetch_gene_measures(_build['ensemble'], 'methylation', 'gene_' + gene_id.replace('.', '_'),
+                                  list(_build['clusters']), [_build['methylation_type']])
+    if fetched is None:
+        return gene_id, None
+    groupings, measures = fetched
+
+    values = measures[marker_measure(_build['methylation_type'])].values.astype(np.float64)
+    scores = {}
+    for column, clusters in _build['clusters'].items():
+        codes = pd.Categorical(groupings[column], categories=clusters).codes.astype(np.int64)
+        scores[column] = cluster_scores(values, codes, len(clusters))
+
+    return gene_id, scores
+
+
+def marker_measure(methylation_type):
+    """Measure of fetch_gene_measures the genes are scored with."""
+
+    return methylation_type + '_normalized'
+
+
+def checkpoint_path(ensemble):
+    """Path of the score checkpoint of an interrupted run."""
+
+    return os.path.join(aggregates_dir(), ensemble, 'marker_scores.npz')
+
+
+def checkpoint_meta(genes, clusters, methylation_type):
+    """What the scores of a checkpoint were computed over, an interrupted run is only resumed by the same run."""
+
+    return {'genes': genes, 'clusters': clusters, 'methylation_type': methylation_type,
+            'measure': marker_measure(methylation_type)}
+
+
+def load_checkpoint(path, meta):
+    """Scores and processed genes saved by an interrupted run with the same checkpoint_meta, if any."""
+
+    try:
+        checkpoint = np.load(path)
+    except (IOError, OSError, ValueError):
+        return None
+
+    with checkpoint:
+        if json.loads(str(checkpoint['meta'])) != meta:
+            return None
+        return checkpoint['done'], {column: checkpoint['scores__' + column] for column in meta['clusters']}
+
+
+def save_checkpoint(path, meta, done, scores):
+    """Save the scores computed so far. Written aside and renamed so that a checkpoint is never partial."""
+
+    arrays = {'scores__' + column: matrix for column, matrix in scores.items()}
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, meta=np.array(json.dumps(meta)), done=done, **arrays)
+    os.replace(path + '.tmp', path)
+
+
+def compute_marker_genes(ensemble, methylation_type='mCH', clusterings=None, force=False, processes=None):
+    """Compute and store the marker genes of the clusterings of an ensemble. Needs an application context.
+
+    Arguments:
+        ensemble (str): Ensemble identifier. (Eg. Ens0, Ens1, Ens2...).
+        methylation_type (str): Methylation type the genes are scored with.
+        clusterings ([str]): Clusterings to compute, ie. mCH_lv_npc50_k5. Defaults to every clustering.
+        force (bool): Recompute clusterings which already have marker genes.
+        processes (int): Number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+        list: Clusterings whose marker genes were written.
+    """
+
+    # Prevent SQL injection since table and column names cannot be parameterized.
+    if ";" in ensemble or ";" in methylation_type:
+        return []
+
+    engine = db.get_engine(current_app, EMBEDDING_BINDS['methylation'])
+    table = ensemble + '_cluster_marker_genes'
+    engine.execute(CREATE_MARKER_TABLE % {'ensemble': ensemble})
+
+    columns = [column for column in get_grouping_columns(ensemble, 'methylation') if column.startswith('cluster_')]
+    if clusterings:
+        columns = [column for column in columns if column[len('cluster_'):] in clusterings]
+    if not force:
+        existing = {row.clustering for row in engine.execute("SELECT DISTINCT clustering FROM " + table).fetchall()}
+        columns = [column for column in columns if column[len('cluster_'):] not in existing]
+    if not columns:
+        return []
+
+    cells = read_frame("SELECT %(columns)s FROM %(ensemble)s" % {
+        'columns': ", ".join(columns), 'ensemble': ensemble}, engine)
+    clusters = {column: sorted(int(cluster) for cluster in cells[column].dropna().unique()) for column in columns}
+    genes = [row.gene_id for row in engine.execute("SELECT gene_id FROM genes").fetchall()]
+    gene_rows = {gene_id: row for row, gene_id in enumerate(genes)}
+
+    os.makedirs(os.path.join(aggregates_dir(), ensemble), exist_ok=True)
+    path = checkpoint_path(ensemble)
+    meta = checkpoint_meta(genes, clusters, methylation_type)
+    checkpoint = load_checkpoint(path, meta)
+    if checkpoint is None:
+        done = np.zeros(len(genes), dtype=bool)
+        scores = {column: np.full((len(genes), len(clusters[column])), np.nan, dtype=np.float32)
+                  for column in columns}
+    else:
+        done, scores = checkpoint
+    remaining = [gene_id for gene_id, gene_done in zip(genes, done) if not gene_done]
+
+    _build.update(app=current_app._get_current_object(), ensemble=ensemble, methylation_type=methylation_type,
+                  clusters=clusters)
+    pool = Pool(processes, initializer=_init_build_worker)
+    try:
+        for i, (gene_id, gene_scores) in enumerate(pool.imap_unordered(_score_gene, remaining, chunksize=16)):
+            row = gene_rows[gene_id]
+            if gene_scores is not None:
+                for column, values in gene_scores.items():
+                    scores[column][row] = values
+            done[row] = True
+
+            if (i + 1) % CHECKPOINT_GENES == 0:
+                save_checkpoint(path, meta, done, scores)
+                now = datetime.datetime.now()
+                print("[{}] compute_marker_genes({}): {}/{} genes".format(str(now), ensemble, done.sum(), len(genes)))
+                sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+        _build.clear()
+    save_checkpoint(path, meta, done, scores)
+
+    insert = "INSERT INTO " + table + " (clustering, cluster, rank, gene_id) VALUES (%s, %s, %s, %s)"
+    for column in columns:
+        clustering = column[len('cluster_'):]
+        rows = [(clustering, cluster, rank + 1, genes[gene_row])
+                for cluster, markers in zip(clusters[column], rank_markers(scores[column]))
+                for rank, gene_row in enumerate(markers)]
+        with engine.begin() as connection:
+            connection.execute("DELETE FROM " + table + " WHERE clustering = %s", (clustering,))
+            if rows:
+                connection.execute(insert, rows)
+
+    os.remove(path)
+    return [column[len('cluster_'):] for column in columns]
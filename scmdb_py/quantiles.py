@@ -0,0 +1,53 @@
+"""Quantile sketches for percentile colour scaling.
+
+Scatter plots and heatmaps clip their colour scale to a pair of percentiles
+chosen with a slider. Instead of taking both quantiles of the full value
+vector on every change, the percentiles 0, 1, ..., 100 of the values are
+computed once, when the data is fetched, and any percentile is read from them
+by linear interpolation between the two nearest stored percentiles. This is
+exact for whole percentiles, which covers every position of the sliders
+(steps of 0.05).
+"""
+import numpy as np
+
+SKETCH_SIZE = 101
+
+
+def quantile_sketch(values):
+    """Stored percentiles of a set of values.
+
+    Arguments:
+        values (array-like): Values, missing ones (NaN) are ignored.
+
+    Returns:
+        list: Percentiles 0 to 100 of the values. [0.0] * SKETCH_SIZE if there is no value.
+    """
+
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    if values.size == 0:
+        return [0.0] * SKETCH_SIZE
+    return np.percentile(values, np.linspace(0, 100, SKETCH_SIZE)).tolist()
+
+
+def sketch_quantile(sketch, q):
+    """Quantile q, in [0, 1], read from a sketch."""
+
+    position = min(max(q, 0.0), 1.0) * (len(sketch) - 1)
+    lower = int(position)
+    if lower == len(sketch) - 1:
+        return sketch[lower]
+    fraction = position - lower
+    return sketch[lower] + (sketch[lower + 1] - sketch[lower]) * fraction
+
+
+def sketch_range(sketch, ptile_start, ptile_end):
+    """Color scale limits for a pair of percentiles, at least 0.01 apart like the plots always had.
+
+    Returns:
+        tuple: start, end
+    """
+
+    start = sketch_quantile(sketch, ptile_start)
+    end = max(sketch_quantile(sketch, ptile_end), start + 0.01)
+    return start, end
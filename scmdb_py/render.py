@@ -0,0 +1,119 @@
+"""Scatter plots built and serialized by a pool of worker processes.
+
+Building the traces and hover texts of a scatter and serializing it to JSON is
+pure Python and NumPy work which holds the GIL, so the requests of one server
+process used to wait for each other's plots. With RENDER_PROCESSES set, each
+server process starts that many workers when the application is created.
+
+Workers are started by a fork server (RENDER_START_METHOD) rather than forked
+from the server process, which by the time of a request runs query threads and
+holds database and Redis connections whose locks and sockets a forked child
+would inherit. They never touch the database or the application: the columns a
+plot needs are sent to them as plain arrays (coordinates, values, and codes and
+labels of categorical columns) along with the arguments of build_scatter, and
+they return the HTML of the plot.
+
+RENDER_PROCESSES defaults to 0, which builds the plots on the request thread.
+"""
+import multiprocessing
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+from flask import current_app
+
+from .scatter import WEBGL_MIN_POINTS, build_scatter
+from .timing import span
+
+RENDER_PROCESSES = 0
+RENDER_START_METHOD = 'forkserver'
+# Seconds a plot may take in a worker before the request fails.
+RENDER_TIMEOUT = 300
+
+_pool = {}
+_lock = threading.Lock()
+
+
+def init_render_pool(app):
+    """Start the workers of this server process, called by create_app."""
+
+    with app.app_context():
+        render_pool()
+
+
+def render_pool():
+    """Worker processes of this server process, None if rendering in the request thread."""
+
+    processes = current_app.config.get('RENDER_PROCESSES', RENDER_PROCESSES)
+    if not processes:
+        return None
+
+    pid = os.getpid()
+    with _lock:
+        if _pool.get('pid') != pid:
+            context = multiprocessing.get_context(current_app.config.get('RENDER_START_METHOD', RENDER_START_METHOD))
+            if context.get_start_method() == 'forkserver':
+                # Imported once by the fork server rather than by each worker.
+                context.set_forkserver_preload([__name__])
+            _pool['pid'] = pid
+            _pool['pool'] = context.Pool(processes)
+        return _pool['pool']
+
+
+def scatter_columns(points, modality, group_column, continuous):
+    """Columns of a scatter frame used by build_scatter, as plain arrays.
+
+    Returns:
+        dict: Column name to a float ndarray for coordinates, values and continuous groups, else to a tuple of
+            integer codes (-1 for missing values) and the list of labels.
+    """
+
+    numeric = [modality.x, modality.y, modality.z, modality.value]
+    if continuous:
+        numeric.append(group_column)
+    labelled = [column for label, column in modality.hover_fields + modality.group_hover_fields]
+    if not continuous:
+        labelled.append(group_column)
+
+    columns = {}
+    for column in numeric:
+        if column is not None:
+            columns[column] = np.asarray(points[column].values)
+    for column in labelled:
+        if column in columns:
+            continue
+        values = points[column]
+        if hasattr(values, 'cat'):
+            columns[column] = (values.cat.codes.values, list(values.cat.categories))
+        else:
+            codes, labels = pd.factorize(values)
+            columns[column] = (codes, list(labels))
+    return columns
+
+
+def build_scatter_columns(columns, args, kwargs):
+    """Build a scatter from the arrays of scatter_columns. Run by the workers."""
+
+    points = pd.DataFrame({column: pd.Categorical.from_codes(*values) if isinstance(values, tuple) else values
+                           for column, values in columns.items()})
+    return build_scatter(points, *args, **kwargs)
+
+
+def render_scatter(points, modality, grouping, group_column, *args, **kwargs):
+    """Build a scatter plot with scatter.build_scatter, in a worker process when there are any.
+
+    Takes the arguments of build_scatter.
+
+    Returns:
+        str: HTML generated by Plot.ly.
+    """
+
+    kwargs.setdefault('webgl_min_points', current_app.config.get('SCATTER_WEBGL_MIN_POINTS', WEBGL_MIN_POINTS))
+    pool = render_pool()
+    with span('figure'):
+        if pool is None:
+            return build_scatter(points, modality, grouping, group_column, *args, **kwargs)
+        columns = scatter_columns(points, modality, group_column, kwargs.get('continuous', False))
+        return pool.apply_async(build_scatter_columns, (columns, (modality, grouping, group_column) + args, kwargs)).get(
+            current_app.config.get('RENDER_TIMEOUT', RENDER_TIMEOUT))
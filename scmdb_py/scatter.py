@@ -0,0 +1,500 @@
+"""tSNE scatter plots shared by the methylation, snATAC-seq and RNA-seq views.
+
+All modalities draw the same figure: cells colored by group next to the same
+cells colored by a gene value. A ScatterModality tells build_scatter which
+columns of the data frame hold the coordinates, the value and the hover labels.
+Figures are assembled as plain dicts from the layout templates below rather
+than through plotly.graph_objs, whose validation dominates the time spent on
+plots with tens of thousands of cells.
+"""
+import colorsys
+import copy
+import json
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from flask import current_app
+from numpy import arange, linspace
+
+from .lazy import lazy_import
+from .quantiles import quantile_sketch, sketch_range
+from .timing import timed
+
+cl = lazy_import('colorlover')
+plotly = lazy_import('plotly')
+
+num_sigfigs_ticklabels = 2
+WEBGL_MIN_POINTS = 5000  # Default for SCATTER_WEBGL_MIN_POINTS
+
+
+ScatterModality = namedtuple('ScatterModality', ['x', 'y', 'z', 'value', 'value_label', 'value_digits',
+                                                 'colorbar_title', 'subplot_title', 'hover_fields',
+                                                 'group_hover_fields'])
+ScatterModality.__doc__ = """Describes the columns of a modality's data frame.
+
+    x, y, z: tSNE coordinate columns, z is None for 2D embeddings.
+    value: Column plotted in the right hand subplot.
+    value_label, value_digits: Hover label and rounding of the value.
+    colorbar_title, subplot_title: Titles of the value subplot.
+    hover_fields: (label, column) pairs shown when hovering any cell.
+    group_hover_fields: Extra (label, column) pairs for the group subplot.
+"""
+
+
+def methylation_scatter_modality(tsne_type, methylation_type, level, clustering, grouping):
+    """Modality of the data frames returned by get_gene_methylation and get_mult_gene_methylation."""
+    context = methylation_type[1:]
+    return ScatterModality(
+        x='tsne_x_' + tsne_type,
+        y='tsne_y_' + tsne_type,
+        z=None if 'ndim2' in tsne_type else 'tsne_z_' + tsne_type,
+        value=methylation_type + '/' + context + '_' + level,
+        value_label='<b>' + level.title() + ' ' + methylation_type + '</b>',
+        value_digits=6,
+        colorbar_title=level.capitalize() + ' ' + methylation_type,
+        subplot_title=level.title() + " Methylation (" + methylation_type + ")",
+        hover_fields=(('Annotation', 'annotation_' + clustering),
+                      ('Cluster', 'cluster_' + clustering),
+                      ('RS2 Target Region', 'target_region'),
+                      ('Dataset', 'dataset')),
+        group_hover_fields=(('<b>' + grouping + '</b>', 'grouping'),))
+
+
+def counts_scatter_modality(suffix):
+    """Modality of snATAC-seq (suffix "ATAC") and RNA-seq (suffix "RNA") normalized counts."""
+    return ScatterModality(
+        x='tsne_x_' + suffix,
+        y='tsne_y_' + suffix,
+        z=None,
+        value='normalized_counts',
+        value_label='<b>Normalized Counts</b>',
+        value_digits=5,
+        colorbar_title='Normalized Counts',
+        subplot_title='Normalized Counts',
+        hover_fields=(('Annotation', 'annotation_' + suffix),
+                      ('Cluster', 'cluster_' + suffix),
+                      ('RS2 Target Region', 'target_region'),
+                      ('Dataset', 'dataset')),
+        group_hover_fields=())
+
+
+## Layout templates, deep copied for every figure ##
+
+AXIS_2D = {
+    'type': 'linear',
+    'ticks': '',
+    'dtick': 10,
+    'tickwidth': 0,
+    'showticklabels': False,
+    'showline': True,
+    'showgrid': False,
+    'zeroline': False,
+    'linecolor': 'black',
+    'linewidth': 0.5,
+    'mirror': False,
+}
+
+LAYOUT_2D = {
+    'autosize': True,
+    'height': 550,
+    'legend': {'y': 0.95,
+               'tracegroupgap': 0.5,
+               'bgcolor': 'rgba(0,0,0,0)'},
+    'margin': {'l': 0,
+               'r': 0,
+               'b': 30,
+               't': 130},
+    'xaxis': dict(AXIS_2D, domain=[0, 0.49], anchor='y', scaleanchor='x2'),
+    'xaxis2': dict(AXIS_2D, domain=[0.51, 1], anchor='y', scaleanchor='y'),
+    'yaxis': dict(AXIS_2D, domain=[0, 1], anchor='x', side='right'),
+    'hovermode': 'closest',
+}
+
+AXIS_3D = {
+    'titlefont': {'color': 'rgba(1,2,2,1)',
+                  'size': 12},
+    'type': 'linear',
+    'ticks': '',
+    'showticklabels': False,
+    'tickwidth': 0,
+    'showline': True,
+    'showgrid': False,
+    'zeroline': False,
+    'linecolor': 'black',
+    'linewidth': 0.5,
+    'mirror': True,
+}
+
+SCENE_3D = {
+    'camera': {'eye': {'x': 1.2, 'y': 1.5, 'z': 0.7},
+               'center': {'x': 0.25, 'z': -0.1}},
+    'aspectmode': 'data',
+    'xaxis': dict(AXIS_3D, title='tSNE 1'),
+    'yaxis': dict(AXIS_3D, title='tSNE 2'),
+    'zaxis': dict(AXIS_3D, title='tSNE 3'),
+}
+
+LAYOUT_3D = {
+    'autosize': True,
+    'height': 450,
+    'width': 1000,
+    'titlefont': {'color': 'rgba(1,2,2,1)',
+                  'size': 16},
+    'legend': {'x': -.1,
+               'y': 1,
+               'bgcolor': 'rgba(0,0,0,0)'},
+    'margin': {'l': 49,
+               'r': 0,
+               'b': 30,
+               't': 100,
+               'pad': 10},
+    'scene1': dict(SCENE_3D, domain={'x': [0, 0.45], 'y': [0, 1]}),
+    'scene2': dict(SCENE_3D, domain={'x': [0.55, 1], 'y': [0, 1]}),
+    'hovermode': 'closest',
+}
+
+# Subplot titles sit above the middle of each half of the figure.
+SUBPLOT_TITLE = {
+    'y': 1.0,
+    'xanchor': 'center',
+    'yanchor': 'bottom',
+    'showarrow': False,
+    'xref': 'paper',
+    'yref': 'paper',
+    'font': {'size': 16},
+}
+SUBPLOT_TITLE_X = (0.225, 0.775)
+
+LEGEND_TITLE = {
+    'xanchor': 'left',
+    'yanchor': 'top',
+    'showarrow': False,
+    'xref': 'paper',
+    'yref': 'paper',
+    'font': {'size': 12,
+             'color': 'gray'},
+}
+
+PLOT_TITLE = {
+    'x': 0.5,
+    'y': 1.3,
+    'xanchor': 'center',
+    'yanchor': 'top',
+    'showarrow': False,
+    'xref': 'paper',
+    'yref': 'paper',
+    'font': {'size': 16,
+             'color': 'black'},
+}
+
+
+def generate_cluster_colors(num, grouping):
+    """Generate a list of colors given number needed.
+
+    Arguments:
+        num (int): Number of colors needed. n <= 35.
+
+    Returns:
+        list: strings containing RGB-style strings e.g. rgb(255,255,255).
+    """
+
+    if (grouping == 'dataset' or grouping == 'target_region') and num > 2 and num <= 9:
+        c = cl.scales[str(num)]['qual']['Set1']
+        return c
+
+    if num>18:
+        # c = ['hsl('+str(round(h*1.8 % 360))+',50%,50%)' for h in linspace(0, 360, num)]
+        c = ['rgb'+str(colorsys.hls_to_rgb((h*1.8/360), 0.5, 0.5)) for h in linspace(0, 360, num)]
+    else:
+        # c = ['hsl('+str(round(h*1.3 % 360))+',50%,50%)' for h in linspace(0, 360, num)]
+        c = ['rgb'+str(colorsys.hls_to_rgb((h*1.3 / 360), 0.5, 0.5)) for h in linspace(0, 360, num)]
+
+    c=c+c
+    return c
+
+
+def use_webgl(num_points, min_points=None):
+    """Decide whether a 2D scatter plot should be drawn with WebGL instead of SVG.
+
+    SVG rendering becomes sluggish past a few thousand markers while scattergl
+    stays interactive with 100k cells. The threshold can be changed with the
+    SCATTER_WEBGL_MIN_POINTS setting.
+
+    Arguments:
+        num_points (int): Number of cells in each subplot.
+        min_points (int): Threshold, read from the settings when not given.
+
+    Returns:
+        bool: True if scattergl traces should be used.
+    """
+    if min_points is None:
+        min_points = current_app.config.get('SCATTER_WEBGL_MIN_POINTS', WEBGL_MIN_POINTS)
+    return num_points >= min_points
+
+
+def build_hover_texts(fields):
+    """Vectorized version of content.build_hover_text.
+
+    Arguments:
+        fields (list): (label, Series) pairs. Missing values are left out of the label.
+
+    Returns:
+        ndarray: Hover text of every row.
+    """
+
+    text = None
+    for label, values in fields:
+        if hasattr(values, 'cat'):
+            # Categorical metadata (see cells.compact_cells) is formatted once per category and gathered by code,
+            # missing values (code -1) picking the trailing ''.
+            labels = np.array([label + ': ' + str(category) for category in values.cat.categories] + [''], dtype=object)
+            part = labels[values.cat.codes.values]
+        else:
+            present = values.notnull().values
+            part = np.where(present, (label + ': ' + values.astype(str)).values, '')
+        if text is None:
+            text = part
+        else:
+            text = np.where((text != '') & (part != ''), text + '<br>' + part, text + part)
+    return text
+
+
+def plot_floats(values, decimals=6):
+    """Numbers of a column as written in the figure.
+
+    float32 columns (see cells.compact_cells) are rounded, they would otherwise be written with every digit of
+    their binary approximation.
+    """
+
+    values = np.asarray(values)
+    if values.dtype == np.float32:
+        return values.astype(np.float64).round(decimals)
+    return values
+
+
+def points_bounds(x, y, tsne_outlier_bool):
+    """Bounds of the plotted cells, for embeddings without precomputed bounds (see cells.get_embedding_bounds)."""
+
+    bounds = []
+    for values in (pd.Series(x), pd.Series(y)):
+        if tsne_outlier_bool:
+            bounds += [values.quantile(0.001), values.quantile(0.999)]
+        else:
+            bounds += [values.min(), values.max()]
+    return bounds
+
+
+def padded_range(bottom, top):
+    """Axis range with 10% padding on both sides."""
+
+    padding = (top - bottom) * 0.1
+    return [bottom - padding, top + padding]
+
+
+def colorbar_ticks(start, end):
+    """Colorbar tick values and labels, the ends being labelled as open ranges."""
+
+    steps = arange(start, end, (end - start) / 4)
+    tickvals = list(steps)
+    tickvals[0] = start
+    tickvals.append(end)
+    ticktext = [str(round(x, num_sigfigs_ticklabels)) for x in steps]
+    ticktext[0] = '<' + str(round(start, num_sigfigs_ticklabels))
+    ticktext.append('>' + str(round(end, num_sigfigs_ticklabels)))
+    return tickvals, ticktext
+
+
+def group_name(group, grouping):
+    """Legend label of a group of cells."""
+    if grouping == 'cluster':
+        return 'cluster_' + str(group)
+    elif grouping == 'dataset':
+        return "_".join(str(group).split('_')[1:])
+    return str(group)
+
+
+def build_scatter(points, modality, grouping, group_column, title, ptile_start, ptile_end, tsne_outlier_bool,
+                  continuous=False, bounds=None, sketch=None, webgl_min_points=None):
+    """Generate the tSNE scatter plot of cells colored by group and by value.
+
+    Arguments:
+        points (DataFrame): One row per cell, with the columns named in `modality`.
+        modality (ScatterModality): Column names and labels of the modality.
+        grouping (str): Variable the cells are grouped by, used for legend labels.
+        group_column (str): Column holding the group of each cell.
+        title (str): Title of the figure.
+        ptile_start (float): Lower end of color percentile. [0, 1].
+        ptile_end (float): Upper end of color percentile. [0, 1].
+        tsne_outlier_bool (bool): Whether or not to change X and Y axes range to hide outliers.
+        continuous (bool): Whether `group_column` is numerical, in which case cells are colored by it instead of
+            being split in groups.
+        bounds (dict): Bounds of the whole embedding from cells.get_embedding_bounds. Computed from `points` when
+            not given.
+        sketch (list): Quantile sketch of the values (see quantiles), used for the color percentiles. Computed from
+            `points` when not given.
+        webgl_min_points (int): Number of cells from which WebGL is used, see use_webgl.
+
+    Returns:
+        str: HTML generated by Plot.ly.
+    """
+
+    is_3d = modality.z is not None
+    if is_3d:
+        trace_type = 'scatter3d'
+    elif use_webgl(len(points), webgl_min_points):
+        trace_type = 'scattergl'
+    else:
+        trace_type = 'scatter'
+
+    if len(points) > 3000:
+        marker_size = 2
+    else:
+        marker_size = 4
+
+    coordinates = [plot_floats(points[modality.x].values), plot_floats(points[modality.y].values)]
+    if is_3d:
+        coordinates.append(plot_floats(points[modality.z].values))
+
+    hover_fields = [(label, points[column]) for label, column in modality.hover_fields]
+    group_text = build_hover_texts(hover_fields + [(label, points[column]) for label, column in modality.group_hover_fields])
+    values = plot_floats(points[modality.value].values).astype(float)
+    value_text = build_hover_texts(hover_fields + [(modality.value_label, pd.Series(values).round(modality.value_digits))])
+
+    ## Cells colored by group ##
+    traces = []
+    if continuous:
+        traces.append(scatter_trace(trace_type, 1, coordinates, group_text,
+                                    {'color': plot_floats(points[group_column].values), 'colorscale': 'Viridis', 'size': marker_size},
+                                    name='', showlegend=False))
+    else:
+        group_values = points[group_column]
+        if hasattr(group_values, 'cat'):
+            # Factorize the category codes rather than the labels, missing groups (code -1) as NaN.
+            category_codes = group_values.cat.codes.values
+            codes, uniques = pd.factorize(np.where(category_codes >= 0, category_codes, np.nan))
+            groups = group_values.cat.categories[uniques.astype(int)]
+        else:
+            codes, groups = pd.factorize(group_values)
+        colors = generate_cluster_colors(len(groups), grouping)
+        order = np.argsort(codes, kind='mergesort')
+        edges = np.searchsorted(codes[order], np.arange(len(groups) + 1))
+        for i, group in enumerate(groups):
+            rows = order[edges[i]:edges[i+1]]
+            marker = {'color': colors[i], 'size': marker_size}
+            if is_3d:
+                marker['opacity'] = 0.8
+            trace = scatter_trace(trace_type, 1, [c[rows] for c in coordinates], group_text[rows], marker,
+                                  name=group_name(group, grouping))
+            # Toggling legend groups does not work with WebGL traces. Every group has its own trace, so the legend
+            # behaves the same without it.
+            if trace_type != 'scattergl':
+                trace['legendgroup'] = str(group)
+            traces.append(trace)
+
+    ## Cells colored by value ##
+    if sketch is None:
+        sketch = quantile_sketch(values)
+    start, end = sketch_range(sketch, ptile_start, ptile_end)
+    tickvals, ticktext = colorbar_ticks(start, end)
+    colorbar = {
+        'x': 1.05,
+        'len': 0.5,
+        'thickness': 10,
+        'title': modality.colorbar_title,
+        'titleside': 'right',
+        'tickmode': 'array',
+        'tickvals': tickvals,
+        'ticktext': ticktext,
+        'tickfont': {'size': 10},
+    }
+    missing = np.isnan(values)
+
+    # Values are sent unclipped and the color range is pinned with cmin/cmax, so that the browser can move the
+    # percentiles with Plotly.restyle (see restyleScatterColors in customview.js).
+    if trace_type == 'scattergl':
+        # scattergl can not mix color names with numbers in marker.color, so cells without data get a trace of
+        # their own, drawn underneath.
+        if missing.any():
+            traces.append(scatter_trace(trace_type, 2, [c[missing] for c in coordinates], value_text[missing],
+                                        {'color': 'grey', 'size': marker_size}, showlegend=False))
+        present = ~missing
+        traces.append(scatter_trace(trace_type, 2, [c[present] for c in coordinates], value_text[present],
+                                    {'color': values[present], 'colorscale': 'Viridis', 'size': marker_size,
+                                     'cmin': start, 'cmax': end, 'cauto': False, 'colorbar': colorbar},
+                                    showlegend=False))
+    else:
+        colors = values.astype(object)
+        colors[missing] = 'grey'
+        traces.append(scatter_trace(trace_type, 2, coordinates, value_text,
+                                    {'color': colors, 'colorscale': 'Viridis', 'size': marker_size,
+                                     'cmin': start, 'cmax': end, 'cauto': False, 'colorbar': colorbar},
+                                    showlegend=False))
+
+    ## Layout ##
+    if grouping == 'cluster':
+        annotation_additional_y = 0.025  # Necessary because legend items overlap with legend title (annotation) when there are many legend items
+    else:
+        annotation_additional_y = 0.00
+    if grouping == 'cluster' or grouping == 'annotation':
+        layout_width = 1000
+        legend_x = -.14
+    else:
+        layout_width = 1100
+        legend_x = -.17
+
+    subplot_titles = [dict(SUBPLOT_TITLE, text=text, x=x)
+                      for text, x in zip(("tSNE", modality.subplot_title), SUBPLOT_TITLE_X)]
+
+    if is_3d:
+        layout = copy.deepcopy(LAYOUT_3D)
+        layout['title'] = title
+        layout['annotations'] = subplot_titles + [dict(LEGEND_TITLE, text=grouping.title(), x=-.09,
+                                                       y=1.03 + annotation_additional_y)]
+    else:
+        layout = copy.deepcopy(LAYOUT_2D)
+        layout['width'] = layout_width
+        layout['legend']['x'] = legend_x
+        if bounds is None:
+            x_min, x_max, y_min, y_max = points_bounds(coordinates[0], coordinates[1], tsne_outlier_bool)
+        else:
+            x_min, x_max, y_min, y_max = bounds['trimmed' if tsne_outlier_bool else 'full']
+        layout['xaxis']['range'] = padded_range(x_min, x_max)
+        layout['xaxis2']['range'] = layout['xaxis']['range']
+        layout['yaxis']['range'] = padded_range(y_min, y_max)
+        layout['annotations'] = subplot_titles + [dict(LEGEND_TITLE, text=grouping.title(), x=legend_x+0.05,
+                                                       y=1.02 + annotation_additional_y),
+                                                  dict(PLOT_TITLE, text=title)]
+
+    return timed('serialize', plotly.offline.plot,
+        figure_or_data={'data': traces, 'layout': layout},
+        output_type='div',
+        show_link=False,
+        include_plotlyjs=False,
+        validate=False) + sketch_script(sketch)
+
+
+def sketch_script(sketch):
+    """Embed the quantile sketch of a plot's values next to it, for the color percentile sliders."""
+
+    return '<script type="application/json" class="color-sketch">' + json.dumps(sketch) + '</script>'
+
+
+def scatter_trace(trace_type, subplot, coordinates, text, marker, **kwargs):
+    """Build a marker trace for the left (1) or right (2) subplot."""
+
+    trace = {'type': trace_type,
+             'mode': 'markers',
+             'x': coordinates[0],
+             'y': coordinates[1],
+             'text': text,
+             'marker': marker,
+             'hoverinfo': 'text'}
+    if trace_type == 'scatter3d':
+        trace['z'] = coordinates[2]
+        trace['scene'] = 'scene' + str(subplot)
+    else:
+        trace['xaxis'] = 'x' if subplot == 1 else 'x2'
+        trace['yaxis'] = 'y'
+    trace.update(kwargs)
+    return trace
@@ -0,0 +1,193 @@
+"""Arrays built once and memory-mapped by every server process.
+
+Each mod_wsgi process used to fetch and keep its own copy of the same per
+ensemble arrays, so every process added to the server multiplied their memory.
+load_shared_arrays saves the arrays as .npy files in SHARED_ARRAYS_DIR (tmpfs at
+/dev/shm/scmdb_py by default) and maps them read-only, so the processes share
+the same pages. The first process to ask for them builds them while holding a
+file lock; the other processes wait and then map what it wrote.
+
+Arrays of a key are kept in a directory of their own, named after the time they
+were built:
+
+    <SHARED_ARRAYS_DIR>/<key>@<build time>/<name>.npy
+    <SHARED_ARRAYS_DIR>/<key>@<build time>/meta.json    names and version
+
+They are rebuilt when the caller gives another version (ie. the modification
+time of the file they are computed from) or when they are older than max_age.
+The previous directory is then deleted, processes which still map it keep their
+pages until they map the new one.
+"""
+import fcntl
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from flask import current_app
+
+from . import basedir
+
+# Arrays mapped by this process, by key.
+_attached = {}
+_lock = threading.Lock()
+
+
+def shared_dir():
+    """Directory of the shared arrays, set with SHARED_ARRAYS_DIR."""
+
+    default = '/dev/shm/scmdb_py' if os.path.isdir('/dev/shm') else os.path.join(basedir, 'tmp', 'shared')
+    return current_app.config.get('SHARED_ARRAYS_DIR', default)
+
+
+def latest_build(path):
+    """Newest directory of arrays built for a key, and its metadata.
+
+    Returns:
+        tuple: directory and metadata. None if the arrays have never been built.
+    """
+
+    parent, name = os.path.split(path)
+    try:
+        builds = [entry for entry in os.listdir(parent)
+                  if '@' in entry and entry.rsplit('@', 1)[0] == name and not entry.endswith('.tmp')]
+    except OSError:
+        return None
+
+    for build in sorted(builds, key=lambda entry: float(entry.rsplit('@', 1)[1]), reverse=True):
+        try:
+            with open(os.path.join(parent, build, 'meta.json')) as f:
+                return os.path.join(parent, build), json.load(f)
+        except (IOError, OSError, ValueError):
+            continue  # Deleted meanwhile
+    return None
+
+
+def is_current(meta, version, max_age):
+    """Whether arrays built with meta can be used for version."""
+
+    return meta['version'] == version and (max_age is None or time.time() - meta['built'] < max_age)
+
+
+def attach(directory, meta):
+    """Memory-map the arrays of a build."""
+
+    arrays = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r') for name in meta['arrays']}
+    return {'directory': directory, 'meta': meta, 'arrays': arrays}
+
+
+def save_build(path, arrays, version):
+    """Write the arrays of a key in a new directory and delete the older ones.
+
+    Returns:
+        tuple: directory and metadata of the new build.
+    """
+
+    built = time.time()
+    directory = '{}@{:.6f}'.format(path, built)
+    os.makedirs(directory + '.tmp')
+    for name, array in arrays.items():
+        np.save(os.path.join(directory + '.tmp', name + '.npy'), np.ascontiguousarray(array))
+    meta = {'version': version, 'built': built, 'arrays': sorted(arrays)}
+    with open(os.path.join(directory + '.tmp', 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    # Renamed when complete so that other processes never map a partial build.
+    os.rename(directory + '.tmp', directory)
+
+    parent, name = os.path.split(path)
+    for entry in os.listdir(parent):
+        if entry.rsplit('@', 1)[0] == name and '@' in entry and os.path.join(parent, entry) != directory:
+            shutil.rmtree(os.path.join(parent, entry), ignore_errors=True)
+
+    return directory, meta
+
+
+@contextmanager
+def build_lock(path):
+    """Hold the file lock under which the arrays of a key are built and older builds deleted."""
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def current_build(path, build, version, max_age):
+    """Latest build of a key if it can be used, else a new one. Called with the build lock held.
+
+    Returns:
+        tuple: directory and metadata. None if build returned None.
+    """
+
+    found = latest_build(path)
+    if found is None or not is_current(found[1], version, max_age):
+        arrays = build()
+        if arrays is None:
+            return None
+        found = save_build(path, arrays, version)
+    return found
+
+
+def load_shared_arrays(key, build, version=None, max_age=None):
+    """Arrays shared by the server processes, built by the first process which needs them.
+
+    Takes the arguments of load_shared_build.
+
+    Returns:
+        dict: Read-only arrays by name. None if build returned None.
+    """
+
+    attached = load_shared_build(key, build, version, max_age)
+    return None if attached is None else attached['arrays']
+
+
+def load_shared_build(key, build, version=None, max_age=None):
+    """Arrays shared by the server processes, along with the directory they were built in.
+
+    The directory changes whenever the arrays are rebuilt, so that values computed from them can be kept by
+    directory.
+
+    Arguments:
+        key (str): Name of the arrays, may contain slashes. ie. Ens1/embedding__mCH_ndim2_perp20
+        build (function): Called without arguments to compute the arrays, returns a dict of name to ndarray or
+            None when there is nothing to build. Arrays must not hold Python objects, store strings as str arrays.
+        version: JSON value the arrays are computed from, they are rebuilt when it changes.
+        max_age (float): Seconds after which the arrays are rebuilt. Never when None.
+
+    Returns:
+        dict: directory of the build, its meta and arrays, the read-only arrays by name. None if build returned
+            None.
+    """
+
+    with _lock:
+        attached = _attached.get(key)
+    if attached is not None and is_current(attached['meta'], version, max_age):
+        return attached
+
+    path = os.path.join(shared_dir(), key)
+    found = latest_build(path)
+    if found is None or not is_current(found[1], version, max_age):
+        with build_lock(path):
+            # Another process may have built them while this one waited for the lock.
+            found = current_build(path, build, version, max_age)
+        if found is None:
+            return None
+
+    try:
+        attached = attach(*found)
+    except (IOError, OSError):
+        # Replaced or deleted meanwhile. Builds are only deleted under the lock, map one while holding it.
+        with build_lock(path):
+            found = current_build(path, build, version, max_age)
+            if found is None:
+                return None
+            attached = attach(*found)
+    with _lock:
+        _attached[key] = attached
+    return attached
@@ -0,0 +1,270 @@
+"""Slow queries of the data databases, by shape, with their EXPLAIN plans.
+
+Queries of the content module are built as strings, with the names of ensemble
+and gene tables and most values written in them, so the same query is run under
+thousands of texts. Every statement executed on the SLOW_QUERY_BINDS engines is
+timed and counted under its shape: its text with literals replaced by ? and
+ensemble and gene tables by Ens? and gene_?. The ensembles it ran on are
+counted for each shape.
+
+When a SELECT takes longer than SLOW_QUERY_SECONDS and is the slowest of its
+shape so far, its EXPLAIN output is captured on another connection along with
+the text, the parameters and the function of the package which ran it.
+
+Each server process keeps the SLOW_QUERY_SHAPES shapes which took the most
+time and writes them every few seconds to <SHARED_ARRAYS_DIR>/slow_queries/
+<pid>.json. The admin page /admin/slow_queries merges the files written in the
+last SLOW_QUERY_WINDOW seconds. Statements are timed until they return, except
+those of fetch.read_frame: their rows are streamed from the server as they are
+read, so a slow query may return at once and take its time in the reads. They
+are timed until read_frame has read the last row (see record_streamed).
+"""
+import datetime
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+from sqlalchemy import event
+
+from . import db
+from .shared import shared_dir
+
+SLOW_QUERY_BINDS = ['methylation_data', 'snATAC_data', 'RNA_data']
+SLOW_QUERY_SECONDS = 1.0
+SLOW_QUERY_SHAPES = 500
+SLOW_QUERY_WINDOW = 86400
+# Seconds between two writes of the statistics of a process.
+FLUSH_SECONDS = 10
+# Characters of the text and parameters of a slow statement which are kept.
+STATEMENT_LENGTH = 4000
+# Modules whose functions only pass queries on, the caller of a query is looked up past them.
+HELPER_MODULES = ['slow_queries', 'fetch', 'executor', 'timing']
+
+LITERALS = [(re.compile(r"'(?:[^'\\]|\\.|'')*'"), '?'),
+            (re.compile(r'"(?:[^"\\]|\\.|"")*"'), '?'),
+            (re.compile(r'\bEns\d+\b'), 'Ens?'),
+            (re.compile(r'\bgene_\w+'), 'gene_?'),
+            (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+            (re.compile(r'\(\s*(?:\?|%s)(?:\s*,\s*(?:\?|%s))+\s*\)'), '(?, ...)'),
+            (re.compile(r'\s+'), ' ')]
+ENSEMBLE = re.compile(r'\bEns\d+\b')
+
+_stats = {}
+_settings = {}
+_lock = threading.Lock()
+
+
+def query_shape(statement):
+    """Text of a statement with its literals and the names of ensemble and gene tables replaced.
+
+    Returns:
+        tuple: Shape of the statement and the ensembles it names.
+    """
+
+    shape = statement
+    for pattern, replacement in LITERALS:
+        shape = pattern.sub(replacement, shape)
+    return shape.strip(), sorted(set(ENSEMBLE.findall(statement)))
+
+
+def query_caller():
+    """Function of the package which ran the current query, as module.function:line."""
+
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        package, _, name = module.rpartition('.')
+        if package == __package__ and name not in HELPER_MODULES:
+            return '{}.{}:{}'.format(name, frame.f_code.co_name, frame.f_lineno)
+        frame = frame.f_back
+    return None
+
+
+def explain_query(engine, statement, parameters):
+    """EXPLAIN output of a statement, run on a connection of its own.
+
+    Returns:
+        dict: columns, the names of the columns of the plan, and rows, lists of values.
+    """
+
+    # Any error is reported in the plan, the query which was explained has succeeded.
+    try:
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            # The statement is in the form given to the DBAPI cursor, run it with the same parameters.
+            cursor.execute('EXPLAIN ' + statement, parameters)
+            columns = [column[0] for column in cursor.description]
+            rows = [[None if value is None else str(value) for value in row] for row in cursor.fetchall()]
+            cursor.close()
+        finally:
+            connection.close()
+    except Exception as e:
+        now = datetime.datetime.now()
+        print("[{}] ERROR in app(explain_query): {}".format(str(now), e))
+        sys.stdout.flush()
+        return {'columns': ['error'], 'rows': [[str(e)]]}
+    return {'columns': columns, 'rows': rows}
+
+
+def record_query(engine, bind, statement, parameters, seconds):
+    """Count a statement under its shape, and capture its plan if it is the slowest of its shape."""
+
+    shape, ensembles = query_shape(statement)
+    slow = seconds >= _settings['seconds'] and statement.lstrip()[:6].upper() == 'SELECT'
+    with _lock:
+        if _stats.get('pid') != os.getpid():
+            # Forked from another server process.
+            _stats.clear()
+            _stats.update(pid=os.getpid(), flushed=time.time(), shapes={})
+        shapes = _stats['shapes']
+        entry = shapes.get(shape)
+        if entry is None:
+            if len(shapes) >= _settings['shapes']:
+                del shapes[min(shapes, key=lambda key: shapes[key]['total'])]
+            entry = shapes[shape] = {'bind': bind, 'count': 0, 'slow': 0, 'total': 0.0, 'max': 0.0,
+                                     'ensembles': {}, 'callers': {}, 'plan': None}
+        entry['count'] += 1
+        entry['total'] += seconds
+        entry['max'] = max(entry['max'], seconds)
+        entry['last'] = time.time()
+        for ensemble in ensembles:
+            entry['ensembles'][ensemble] = entry['ensembles'].get(ensemble, 0) + 1
+        capture = slow and (entry['plan'] is None or seconds > entry['plan']['seconds'])
+        if slow:
+            entry['slow'] += 1
+
+    if slow:
+        caller = query_caller()
+        with _lock:
+            entry['callers'][caller] = entry['callers'].get(caller, 0) + 1
+        if capture:
+            plan = {'seconds': seconds, 'statement': statement[:STATEMENT_LENGTH],
+                    'parameters': repr(parameters)[:STATEMENT_LENGTH], 'caller': caller,
+                    'time': time.time(), 'explain': explain_query(engine, statement, parameters)}
+            with _lock:
+                if entry['plan'] is None or seconds > entry['plan']['seconds']:
+                    entry['plan'] = plan
+
+    if time.time() - _stats['flushed'] > FLUSH_SECONDS:
+        flush_stats()
+
+
+def record_streamed(connection):
+    """Record the streamed statement of a connection once its rows have been read. Called by fetch.read_frame."""
+
+    streamed = connection.info.pop('slow_query_streamed', None)
+    if streamed is not None:
+        engine, bind, statement, parameters, start = streamed
+        record_query(engine, bind, statement, parameters, time.perf_counter() - start)
+
+
+def flush_stats():
+    """Write the statistics of this process to <directory>/<pid>.json."""
+
+    with _lock:
+        if not _stats.get('shapes'):
+            return
+        _stats['flushed'] = time.time()
+        snapshot = json.dumps({'pid': _stats['pid'], 'time': _stats['flushed'], 'shapes': _stats['shapes']})
+
+    path = os.path.join(_settings['directory'], '{}.json'.format(os.getpid()))
+    try:
+        os.makedirs(_settings['directory'], exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            f.write(snapshot)
+        os.replace(path + '.tmp', path)
+    except (IOError, OSError) as e:
+        now = datetime.datetime.now()
+        print("[{}] ERROR in app(flush_stats): {}".format(str(now), e))
+        sys.stdout.flush()
+
+
+def top_queries(top=50, sort='total'):
+    """Shapes of query which took the most time, merged over the server processes.
+
+    Arguments:
+        top (int): Number of shapes.
+        sort (str): total, max, count or slow.
+
+    Returns:
+        list: Statistics of each shape, longest first.
+    """
+
+    flush_stats()
+    merged = {}
+    directory = _settings['directory']
+    try:
+        names = [name for name in os.listdir(directory) if name.endswith('.json')]
+    except OSError:
+        names = []
+    for name in names:
+        try:
+            with open(os.path.join(directory, name)) as f:
+                snapshot = json.load(f)
+        except (IOError, OSError, ValueError):
+            continue  # Being replaced
+        if time.time() - snapshot['time'] > _settings['window']:
+            continue
+
+        for shape, entry in snapshot['shapes'].items():
+            if shape not in merged:
+                merged[shape] = dict(entry, shape=shape, ensembles={}, callers={}, processes=0)
+            else:
+                query = merged[shape]
+                query['count'] += entry['count']
+                query['slow'] += entry['slow']
+                query['total'] += entry['total']
+                query['max'] = max(query['max'], entry['max'])
+                query['last'] = max(query['last'], entry['last'])
+                if entry['plan'] is not None and (query['plan'] is None
+                                                  or entry['plan']['seconds'] > query['plan']['seconds']):
+                    query['plan'] = entry['plan']
+            query = merged[shape]
+            query['processes'] += 1
+            for counts in ['ensembles', 'callers']:
+                for key, count in entry[counts].items():
+                    query[counts][key] = query[counts].get(key, 0) + count
+
+    queries = sorted(merged.values(), key=lambda query: query[sort], reverse=True)[:top]
+    for query in queries:
+        query['mean'] = query['total'] / query['count']
+        for counts in ['ensembles', 'callers']:
+            query[counts] = sorted(query[counts].items(), key=lambda item: item[1], reverse=True)
+    return queries
+
+
+def init_slow_queries(app):
+    """Time the statements executed on the engines of the SLOW_QUERY_BINDS binds of an application."""
+
+    with app.app_context():
+        _settings.update(seconds=app.config.get('SLOW_QUERY_SECONDS', SLOW_QUERY_SECONDS),
+                         shapes=app.config.get('SLOW_QUERY_SHAPES', SLOW_QUERY_SHAPES),
+                         window=app.config.get('SLOW_QUERY_WINDOW', SLOW_QUERY_WINDOW),
+                         directory=os.path.join(shared_dir(), 'slow_queries'))
+
+        binds = app.config.get('SQLALCHEMY_BINDS') or {}
+        for bind in app.config.get('SLOW_QUERY_BINDS', SLOW_QUERY_BINDS):
+            if bind in binds:
+                listen_engine(db.get_engine(app, bind), bind)
+
+
+def listen_engine(engine, bind):
+    """Time the statements of an engine."""
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('slow_query_starts', []).append(time.perf_counter())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info['slow_query_starts'].pop()
+        if context is not None and context.execution_options.get('stream_results'):
+            # Recorded by record_streamed after the rows are read.
+            conn.info['slow_query_streamed'] = (engine, bind, statement, parameters, start)
+            return
+        record_query(engine, bind, statement, parameters, time.perf_counter() - start)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
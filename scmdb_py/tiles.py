@@ -0,0 +1,240 @@
+"""Viewport tiles for zooming into tSNE scatter plots.
+
+The scatter plots only ship a random `max_points` sample of an ensemble. When
+the user zooms in, the browser asks for the tiles covering the visible region
+and overlays them. Tiles follow the usual quadtree layout: zoom level z splits
+the embedding bounding box into 2^z x 2^z tiles, tile (0, 0) being the bottom
+left one. Each tile holds at most `TILE_POINTS` cells, picked by a fixed random
+priority, so deeper zoom levels show progressively denser subsets of the same
+cells.
+
+The coordinates and priorities of the index are shared by the server processes
+(see shared), each process builds its own k-d tree over them once per build of
+the embedding.
+"""
+import datetime
+import os
+import sys
+import threading
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import exc
+
+from . import cache, db
+from .cells import load_embedding
+from .fetch import read_frame
+from .lazy import lazy_import
+from .shared import load_shared_arrays
+
+spatial = lazy_import('scipy.spatial')
+
+TILE_POINTS = 2000
+MAX_ZOOM = 12
+
+# Spatial indexes of this process, by (ensemble, tsne_type, modality). Flask-Cache
+# pickles cached values, which would copy the tree and the coordinates on every lookup.
+_indexes = {}
+_lock = threading.Lock()
+
+
+def get_spatial_index(ensemble, tsne_type, modality='methylation'):
+    """Build a k-d tree over the tSNE coordinates of an ensemble.
+
+    Coordinates are rescaled to the unit square so that tiles are squares in
+    the index regardless of the aspect ratio of the embedding. The index is
+    kept until the embedding is rebuilt.
+
+    Arguments:
+        ensemble (str): Ensemble identifier. (Eg. Ens0, Ens1, Ens2...).
+        tsne_type (str): Suffix of the tSNE columns. ie. mCH_ndim2_perp20
+        modality (str): methylation, snATAC or RNA
+
+    Returns:
+        dict: build (of the embedding), cell_id, xy (original coordinates),
+            unit (rescaled coordinates), priority, tree and bounds
+            [xmin, xmax, ymin, ymax]. None if the embedding is not available.
+    """
+
+    embedding = load_embedding(ensemble, tsne_type, modality)
+    if embedding is None:
+        return None
+
+    key = (ensemble, tsne_type, modality)
+    with _lock:
+        index = _indexes.get(key)
+    if index is not None and index['build'] == embedding['build']:
+        return index
+
+    x, y = embedding['arrays']['x'], embedding['arrays']['y']
+    bounds = [float(x.min()), float(x.max()), float(y.min()), float(y.max())]
+
+    def build():
+        xy = np.column_stack([x, y]).astype(np.float64)
+        lower = np.array([bounds[0], bounds[2]])
+        extent = np.array([bounds[1] - bounds[0], bounds[3] - bounds[2]])
+        extent[extent == 0] = 1
+
+        # Fixed seed: the same cells are shown for a tile on every request.
+        return {'xy': xy,
+                'unit': (xy - lower) / extent,
+                'priority': np.random.RandomState(0).permutation(len(xy))}
+
+    # Rebuilt along with the embedding.
+    arrays = load_shared_arrays(os.path.join('tiles', modality, ensemble, tsne_type), build,
+                                version=embedding['build'])
+    index = {'build': embedding['build'],
+             'cell_id': embedding['frame']['cell_id'].values,
+             'xy': arrays['xy'],
+             'unit': arrays['unit'],
+             'priority': arrays['priority'],
+             'tree': spatial.cKDTree(arrays['unit']),
+             'bounds': bounds}
+    with _lock:
+        _indexes[key] = index
+    return index
+
+
+def get_tile_indices(index, zoom, tile_x, tile_y, tile_points=TILE_POINTS):
+    """Return the positions (in the spatial index) of the cells shown in a tile.
+
+    Arguments:
+        index (dict): Spatial index returned by get_spatial_index.
+        zoom (int): Zoom level, 0 being the whole embedding.
+        tile_x (int): Column of the tile, counted from the left.
+        tile_y (int): Row of the tile, counted from the bottom.
+        tile_points (int): Maximum number of cells in a tile.
+
+    Returns:
+        ndarray: Positions sorted by priority.
+    """
+
+    num_tiles = 2 ** zoom
+    if not (0 <= tile_x < num_tiles and 0 <= tile_y < num_tiles):
+        return np.array([], dtype=int)
+
+    center = [(tile_x + 0.5) / num_tiles, (tile_y + 0.5) / num_tiles]
+    candidates = np.asarray(index['tree'].query_ball_point(center, 0.5 / num_tiles, p=np.inf), dtype=int)
+    if candidates.size == 0:
+        return candidates
+
+    # The ball query is closed; keep only the half-open tile so that cells on a
+    # tile border are not sent twice.
+    cells = np.floor(index['unit'][candidates] * num_tiles).clip(0, num_tiles - 1)
+    candidates = candidates[(cells[:, 0] == tile_x) & (cells[:, 1] == tile_y)]
+
+    order = np.argsort(index['priority'][candidates], kind='mergesort')
+    return candidates[order[:tile_points]]
+
+
+@cache.memoize(timeout=3600)
+def get_gene_methylation_values(ensemble, tsne_type, methylation_type, gene, level, build):
+    """Return gene body methylation of every cell of an ensemble, aligned with its spatial index.
+
+    Arguments:
+        ensemble (str): Ensemble identifier. (Eg. Ens0, Ens1, Ens2...).
+        tsne_type (str): Options for calculating tSNE. ndims = number of dimensions, perp = perplexity.
+        methylation_type (str): Type of methylation to visualize. "mCH", "mCG", or "mCA"
+        gene (str): Ensembl ID of gene.
+        level (str): "original" or "normalized" methylation values.
+        build (str): Build of the embedding of the spatial index, the values are cached per build.
+
+    Returns:
+        ndarray: One value per cell of the spatial index (NaN when the cell has no coverage). None if the
+            embedding has been rebuilt since `build`.
+    """
+
+    if ";" in ensemble or ";" in methylation_type:
+        return None
+
+    index = get_spatial_index(ensemble, tsne_type)
+    if index is None or index['build'] != build:
+        return None
+
+    result = db.get_engine(current_app, 'methylation_data').execute("SELECT gene_id FROM genes WHERE gene_id LIKE %s", (gene+"%",)).fetchone()
+    if result is None:
+        return None
+    gene_table_name = 'gene_' + result.gene_id.replace('.', '_')
+
+    context = methylation_type[1:]
+    query = "SELECT %(ensemble)s.cell_id, %(gene_table_name)s.%(methylation_type)s, \
+        %(gene_table_name)s.%(context)s, cells.global_%(methylation_type)s \
+        FROM %(ensemble)s \
+        INNER JOIN cells ON cells.cell_id = %(ensemble)s.cell_id \
+        LEFT JOIN %(gene_table_name)s ON %(ensemble)s.cell_id = %(gene_table_name)s.cell_id" % {'ensemble': ensemble,
+                                                                                                   'gene_table_name': gene_table_name,
+                                                                                                   'methylation_type': methylation_type,
+                                                                                                   'context': context,}
+
+    try:
+        df = read_frame(query, db.get_engine(current_app, 'methylation_data'))
+    except exc.ProgrammingError as e:
+        now = datetime.datetime.now()
+        print("[{}] ERROR in app(get_gene_methylation_values): {}".format(str(now), e))
+        sys.stdout.flush()
+        return None
+
+    values = df[methylation_type] / df[context]
+    if level != 'original':
+        values = values / df['global_'+methylation_type]
+
+    values.index = df['cell_id']
+    return values.reindex(index['cell_id']).values
+
+
+def get_tile_info(ensemble, tsne_type, modality='methylation'):
+    """Return what the browser needs to compute which tiles are in view."""
+
+    index = get_spatial_index(ensemble, tsne_type, modality)
+    if index is None:
+        return None
+
+    return {'bounds': index['bounds'],
+            'num_cells': len(index['cell_id']),
+            'tile_points': TILE_POINTS,
+            'max_zoom': MAX_ZOOM}
+
+
+def get_methylation_tile(ensemble, tsne_type, methylation_type, gene, level, zoom, tile_x, tile_y):
+    """Return the cells of one methylation scatter tile.
+
+    Arguments:
+        ensemble (str): Ensemble identifier. (Eg. Ens0, Ens1, Ens2...).
+        tsne_type (str): Options for calculating tSNE. ndims = number of dimensions, perp = perplexity.
+        methylation_type (str): Type of methylation to visualize. "mCH", "mCG", or "mCA"
+        gene (str): Ensembl ID of gene.
+        level (str): "original" or "normalized" methylation values.
+        zoom (int): Zoom level, 0 being the whole embedding.
+        tile_x (int): Column of the tile, counted from the left.
+        tile_y (int): Row of the tile, counted from the bottom.
+
+    Returns:
+        dict: x, y and value lists for the cells in the tile. Values are None
+            for cells without coverage.
+    """
+
+    index = get_spatial_index(ensemble, tsne_type)
+    if index is None or zoom > MAX_ZOOM:
+        return None
+    # Positions in the index are only valid for the build it was made from.
+    return get_build_methylation_tile(ensemble, tsne_type, methylation_type, gene, level, zoom, tile_x, tile_y,
+                                      index['build'])
+
+
+@cache.memoize(timeout=3600)
+def get_build_methylation_tile(ensemble, tsne_type, methylation_type, gene, level, zoom, tile_x, tile_y, build):
+    """get_methylation_tile for one build of the embedding, cached per build."""
+
+    index = get_spatial_index(ensemble, tsne_type)
+    values = get_gene_methylation_values(ensemble, tsne_type, methylation_type, gene, level, build)
+    if index is None or values is None or index['build'] != build:
+        return None
+
+    positions = get_tile_indices(index, zoom, tile_x, tile_y)
+    tile_values = values[positions]
+
+    return {'zoom': zoom,
+            'tile': [tile_x, tile_y],
+            'x': index['xy'][positions, 0].tolist(),
+            'y': index['xy'][positions, 1].tolist(),
+            'value': [None if np.isnan(v) else round(float(v), 6) for v in tile_values]}
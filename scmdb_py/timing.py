@@ -0,0 +1,199 @@
+"""Where the time of each request goes.
+
+Code doing a distinct kind of work runs it in a span:
+
+    with span('figure'):
+        ...
+
+or in a function decorated with @spanned('transform'). Statements executed on
+the SQLAlchemy engines are timed as sql spans, lookups of the cache as cache
+spans. The time of each kind (sql, fetch, transform, figure, serialize, cache,
+compress) is summed over the request and sent back in a Server-Timing header,
+which the network panel of browsers shows next to the response. Spans run on
+the threads of executor.gather are counted in the request which gathered them.
+Spans may nest (figure includes serialize) and, on several threads, add up to
+more than the total. Streamed responses, ie. /plot/gene_view/stream, do their
+work after the headers are sent and are not timed.
+
+A TIMING_LOG_SAMPLE fraction of the requests is also logged as one JSON object
+per line, to TIMING_LOG_FILE or to the standard output.
+"""
+import datetime
+import json
+import random
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+TIMING_LOG_SAMPLE = 0.01
+
+_local = threading.local()
+
+
+class Timings:
+    """Total time and number of spans of each name, for one request."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            total, count = self.spans.get(name, (0.0, 0))
+            self.spans[name] = (total + seconds, count + 1)
+
+    def header(self, total):
+        """Value of the Server-Timing header."""
+
+        metrics = ['{};desc="{}";dur={:.1f}'.format(name, count, seconds * 1000)
+                   for name, (seconds, count) in self.spans.items()]
+        return ', '.join(metrics + ['total;dur={:.1f}'.format(total * 1000)])
+
+
+def current_timings():
+    """Timings of the request handled by this thread, None outside of requests."""
+
+    return getattr(_local, 'timings', None)
+
+
+@contextmanager
+def bind(timings):
+    """Count the spans of this thread in timings, ie. on the threads of executor.gather."""
+
+    previous = current_timings()
+    _local.timings = timings
+    try:
+        yield
+    finally:
+        _local.timings = previous
+
+
+@contextmanager
+def span(name):
+    """Time a block of code as a span of the current request."""
+
+    timings = current_timings()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
+
+
+def timed(name, function, *args, **kwargs):
+    """Call a function in a span, ie. `return timed('serialize', plotly.offline.plot, figure, ...)`."""
+
+    with span(name):
+        return function(*args, **kwargs)
+
+
+def spanned(name):
+    """Decorator timing each call of a function as a span."""
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument_cache(backend):
+    """Time the lookups of a cache backend as cache spans."""
+
+    for method in ['get', 'get_many', 'set', 'set_many']:
+        function = getattr(backend, method, None)
+        if function is not None:
+            setattr(backend, method, spanned('cache')(function))
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('timing_starts', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info['timing_starts'].pop()
+    timings = current_timings()
+    if timings is not None:
+        timings.add('sql', time.perf_counter() - start)
+
+
+def instrument_engines():
+    """Time the execution of every statement on the SQLAlchemy engines as sql spans.
+
+    Rows are read from the cursor afterwards, read_frame times that as fetch spans.
+    """
+
+    if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+
+def log_request(response, total, timings, config):
+    """Write the timings of a request as a line of JSON."""
+
+    record = OrderedDict([('time', str(datetime.datetime.now())),
+                          ('method', request.method),
+                          ('path', request.full_path.rstrip('?')),
+                          ('status', response.status_code),
+                          ('total_ms', round(total * 1000, 1)),
+                          ('spans', OrderedDict((name, {'ms': round(seconds * 1000, 1), 'count': count})
+                                                for name, (seconds, count) in timings.spans.items()))])
+    line = json.dumps(record)
+    if config.get('TIMING_LOG_FILE'):
+        with open(config['TIMING_LOG_FILE'], 'a') as f:
+            f.write(line + '\n')
+    else:
+        print("[{}] TIMING {}".format(record['time'], line))
+        sys.stdout.flush()
+
+
+def init_timing(app):
+    """Time the requests of an application. Called last in create_app, so that compression is timed as well."""
+
+    # Backends of the Flask-Cache instances initialized on the application.
+    for backend in app.extensions.get('cache', {}).values():
+        instrument_cache(backend)
+    instrument_engines()
+
+    @app.before_request
+    def start_timings():
+        _local.timings = Timings()
+
+    # After request handlers run in the reverse order of registration: this one runs first, before the
+    # compression of the response, and write_timings below runs last.
+    @app.after_request
+    def mark_response(response):
+        g.timing_response = time.perf_counter()
+        return response
+
+    def write_timings(response):
+        timings = current_timings()
+        if timings is None or response.is_streamed:
+            return response
+        now = time.perf_counter()
+        if 'timing_response' in g:
+            timings.add('compress', now - g.timing_response)
+        total = now - timings.start
+        response.headers['Server-Timing'] = timings.header(total)
+        if request.endpoint != 'static' and random.random() < app.config.get('TIMING_LOG_SAMPLE', TIMING_LOG_SAMPLE):
+            log_request(response, total, timings, app.config)
+        return response
+
+    app.after_request_funcs.setdefault(None, []).insert(0, write_timings)
+
+    @app.teardown_request
+    def clear_timings(exception=None):
+        _local.timings = None
@@ -0,0 +1,38 @@
+"""Box plot statistics computed by the box-summaries job."""
+import json
+
+import numpy as np
+import pandas as pd
+
+from scmdb_py.box_stats import MAX_OUTLIERS, summarize_groups, summarize_values
+
+
+def test_summarize_values():
+    summary = summarize_values(np.array([4.0, 1.0, 100.0, 3.0, 2.0]))
+
+    assert summary['n'] == 5
+    assert summary['mean'] == 22.0
+    assert (summary['q1'], summary['median'], summary['q3']) == (2.0, 3.0, 4.0)
+    # Whiskers end at the most extreme values within 1.5 IQR of the quartiles.
+    assert (summary['lowerfence'], summary['upperfence']) == (1.0, 4.0)
+    assert json.loads(summary['outliers']) == [100.0]
+
+
+def test_outliers_are_thinned_out():
+    values = np.concatenate([np.zeros(1000), np.arange(1, 301) * 1000.0])
+    outliers = json.loads(summarize_values(values)['outliers'])
+
+    assert len(outliers) == MAX_OUTLIERS
+    assert (outliers[0], outliers[-1]) == (1000.0, 300000.0)
+    assert outliers == sorted(outliers)
+
+
+def test_summarize_groups():
+    values = pd.Series([1.0, 2.0, 3.0, np.nan, 5.0])
+    groups = pd.Series([1.0, 1.0, 1.0, 2.0, np.nan])
+    summaries = summarize_groups(values, groups)
+
+    # Cluster numbers read as floats are labelled as integers, groups without values are left out.
+    assert list(summaries['group_name']) == ['1', 'None']
+    assert list(summaries['n']) == [3, 1]
+    assert list(summaries['median']) == [2.0, 5.0]
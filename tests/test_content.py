@@ -0,0 +1,25 @@
+"""Multi-gene values aligned to the cells of a plot and averaged."""
+import numpy as np
+
+from scmdb_py.content import align_gene_values, nanmean_rows
+
+
+def test_align_gene_values():
+    aligned = align_gene_values(np.array([3, 1, 2]), np.array([1, 2, 4]), np.array([10, 20, 40]))
+
+    assert aligned.dtype == np.float32
+    np.testing.assert_array_equal(aligned, [np.nan, 10, 20])
+
+
+def test_align_gene_values_without_rows():
+    aligned = align_gene_values(np.array([1, 2]), np.array([], dtype=int), np.array([]))
+
+    assert np.isnan(aligned).all()
+
+
+def test_nanmean_rows():
+    matrix = np.array([[1.0, np.nan, 3.0],
+                       [np.nan, np.nan, np.nan],
+                       [2.0, 2.0, 5.0]], dtype=np.float32)
+
+    np.testing.assert_allclose(nanmean_rows(matrix), [2.0, np.nan, 3.0])
@@ -0,0 +1,19 @@
+"""Leaf order of the heatmap dendrograms."""
+import numpy as np
+
+from scmdb_py.dendrogram import cluster_leaves
+
+
+def test_cluster_leaves():
+    matrix = np.array([[0.0, 0.0], [10.0, 10.0], [1.0, 0.0], [11.0, 10.0]])
+
+    for optimal_ordering in [False, True]:
+        linkage, order = cluster_leaves(matrix, optimal_ordering)
+        assert linkage.shape == (3, 4)
+        assert sorted(order) == [0, 1, 2, 3]
+        # Close rows are neighbouring leaves.
+        assert set(order[:2]) in [{0, 2}, {1, 3}]
+
+
+def test_single_row():
+    assert cluster_leaves(np.array([[1.0, 2.0]]), False) == (None, [0])
@@ -0,0 +1,68 @@
+"""read_frame on results whose chunks need different column types."""
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+
+from scmdb_py.fetch import read_frame
+
+
+class FakeResult:
+    def __init__(self, names, rows):
+        self.names = names
+        self.rows = list(rows)
+
+    def keys(self):
+        return self.names
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def close(self):
+        pass
+
+
+class FakeEngine:
+    """Stands for an SQLAlchemy engine, connect() and execute() return the rows given."""
+
+    def __init__(self, names, rows):
+        self.result = FakeResult(names, rows)
+        self.info = {}
+
+    def connect(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execution_options(self, **options):
+        return self
+
+    def execute(self, query, params=None):
+        return self.result
+
+
+def test_mixed_chunks_widen_columns():
+    rows = [(1, None, 2), (2, None, 3),                   # annotation all NULL, value integers
+            (3, 'mL2/3', Decimal('2.5')), (4, 'mPv', None),  # strings, then a fraction and a NULL
+            (5, None, 7)]
+    df = read_frame('SELECT ...', FakeEngine(['cell_id', 'annotation', 'value'], rows), chunk_size=2)
+
+    assert df['cell_id'].dtype == np.int64
+    assert list(df['cell_id']) == [1, 2, 3, 4, 5]
+    assert not pd.api.types.is_numeric_dtype(df['annotation'])
+    assert df['annotation'].isnull().tolist() == [True, True, False, False, True]
+    assert list(df['annotation'][2:4]) == ['mL2/3', 'mPv']
+    assert df['value'].dtype == np.float64
+    np.testing.assert_array_equal(df['value'].values, [2, 3, 2.5, np.nan, 7])
+
+
+def test_empty_result():
+    df = read_frame('SELECT ...', FakeEngine(['cell_id'], []))
+
+    assert list(df.columns) == ['cell_id']
+    assert len(df) == 0
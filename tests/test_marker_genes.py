@@ -0,0 +1,32 @@
+"""Scores and ranks of the marker genes job."""
+import numpy as np
+
+from scmdb_py.marker_genes import cluster_scores, rank_markers
+
+
+def test_cluster_scores():
+    values = np.array([1.0, 2.0, 3.0, 10.0, 11.0, 12.0, 50.0, np.nan])
+    codes = np.array([0, 0, 0, 1, 1, 1, -1, 1])
+    scores = cluster_scores(values, codes, 3)
+
+    # Means 2 and 11, variances 2/3: t = (2 - 11) / sqrt(2/9 + 2/9). Unclustered cells and NaN are left out.
+    np.testing.assert_allclose(scores[:2], [-13.5, 13.5])
+    # No cell in the third cluster.
+    assert np.isnan(scores[2])
+
+
+def test_clusters_without_spread_have_no_score():
+    scores = cluster_scores(np.array([1.0, 1.0, 1.0, 1.0]), np.array([0, 0, 1, 1]), 2)
+
+    assert np.isnan(scores).all()
+
+
+def test_rank_markers():
+    scores = np.array([[0.5, np.nan],
+                       [-2.0, 1.0],
+                       [-1.0, np.nan],
+                       [np.nan, -3.0]])
+
+    markers = rank_markers(scores, top=2)
+    assert [list(rows) for rows in markers] == [[1, 2], [3, 1]]
+    assert [list(rows) for rows in rank_markers(scores, top=5)] == [[1, 2, 0], [3, 1]]
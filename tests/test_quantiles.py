@@ -0,0 +1,40 @@
+"""Percentiles read from quantile sketches against np.percentile."""
+import numpy as np
+
+from scmdb_py.quantiles import SKETCH_SIZE, quantile_sketch, sketch_quantile, sketch_range
+
+
+def test_evenly_spaced_values_are_exact():
+    values = np.random.RandomState(0).permutation(1001).astype(float)
+    sketch = quantile_sketch(np.concatenate([values, [np.nan, np.nan]]))
+
+    assert len(sketch) == SKETCH_SIZE
+    # Percentiles of evenly spaced values are linear in q, so interpolating between the stored ones is exact.
+    for q in [0, 0.0005, 0.05, 0.25, 0.333, 0.5, 0.9975, 1]:
+        assert np.isclose(sketch_quantile(sketch, q), np.percentile(values, 100 * q))
+
+
+def test_whole_percentiles_are_exact():
+    values = np.random.RandomState(1).lognormal(size=500)
+    sketch = quantile_sketch(values)
+
+    for percentile in [0, 1, 5, 37, 50, 99, 100]:
+        assert np.isclose(sketch_quantile(sketch, percentile / 100), np.percentile(values, percentile))
+
+
+def test_quantiles_are_clamped_to_the_endpoints():
+    values = np.array([3.0, -1.0, 7.5, 2.0])
+    sketch = quantile_sketch(values)
+
+    assert sketch_quantile(sketch, 0) == -1.0
+    assert sketch_quantile(sketch, 1) == 7.5
+    assert sketch_quantile(sketch, -0.5) == -1.0
+    assert sketch_quantile(sketch, 1.5) == 7.5
+
+
+def test_all_nan_values():
+    sketch = quantile_sketch([np.nan, np.nan])
+
+    assert sketch == [0.0] * SKETCH_SIZE
+    assert sketch_quantile(sketch, 0.5) == 0.0
+    assert sketch_range(sketch, 0.05, 0.95) == (0.0, 0.01)
@@ -0,0 +1,23 @@
+"""Shapes which the slow queries are counted under."""
+from scmdb_py.slow_queries import query_shape
+
+
+def test_query_shape():
+    shape, ensembles = query_shape("SELECT Ens12.cell_id, gene_ENSMUSG00000026787_3.mCH FROM Ens12\n"
+                                   "  LEFT JOIN gene_ENSMUSG00000026787_3 ON Ens12.cell_id = gene_ENSMUSG00000026787_3.cell_id"
+                                   " WHERE dataset = 'CEMBA_3C' AND cell_id IN (1, 2, 3) LIMIT 10")
+
+    assert shape == ("SELECT Ens?.cell_id, gene_?.mCH FROM Ens? LEFT JOIN gene_? ON Ens?.cell_id = gene_?.cell_id"
+                     " WHERE dataset = ? AND cell_id IN (?, ...) LIMIT ?")
+    assert ensembles == ['Ens12']
+
+
+def test_parameter_lists_share_a_shape():
+    short, _ = query_shape("SELECT cell_id FROM gene_A WHERE cell_id IN (%s, %s)")
+    long, _ = query_shape("SELECT cell_id FROM gene_B WHERE cell_id IN (%s, %s, %s, %s)")
+
+    assert short == long == "SELECT cell_id FROM gene_? WHERE cell_id IN (?, ...)"
+
+
+def test_ensembles_of_a_query():
+    assert query_shape("SELECT * FROM Ens3 INNER JOIN Ens1 ON Ens3.cell_id = Ens1.cell_id")[1] == ['Ens1', 'Ens3']
@@ -0,0 +1,46 @@
+"""Cells picked for the tiles of a spatial index."""
+import numpy as np
+from scipy.spatial import cKDTree
+
+from scmdb_py.tiles import get_tile_indices
+
+
+def make_index(unit, priority=None):
+    """The parts of a get_spatial_index index that get_tile_indices reads."""
+
+    unit = np.asarray(unit, dtype=np.float64)
+    priority = np.arange(len(unit)) if priority is None else np.asarray(priority)
+    return {'unit': unit, 'tree': cKDTree(unit), 'priority': priority}
+
+
+def test_tiles_split_the_unit_square():
+    index = make_index([[0.1, 0.1], [0.9, 0.1], [0.1, 0.9], [0.9, 0.9], [0.4, 0.6]])
+
+    assert list(get_tile_indices(index, 0, 0, 0)) == [0, 1, 2, 3, 4]
+    assert list(get_tile_indices(index, 1, 0, 0)) == [0]
+    assert list(get_tile_indices(index, 1, 1, 0)) == [1]
+    assert list(get_tile_indices(index, 1, 0, 1)) == [2, 4]
+    assert list(get_tile_indices(index, 1, 1, 1)) == [3]
+
+
+def test_border_cells_are_in_one_tile():
+    index = make_index([[0.5, 0.25], [1.0, 1.0], [0.0, 0.0]])
+
+    assert list(get_tile_indices(index, 1, 0, 0)) == [2]
+    assert list(get_tile_indices(index, 1, 1, 0)) == [0]
+    assert list(get_tile_indices(index, 1, 1, 1)) == [1]
+
+
+def test_cells_are_picked_by_priority():
+    index = make_index([[0.1, 0.1], [0.2, 0.2], [0.3, 0.3], [0.4, 0.4]], priority=[3, 0, 2, 1])
+
+    assert list(get_tile_indices(index, 0, 0, 0)) == [1, 3, 2, 0]
+    assert list(get_tile_indices(index, 0, 0, 0, tile_points=2)) == [1, 3]
+
+
+def test_tiles_outside_of_the_zoom_level_are_empty():
+    index = make_index([[0.1, 0.1]])
+
+    assert get_tile_indices(index, 1, 2, 0).size == 0
+    assert get_tile_indices(index, 1, 0, -1).size == 0
+    assert get_tile_indices(index, 2, 3, 3).size == 0